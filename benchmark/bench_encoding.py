@@ -0,0 +1,99 @@
+"""
+Benchmark guessing the encoding of large files
+
+The files in `test/sample_encodings` are repeated to make large files, and
+the time taken to guess their encoding is compared with decoding the whole file.
+
+Usage:
+
+    python benchmark/bench_encoding.py --size 200
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from threesixty import ThreeSixtyGiving
+from threesixty.threesixty import ENCODINGS_TO_CHECK
+
+SAMPLE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'test', 'sample_encodings'
+)
+
+
+def scale_file(source, destination, size):
+    """
+    Write a file of around `size` bytes by repeating the contents of another file
+
+    The repeated contents are put at the end of the file, after plain ASCII
+    text, so the non-ASCII characters are as far into the file as possible.
+    """
+    with open(source, 'rb') as f_:
+        contents = f_.read()
+    padding = b'a,b,c,d,e,f,g\r\n' * 1000
+    with open(destination, 'wb') as f_:
+        written = 0
+        while written < size - len(contents):
+            f_.write(padding)
+            written += len(padding)
+        f_.write(contents)
+
+
+def read_whole_file(f):
+    """
+    How encodings were guessed before - decode the whole file with each encoding
+    """
+    for e in ENCODINGS_TO_CHECK:
+        try:
+            with open(f, encoding=e) as f_:
+                f_.read()
+            return e
+        except UnicodeDecodeError:
+            continue
+
+
+def guess_encoding(f, **kwargs):
+    fileobj, encoding = ThreeSixtyGiving.guess_encoding(f, **kwargs)
+    fileobj.close()
+    return encoding
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark guessing file encodings')
+    parser.add_argument('--size', type=int, default=200, help='Size of the test files in MB')
+    parser.add_argument('--sample-sizes', type=int, nargs='+', default=[1024 * 1024],
+                        help='Sample sizes (in bytes) to test')
+    args = parser.parse_args()
+
+    print('{:>12} {:>16} {:>12} {:>10}'.format('file', 'method', 'encoding', 'seconds'))
+    for sample in sorted(os.listdir(SAMPLE_DIR)):
+        t_, t = tempfile.mkstemp(suffix='.txt')
+        os.close(t_)
+        try:
+            scale_file(os.path.join(SAMPLE_DIR, sample), t, args.size * 1024 * 1024)
+
+            methods = [
+                ('whole file', lambda: read_whole_file(t)),
+                ('chunked', lambda: guess_encoding(t)),
+            ]
+            for sample_size in args.sample_sizes:
+                methods.append((
+                    'sample {}'.format(sample_size),
+                    lambda s=sample_size: guess_encoding(t, sample_size=s)
+                ))
+
+            for name, method in methods:
+                start = time.perf_counter()
+                encoding = method()
+                elapsed = time.perf_counter() - start
+                print('{:>12} {:>16} {:>12} {:>10.3f}'.format(sample, name, encoding, elapsed))
+        finally:
+            os.remove(t)
+
+
+if __name__ == '__main__':
+    main()
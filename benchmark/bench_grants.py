@@ -0,0 +1,50 @@
+"""
+Benchmark the memory and time used by iterating the grants in a dataset
+
+Compares creating each `Grant` with a copy of the grant's fields
+(`Grant(**grant)`, which is how grants used to be created) with a
+`Grant` that is a view of the existing data (`Grant.from_dict(grant)`).
+
+Usage:
+
+    python benchmark/bench_grants.py --grants 100000
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from threesixty import Grant
+from generate import generate_grants
+
+METHODS = {
+    'copy': lambda g: Grant(**g),
+    'view': Grant.from_dict,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark creating grant objects')
+    parser.add_argument('--grants', type=int, default=100000, help='Number of grants to create')
+    args = parser.parse_args()
+
+    grants = list(generate_grants(args.grants))
+
+    print('{:>6} {:>10} {:>12} {:>16}'.format('method', 'seconds', 'MB held', 'bytes per grant'))
+    for name, method in METHODS.items():
+        tracemalloc.start()
+        start = time.perf_counter()
+        held = [method(g) for g in grants]
+        elapsed = time.perf_counter() - start
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('{:>6} {:>10.3f} {:>12.1f} {:>16,.0f}'.format(
+            name, elapsed, size / 1024 / 1024, size / len(held)))
+        del held
+
+
+if __name__ == '__main__':
+    main()
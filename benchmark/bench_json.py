@@ -0,0 +1,64 @@
+"""
+Benchmark reading and writing a large JSON file with each JSON backend
+
+Usage:
+
+    python benchmark/bench_json.py --grants 1000000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from threesixty import ThreeSixtyGiving
+from threesixty.jsonbackend import BACKENDS
+from generate import write_json
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark JSON backends')
+    parser.add_argument('--grants', type=int, default=1000000, help='Number of grants in the synthetic file')
+    parser.add_argument('--backends', nargs='+', default=list(BACKENDS), help='Backends to test')
+    args = parser.parse_args()
+
+    t_, t = tempfile.mkstemp(suffix='.json')
+    os.close(t_)
+    o_, o = tempfile.mkstemp(suffix='.json')
+    os.close(o_)
+    try:
+        write_json(t, args.grants)
+        size = os.path.getsize(t) / 1024 / 1024
+        print('File size: {:,.0f} MB'.format(size))
+        print('{:>8} {:>16} {:>10} {:>10} {:>10}'.format('backend', 'operation', 'seconds', 'MB/second', 'grants/s'))
+
+        class Timer(ThreeSixtyGiving):
+            pass
+
+        for backend in args.backends:
+            Timer.json_backend = backend
+            start = time.perf_counter()
+            g = Timer.from_json(t, validate=False)
+            results = [('from_json', time.perf_counter() - start)]
+
+            start = time.perf_counter()
+            g.to_json(o, compact=True)
+            results.append(('to_json compact', time.perf_counter() - start))
+
+            start = time.perf_counter()
+            g.to_json(o)
+            results.append(('to_json indent', time.perf_counter() - start))
+
+            for operation, elapsed in results:
+                print('{:>8} {:>16} {:>10.2f} {:>10.1f} {:>10,.0f}'.format(
+                    backend, operation, elapsed, size / elapsed, args.grants / elapsed))
+            del g
+    finally:
+        os.remove(t)
+        os.remove(o)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Benchmark creating a pandas DataFrame from a large file
+
+Compares:
+
+- `rows`: creating the DataFrame from the list of rows made by `to_flatfile()`
+  (how `to_pandas()` used to work), leaving every column as an object
+- `to_pandas`: the columns built directly, without types
+- `typed`: `to_pandas(typed=True)`, with column types based on the schema
+
+Usage:
+
+    python benchmark/bench_pandas.py --grants 100000
+
+Each method is run `--repeat` times and the fastest run is reported.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas
+
+from threesixty import ThreeSixtyGiving
+from generate import write_json
+
+
+def rows(g):
+    data, fieldnames = g.to_flatfile()
+    return pandas.DataFrame(data, columns=fieldnames)
+
+
+METHODS = {
+    'rows': rows,
+    'to_pandas': lambda g: g.to_pandas(convert_fieldnames=False),
+    'typed': lambda g: g.to_pandas(convert_fieldnames=False, typed=True),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark creating pandas DataFrames')
+    parser.add_argument('--grants', type=int, default=100000, help='Number of grants in the synthetic file')
+    parser.add_argument('--schema-url', default=None, help='URL of the package schema to use')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of times to run each method')
+    args = parser.parse_args()
+
+    t_, t = tempfile.mkstemp(suffix='.json')
+    os.close(t_)
+    try:
+        write_json(t, args.grants)
+        g = ThreeSixtyGiving.from_json(t, validate=False, schema_url=args.schema_url)
+        g.fetch_schema()
+
+        print('{:>10} {:>10} {:>14} {:>12}'.format('method', 'seconds', 'grants/second', 'MB in memory'))
+        for name, method in METHODS.items():
+            elapsed = None
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                df = method(g)
+                run = time.perf_counter() - start
+                elapsed = run if elapsed is None else min(elapsed, run)
+            size = df.memory_usage(deep=True).sum() / 1024 / 1024
+            print('{:>10} {:>10.2f} {:>14,.0f} {:>12.1f}'.format(
+                name, elapsed, args.grants / elapsed, size))
+            del df
+    finally:
+        os.remove(t)
+
+
+if __name__ == '__main__':
+    main()
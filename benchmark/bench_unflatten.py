@@ -0,0 +1,71 @@
+"""
+Benchmark converting a CSV file using flattentool and the native unflattener
+
+The sample CSV file is repeated (with new grant identifiers) to make a large file.
+
+Usage:
+
+    python benchmark/bench_unflatten.py --rows 1000000
+"""
+import argparse
+import csv
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from threesixty import ThreeSixtyGiving
+
+SAMPLE_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'test', 'sample_data', 'ExampleTrust-grants-fixed.csv'
+)
+
+
+def scale_csv(source, destination, rows):
+    """
+    Write a CSV file with a set number of rows by repeating the rows in another file
+
+    The first column (the grant identifier) is made unique for each row.
+    """
+    with open(source, encoding='utf-8-sig', newline='') as f_:
+        reader = csv.reader(f_)
+        headers = next(reader)
+        sample = list(reader)
+    with open(destination, 'w', encoding='utf8', newline='') as f_:
+        writer = csv.writer(f_)
+        writer.writerow(headers)
+        for i in range(rows):
+            row = list(sample[i % len(sample)])
+            row[0] = '{}-{}'.format(row[0], i)
+            writer.writerow(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark unflattening CSV files')
+    parser.add_argument('--rows', type=int, default=1000000, help='Number of rows in the CSV file')
+    parser.add_argument('--source', default=SAMPLE_FILE, help='CSV file to repeat')
+    parser.add_argument('--engines', nargs='+', default=['flattentool', 'native'],
+                        help='Engines to test')
+    args = parser.parse_args()
+
+    t_, t = tempfile.mkstemp(suffix='.csv')
+    os.close(t_)
+    try:
+        scale_csv(args.source, t, args.rows)
+        print('{:>12} {:>10} {:>12}'.format('engine', 'seconds', 'rows/second'))
+        for engine in args.engines:
+            start = time.perf_counter()
+            g = ThreeSixtyGiving.from_csv(t, engine=engine, validate=False)
+            elapsed = time.perf_counter() - start
+            assert len(g.data[g.root_id]) == args.rows
+            print('{:>12} {:>10.2f} {:>12,.0f}'.format(engine, elapsed, args.rows / elapsed))
+            del g
+    finally:
+        os.remove(t)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Benchmark validating a large file using different numbers of processes
+
+Usage:
+
+    python benchmark/bench_validation.py --grants 500000 --workers 1 2 4 8
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from threesixty import ThreeSixtyGiving
+from generate import write_json
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parallel validation')
+    parser.add_argument('--grants', type=int, default=500000, help='Number of grants in the synthetic file')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, os.cpu_count()],
+                        help='Numbers of processes to test')
+    parser.add_argument('--schema-url', default=None, help='URL of the package schema to use')
+    args = parser.parse_args()
+
+    t_, t = tempfile.mkstemp(suffix='.json')
+    os.close(t_)
+    try:
+        write_json(t, args.grants)
+        g = ThreeSixtyGiving.from_json(t, validate=False, schema_url=args.schema_url)
+        g.fetch_schema()
+
+        print('{:>8} {:>10} {:>14} {:>8}'.format('workers', 'seconds', 'grants/second', 'speedup'))
+        baseline = None
+        for workers in sorted(set(args.workers)):
+            start = time.perf_counter()
+            errors = list(g.get_errors_parallel(workers=workers))
+            elapsed = time.perf_counter() - start
+            if baseline is None:
+                baseline = elapsed
+            print('{:>8} {:>10.2f} {:>14,.0f} {:>7.2f}x'.format(
+                workers, elapsed, args.grants / elapsed, baseline / elapsed))
+            assert not errors, errors[:5]
+    finally:
+        os.remove(t)
+
+
+if __name__ == '__main__':
+    main()
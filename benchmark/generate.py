@@ -0,0 +1,264 @@
+"""
+Generate synthetic 360Giving data for benchmarking
+
+The data is the same each time for the same options and seed. The number of
+beneficiary locations and extra columns for each grant can be set to make
+the data wider, and a proportion of the grants can be made invalid.
+
+Usage:
+
+    python benchmark/generate.py 500000 grants.json
+    python benchmark/generate.py 100000 grants.csv --locations 3 --extra-fields 20 --invalid 0.05
+    python benchmark/generate.py 100000 grants.xlsx
+"""
+import argparse
+import csv
+import json
+import os
+import random
+from datetime import datetime, timedelta
+
+CURRENCIES = ['GBP', 'GBP', 'GBP', 'EUR', 'USD']
+WORDS = ['community', 'project', 'youth', 'arts', 'health', 'support', 'centre',
+         'education', 'heritage', 'sports', 'environment', 'trust', 'local']
+PLACES = [
+    ('Bath and North East Somerset', 'E06000022'),
+    ('Bristol', 'E06000023'),
+    ('Cardiff', 'W06000015'),
+    ('Glasgow City', 'S12000049'),
+    ('Leeds', 'E08000035'),
+    ('Manchester', 'E08000003'),
+    ('Norfolk', 'E10000020'),
+]
+
+# titles used as the column headings in CSV and Excel files, as in files from publishers
+TITLES = {
+    'id': 'Identifier',
+    'title': 'Title',
+    'description': 'Description',
+    'currency': 'Currency',
+    'amountAwarded': 'Amount Awarded',
+    'awardDate': 'Award Date',
+    'recipientOrganization': 'Recipient Org',
+    'beneficiaryLocation': 'Beneficiary Location',
+    'fundingOrganization': 'Funding Org',
+    'name': 'Name',
+    'countryCode': 'Country Code',
+    'geoCode': 'Geographic Code',
+    'geoCodeType': 'Geographic Code Type',
+    'dateModified': 'Last Modified',
+    'dataSource': 'Data Source',
+}
+
+
+def make_invalid(grant, rand):
+    """
+    Break a grant in one of the ways publishers' data is often invalid
+    """
+    problem = rand.randrange(4)
+    if problem == 0:
+        grant['amountAwarded'] = 'unknown'
+    elif problem == 1:
+        del grant['recipientOrganization'][0]['id']
+    elif problem == 2:
+        grant['currency'] = 'Pounds'
+    else:
+        del grant['title']
+    return grant
+
+
+def generate_grant(i, rand, locations=1, extra_fields=0, invalid=False):
+    """
+    Create a single grant that is valid against the 360Giving schema
+
+    :param int i: number of the grant, used to make the identifier
+    :param random.Random rand: random number generator
+    :param int locations: number of `beneficiaryLocation` entries
+    :param int extra_fields: number of fields to add that aren't in the schema (as publishers often do)
+    :param bool invalid: make the grant invalid against the schema instead
+    :return: dictionary with the grant data
+    """
+    award_date = datetime(2015, 1, 1) + timedelta(days=rand.randint(0, 2000))
+    recipient = rand.randint(1, 50000)
+    grant = {
+        'id': '360G-BENCH-{:08d}'.format(i),
+        'title': 'Grant to {} {}'.format(rand.choice(WORDS).title(), rand.choice(WORDS)),
+        'description': ' '.join(rand.choice(WORDS) for _ in range(rand.randint(5, 30))),
+        'currency': rand.choice(CURRENCIES),
+        'amountAwarded': rand.randint(100, 500000),
+        'awardDate': award_date.strftime('%Y-%m-%dT00:00:00+00:00'),
+        'recipientOrganization': [{
+            'id': 'GB-CHC-{}'.format(recipient),
+            'name': 'Recipient Charity {}'.format(recipient),
+        }],
+        'fundingOrganization': [{
+            'id': 'GB-CHC-1000000',
+            'name': 'Benchmark Foundation',
+        }],
+        'dateModified': '2019-01-01T00:00:00+00:00',
+        'dataSource': 'http://www.example.org/grants.htm',
+    }
+    if locations:
+        grant['beneficiaryLocation'] = []
+        for _ in range(locations):
+            name, code = rand.choice(PLACES)
+            grant['beneficiaryLocation'].append({
+                'name': name,
+                'countryCode': 'GB',
+                'geoCode': code,
+                'geoCodeType': 'LA',
+            })
+    for j in range(extra_fields):
+        grant['Extra Field {}'.format(j + 1)] = rand.choice(WORDS)
+    if invalid:
+        make_invalid(grant, rand)
+    return grant
+
+
+def generate_grants(n, seed=0, locations=1, extra_fields=0, invalid_ratio=0):
+    """
+    Yield a number of synthetic grants
+
+    :param int n: number of grants to create
+    :param int seed: seed for the random number generator, so the output is reproducible
+    :param int locations: number of `beneficiaryLocation` entries for each grant
+    :param int extra_fields: number of fields that aren't in the schema to add to each grant
+    :param float invalid_ratio: proportion of the grants (between 0 and 1) that are invalid
+    """
+    rand = random.Random(seed)
+    for i in range(n):
+        invalid = invalid_ratio > 0 and rand.random() < invalid_ratio
+        yield generate_grant(i, rand, locations, extra_fields, invalid)
+
+
+def flatten_grant(grant):
+    """
+    Turn a grant into a flat dictionary with column headings as the keys
+    (eg `Recipient Org:0:Identifier`)
+    """
+    row = {}
+    for k, v in grant.items():
+        title = TITLES.get(k, k)
+        if isinstance(v, list):
+            for i, item in enumerate(v):
+                for k_, v_ in item.items():
+                    row['{}:{}:{}'.format(title, i, TITLES.get(k_, k_))] = v_
+        else:
+            row[title] = v
+    return row
+
+
+def flat_headings(locations=1, extra_fields=0):
+    """
+    The column headings for grants generated with these options
+    """
+    rand = random.Random(0)
+    return list(flatten_grant(generate_grant(0, rand, locations, extra_fields)))
+
+
+def write_json(f, n, seed=0, **kwargs):
+    """
+    Write a 360Giving package with synthetic grants to a JSON file
+
+    Grants are written one at a time so large files can be created
+    without holding them all in memory.
+
+    :param str f: file path to write to
+    :param int n: number of grants to create
+    :param int seed: seed for the random number generator
+
+    Additional keyword arguments are passed to `generate_grants()`
+    """
+    with open(f, 'w') as f_:
+        f_.write('{"grants": [\n')
+        for i, g in enumerate(generate_grants(n, seed, **kwargs)):
+            if i:
+                f_.write(',\n')
+            json.dump(g, f_)
+        f_.write('\n]}\n')
+
+
+def write_csv(f, n, seed=0, **kwargs):
+    """
+    Write synthetic grants to a CSV file, using titles from the schema as the headings
+
+    :param str f: file path to write to
+    :param int n: number of grants to create
+    :param int seed: seed for the random number generator
+
+    Additional keyword arguments are passed to `generate_grants()`
+    """
+    headings = flat_headings(kwargs.get('locations', 1), kwargs.get('extra_fields', 0))
+    with open(f, 'w', encoding='utf8', newline='') as f_:
+        writer = csv.DictWriter(f_, fieldnames=headings, extrasaction='ignore')
+        writer.writeheader()
+        for g in generate_grants(n, seed, **kwargs):
+            writer.writerow(flatten_grant(g))
+
+
+def write_xlsx(f, n, seed=0, **kwargs):
+    """
+    Write synthetic grants to the `grants` sheet of an Excel file, using titles
+    from the schema as the headings
+
+    :param str f: file path to write to
+    :param int n: number of grants to create (up to 1,048,575, the most rows a sheet can hold)
+    :param int seed: seed for the random number generator
+
+    Additional keyword arguments are passed to `generate_grants()`
+    """
+    import xlsxwriter
+
+    headings = flat_headings(kwargs.get('locations', 1), kwargs.get('extra_fields', 0))
+    columns = {h: i for i, h in enumerate(headings)}
+    workbook = xlsxwriter.Workbook(f, {'constant_memory': True})
+    try:
+        worksheet = workbook.add_worksheet('grants')
+        worksheet.write_row(0, 0, headings)
+        for r, g in enumerate(generate_grants(n, seed, **kwargs), start=1):
+            for k, v in flatten_grant(g).items():
+                if k in columns:
+                    worksheet.write(r, columns[k], v)
+    finally:
+        workbook.close()
+
+
+WRITERS = {
+    'json': write_json,
+    'csv': write_csv,
+    'xlsx': write_xlsx,
+}
+
+
+def write_file(f, n, seed=0, filetype=None, **kwargs):
+    """
+    Write synthetic grants to a file in the format given by its extension
+    (`.json`, `.csv` or `.xlsx`) or by `filetype`
+    """
+    if filetype is None:
+        filetype = os.path.splitext(f)[1].lstrip('.').lower()
+    if filetype not in WRITERS:
+        raise ValueError('Unknown file type [{}]'.format(filetype))
+    WRITERS[filetype](f, n, seed, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic 360Giving data')
+    parser.add_argument('grants', type=int, help='Number of grants to create')
+    parser.add_argument('output', help='File to write to (.json, .csv or .xlsx)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the random number generator')
+    parser.add_argument('--locations', type=int, default=1,
+                        help='Number of beneficiary locations for each grant')
+    parser.add_argument('--extra-fields', type=int, default=0,
+                        help='Number of fields that aren\'t in the schema to add to each grant')
+    parser.add_argument('--invalid', type=float, default=0,
+                        help='Proportion of grants (between 0 and 1) that are invalid')
+    parser.add_argument('--format', choices=list(WRITERS), default=None,
+                        help='File format, if not given by the extension of the output file')
+    args = parser.parse_args()
+    write_file(args.output, args.grants, args.seed, args.format, locations=args.locations,
+               extra_fields=args.extra_fields, invalid_ratio=args.invalid)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+"""
+Run a set of benchmarks covering reading, validating and exporting data
+
+Synthetic files are created by `generate.py` for each size (and kept in
+`--data-dir` so later runs don't need to create them again). Each operation
+is run in a new process so that the peak memory (resident set size) reported
+is for that operation alone, although it includes the data loaded before the
+operation starts (eg the grants that are exported by `to_csv`).
+
+The results can be saved and compared with a later run. Operations that are
+slower (or use more memory) than the baseline by more than `--threshold` are
+reported as regressions, and the script exits with an error.
+
+Schemas are stored in a `SchemaCache` in `--cache-dir`, fetched once before the
+benchmarks start, so the timings don't include downloading them.
+
+Usage:
+
+    python benchmark/suite.py --sizes 1000 100000 --save baseline.json
+    python benchmark/suite.py --sizes 1000 100000 --compare baseline.json
+    python benchmark/suite.py --operations from_json is_valid --sizes 1000000
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from threesixty import ThreeSixtyGiving, SchemaCache
+from threesixty.stats import peak_memory
+from generate import write_file
+
+# the most grants that fit on an Excel sheet (below the heading row)
+MAX_EXCEL_ROWS = 1048575
+
+
+def _load(path, **kwargs):
+    return ThreeSixtyGiving.from_json(path, validate=False, **kwargs)
+
+
+def _export(method, suffix, **kwargs):
+    """
+    Create an operation that exports the data to a temporary file
+    """
+    def run(g, data_dir):
+        t_, t = tempfile.mkstemp(suffix=suffix, dir=data_dir)
+        os.close(t_)
+        try:
+            getattr(g, method)(t, **kwargs)
+        finally:
+            os.remove(t)
+    return run
+
+
+# each operation is a tuple of `(file type to read, setup, operation)`. `setup` is
+# called (and not timed) with the path of the file and returns the argument
+# passed to `operation`
+OPERATIONS = {
+    'from_json': ('json', lambda path: path, lambda path, data_dir: _load(path)),
+    'from_csv': ('csv', lambda path: path,
+                 lambda path, data_dir: ThreeSixtyGiving.from_csv(path, validate=False)),
+    'from_excel': ('xlsx', lambda path: path,
+                   lambda path, data_dir: ThreeSixtyGiving.from_excel(path, validate=False)),
+    'is_valid': ('json', _load, lambda g, data_dir: g.is_valid()),
+    'to_flatfile': ('json', _load, lambda g, data_dir: g.to_flatfile()),
+    'to_csv': ('json', _load, _export('to_csv', '.csv')),
+    'to_excel': ('json', _load, _export('to_excel', '.xlsx')),
+    'to_pandas': ('json', _load, lambda g, data_dir: g.to_pandas()),
+}
+
+
+def data_file(data_dir, filetype, size, options):
+    """
+    Get the path of a synthetic data file, creating it if it doesn't exist
+    """
+    name = 'grants-{}-s{seed}-l{locations}-x{extra_fields}-i{invalid_ratio}.{}'.format(
+        size, filetype, **options)
+    path = os.path.join(data_dir, name)
+    if not os.path.exists(path):
+        t = path + '.tmp'
+        write_file(t, size, filetype=filetype, **options)
+        os.replace(t, path)
+    return path
+
+
+def run_operation(name, path, data_dir, cache_dir):
+    """
+    Run a single operation in this process, and measure it
+
+    :return: dict with the seconds taken and the peak memory used in bytes
+    """
+    # flattentool warns about every invalid value
+    warnings.simplefilter('ignore')
+    ThreeSixtyGiving.schema_cache = SchemaCache(cache_dir, offline=True)
+    _, setup, operation = OPERATIONS[name]
+    arg = setup(path)
+    if isinstance(arg, ThreeSixtyGiving):
+        arg.fetch_schema()
+    start = time.perf_counter()
+    operation(arg, data_dir)
+    elapsed = time.perf_counter() - start
+    return {'seconds': elapsed, 'peak_memory': peak_memory()}
+
+
+def run_suite(sizes, operations, data_dir, cache_dir, options, repeat=1):
+    """
+    Run each operation for each size of data
+
+    The fastest of the repeated runs is used.
+
+    :return: list of results
+    """
+    context = get_context('spawn')
+    results = []
+    for size in sizes:
+        for name in operations:
+            filetype = OPERATIONS[name][0]
+            if filetype == 'xlsx' and size > MAX_EXCEL_ROWS:
+                print('{:>12} {:>10,} skipped: too many rows for an Excel file'.format(name, size))
+                continue
+            path = data_file(data_dir, filetype, size, options)
+            runs = []
+            for _ in range(repeat):
+                # a new process for each run, so the peak memory isn't left over from an earlier one
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    runs.append(executor.submit(
+                        run_operation, name, path, data_dir, cache_dir).result())
+            result = min(runs, key=lambda r: r['seconds'])
+            result.update({
+                'operation': name,
+                'grants': size,
+                'grants_per_second': size / result['seconds'] if result['seconds'] else None,
+                'file_size': os.path.getsize(path),
+            })
+            results.append(result)
+            print_result(result)
+    return results
+
+
+def _mb(n):
+    return n / 1024 / 1024 if n is not None else float('nan')
+
+
+def print_header():
+    print('{:>12} {:>10} {:>10} {:>12} {:>10} {:>12}'.format(
+        'operation', 'grants', 'seconds', 'grants/s', 'file MB', 'peak RSS MB'))
+
+
+def print_result(result):
+    print('{:>12} {:>10,} {:>10.3f} {:>12,.0f} {:>10.1f} {:>12.1f}'.format(
+        result['operation'], result['grants'], result['seconds'],
+        result['grants_per_second'] or 0, _mb(result['file_size']), _mb(result['peak_memory'])))
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results with a baseline from an earlier run
+
+    :param float threshold: how much slower (or more memory) counts as a regression, eg 0.1 for 10%
+    :return: list of the regressions found
+    """
+    previous = {(r['operation'], r['grants']): r for r in baseline['results']}
+    regressions = []
+    print()
+    print('{:>12} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'operation', 'grants', 'seconds', 'change', 'peak MB', 'change'))
+    for r in results:
+        b = previous.get((r['operation'], r['grants']))
+        if b is None:
+            continue
+        time_change = r['seconds'] / b['seconds'] - 1 if b['seconds'] else 0
+        memory_change = 0
+        if r['peak_memory'] and b.get('peak_memory'):
+            memory_change = r['peak_memory'] / b['peak_memory'] - 1
+        flags = []
+        if time_change > threshold:
+            flags.append('slower')
+        if memory_change > threshold:
+            flags.append('more memory')
+        if flags:
+            regressions.append((r['operation'], r['grants'], flags))
+        print('{:>12} {:>10,} {:>10.3f} {:>+9.1%} {:>10.1f} {:>+9.1%} {}'.format(
+            r['operation'], r['grants'], r['seconds'], time_change,
+            _mb(r['peak_memory']), memory_change, ', '.join(flags)))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the benchmark suite')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000],
+                        help='Numbers of grants to test with')
+    parser.add_argument('--operations', nargs='+', default=list(OPERATIONS),
+                        choices=list(OPERATIONS), help='Operations to run')
+    parser.add_argument('--locations', type=int, default=1,
+                        help='Number of beneficiary locations for each grant')
+    parser.add_argument('--extra-fields', type=int, default=0,
+                        help='Number of fields that aren\'t in the schema to add to each grant')
+    parser.add_argument('--invalid', type=float, default=0,
+                        help='Proportion of grants (between 0 and 1) that are invalid')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the random number generator')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of times to run each operation')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'threesixty-benchmark'),
+                        help='Directory to keep the synthetic data files in')
+    parser.add_argument('--cache-dir', default=None, help='Directory to store schemas in')
+    parser.add_argument('--save', help='Save the results to this JSON file')
+    parser.add_argument('--compare', help='Compare the results with those saved in this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='How much slower than the baseline counts as a regression (default 0.1 = 10%%)')
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    cache = SchemaCache(args.cache_dir)
+    ThreeSixtyGiving(schema_cache=cache).fetch_schema()
+
+    options = {
+        'seed': args.seed,
+        'locations': args.locations,
+        'extra_fields': args.extra_fields,
+        'invalid_ratio': args.invalid,
+    }
+    print_header()
+    results = run_suite(args.sizes, args.operations, args.data_dir, cache.cache_dir, options, args.repeat)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'options': options,
+                'results': results,
+            }, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('options') != options:
+            print('Warning: the baseline used different data options: {}'.format(baseline.get('options')))
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print()
+            for operation, size, flags in regressions:
+                print('Regression: {} with {:,} grants ({})'.format(operation, size, ', '.join(flags)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
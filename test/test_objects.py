@@ -1,11 +1,20 @@
+import csv
+import datetime
+import io
+import json
 import tempfile
+import gzip
 import os
+import re
 
 import pytest
+import requests
 import requests_mock
 import pandas
 
-from threesixty import ThreeSixtyGiving, Grant, ParseError
+from threesixty import ThreeSixtyGiving, Grant, ParseError, ErrorRecord, LazyGrants, SchemaCache, DatasetCache, Stats, clear_compiled_schemas
+from threesixty.fastvalidator import compile_validator, UnsupportedSchema
+from threesixty import schema as threesixty_schema
 
 @pytest.fixture
 def get_file():
@@ -217,4 +226,896 @@ def test_encodings(get_file):
     assert encoding[1] == 'latin_1'
     f = get_file(os.path.join('sample_encodings', 'utf8.txt'))
     encoding = ThreeSixtyGiving.guess_encoding(f)
-    assert encoding[1] == 'utf-8-sig'
\ No newline at end of file
+    assert encoding[1] == 'utf-8-sig'
+
+    # bytes and file objects
+    with open(get_file(os.path.join('sample_encodings', 'cp1252.txt')), 'rb') as f_:
+        contents = f_.read()
+        f_.seek(0)
+        fileobj, encoding = ThreeSixtyGiving.guess_encoding(f_)
+        assert encoding == 'latin_1'
+        assert fileobj.read() == contents.decode('latin_1')
+        # the file object passed in isn't closed with the wrapper
+        fileobj.close()
+        del fileobj
+        assert not f_.closed
+        f_.seek(0)
+        with ThreeSixtyGiving.guess_encoding(f_)[0]:
+            pass
+        assert not f_.closed
+    assert ThreeSixtyGiving.guess_encoding(contents)[1] == 'latin_1'
+
+    # only checking the start of the file
+    assert ThreeSixtyGiving.guess_encoding(contents, sample_size=100)[1] == 'utf-8-sig'
+
+    # fall back to detecting the encoding
+    with open(get_file(os.path.join('sample_encodings', 'utf8.txt')), 'rb') as f_:
+        encoding = ThreeSixtyGiving.guess_encoding(f_.read(), encodings=['ascii'])
+    assert encoding[1].lower().replace('_', '-') == 'utf-8'
+    assert ThreeSixtyGiving.guess_encoding(contents, encodings=['ascii'], min_confidence=1.1) is None
+
+    # newlines in quoted CSV fields are kept
+    t_, t = tempfile.mkstemp(suffix='.csv')
+    with os.fdopen(t_, 'wb') as f_:
+        f_.write(b'id,description\r\n1,"two\r\nlines"\r\n')
+    fileobj, encoding = ThreeSixtyGiving.guess_encoding(t)
+    with fileobj:
+        assert list(csv.reader(fileobj)) == [['id', 'description'], ['1', 'two\r\nlines']]
+    os.remove(t)
+
+def test_iter_json(get_file):
+    f = get_file("sample_data/ExampleTrust-grants-fixed.json")
+    g = ThreeSixtyGiving.from_json(f, validate=False)
+    stream = ThreeSixtyGiving.iter_json(f)
+    grants = list(stream)
+    assert len(grants) == 10
+    assert isinstance(grants[0], Grant)
+    assert [x.id for x in grants] == [x.id for x in g]
+    assert list(stream.iter_raw()) == g.data["grants"]
+    for k, v in g.data.items():
+        if k != "grants":
+            assert stream.metadata[k] == v
+
+    # also accepts a file object
+    with open(f, 'rb') as f_:
+        assert len(list(ThreeSixtyGiving.iter_json(f_))) == 10
+
+
+def test_iter_grant_errors(get_file, m):
+    g = ThreeSixtyGiving.from_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json"))
+    assert list(g.iter_grant_errors()) == []
+    assert list(g.iter_grant_errors(ThreeSixtyGiving.iter_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json")))) == []
+
+    grants = [dict(grant.__dict__) for grant in g]
+    grants[2]["amountAwarded"] = "lots"
+    del grants[5]["title"]
+    errors = list(g.iter_grant_errors(grants))
+    assert [(i, grant_id) for i, grant_id, e in errors] == [
+        (2, grants[2]["id"]),
+        (5, grants[5]["id"]),
+    ]
+    assert errors[0][2].validator == "type"
+
+
+def test_parallel_validation(get_file, m):
+    g = ThreeSixtyGiving.from_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json"), workers=2)
+    assert g.is_valid()
+
+    g.data["grants"][2]["amountAwarded"] = "lots"
+    del g.data["grants"][5]["title"]
+    g.data["grants"][7]["currency"] = "POUNDS"
+    expected = [(list(e.path), e.message) for e in g.get_errors()]
+    errors = [(list(e.path), e.message) for e in g.get_errors_parallel(workers=2, chunk_size=3)]
+    assert sorted(errors) == sorted(expected)
+    assert [e[0][1] for e in errors] == [2, 5, 7]
+
+    g.valid = None
+    assert not g.is_valid(workers=2)
+    assert len(g.errors) == 3
+
+    g.data["grants"][8] = g.data["grants"][0]
+    errors = list(g.get_errors_parallel(workers=2))
+    assert errors[-1].validator == "uniqueItems"
+
+
+def test_schema_cache(get_file, m):
+    clear_compiled_schemas()
+    cache_dir = tempfile.mkdtemp()
+    package_url = ThreeSixtyGiving.schema_url
+    grant_url = ThreeSixtyGiving.grant_schema_url
+    with open(get_file("sample_data/360-giving-package-schema.json"), 'rb') as f_:
+        m.get(package_url, content=f_.read(), headers={"ETag": '"package-v1"'})
+
+    cache = SchemaCache(cache_dir)
+    g = ThreeSixtyGiving.from_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json"), schema_cache=cache)
+    assert g.is_valid()
+    assert os.path.exists(cache.filename(package_url))
+    assert os.path.exists(cache.filename(grant_url))
+
+    # schemas held in memory aren't fetched again
+    calls = m.call_count
+    ThreeSixtyGiving.from_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json"), schema_cache=cache)
+    ThreeSixtyGiving.from_csv(
+        get_file("sample_data/ExampleTrust-grants-fixed.csv"), schema_cache=cache)
+    assert m.call_count == calls
+
+    # a new cache revalidates using the ETag
+    m.get(package_url, status_code=304)
+    cache = SchemaCache(cache_dir)
+    g = ThreeSixtyGiving.from_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json"), schema_cache=cache)
+    assert g.is_valid()
+    assert m.request_history[calls].headers["If-None-Match"] == '"package-v1"'
+
+    # offline mode doesn't make any requests
+    calls = m.call_count
+    cache = SchemaCache(cache_dir, offline=True)
+    g = ThreeSixtyGiving.from_excel(
+        get_file("sample_data/ExampleTrust-grants-fixed.xlsx"), schema_cache=cache)
+    assert g.is_valid()
+    assert m.call_count == calls
+    with pytest.raises(ValueError):
+        SchemaCache(tempfile.mkdtemp(), offline=True).get(package_url)
+
+
+def test_compiled_schema_cache(get_file, m):
+    clear_compiled_schemas()
+    g = ThreeSixtyGiving.from_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json"))
+    calls = m.call_count
+    h = ThreeSixtyGiving.from_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json"))
+    assert h.validator is g.validator
+    assert h.replace_names is g.replace_names
+    # only the package schema is fetched, references aren't resolved again
+    assert m.call_count == calls + 1
+
+    # calling fetch_schema again reuses the same schema
+    h.fetch_schema()
+    assert h.validator is g.validator
+
+    clear_compiled_schemas()
+    h = ThreeSixtyGiving.from_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json"))
+    assert h.validator is not g.validator
+    assert h.is_valid()
+
+
+def test_native_unflatten(get_file, m):
+    for f, method in [
+        ("sample_data/ExampleTrust-grants-fixed.csv", ThreeSixtyGiving.from_csv),
+        ("sample_data/ExampleTrust-grants-fixed.xlsx", ThreeSixtyGiving.from_excel),
+    ]:
+        g = method(get_file(f))
+        h = method(get_file(f), engine='native')
+        assert h.is_valid()
+        assert h.data["grants"] == g.data["grants"]
+
+    with pytest.raises(ParseError):
+        ThreeSixtyGiving.from_csv(
+            get_file("sample_data/ExampleTrust-grants-broken.csv"), engine='native')
+    with pytest.raises(ParseError):
+        ThreeSixtyGiving.from_excel(
+            get_file("sample_data/ExampleTrust-grants-broken.xlsx"), engine='native')
+
+    # stream the rows
+    grants = list(ThreeSixtyGiving.iter_csv(
+        get_file("sample_data/ExampleTrust-grants-fixed.csv")))
+    assert len(grants) == 10
+    assert isinstance(grants[0], Grant)
+    with open(get_file("sample_data/ExampleTrust-grants-fixed.xlsx"), 'rb') as f_:
+        assert len(list(ThreeSixtyGiving.iter_excel(f_))) == 10
+
+    # fieldnames as well as titles can be used
+    g = ThreeSixtyGiving()
+    g.fetch_schema()
+    grants = list(g.unflatten([
+        ["id", "amountAwarded", "recipientOrganization.0.name", "Recipient Org:1:Name"],
+        ["360G-1", "1000.50", "Blue Trust", "Red Trust"],
+        ["", "", "", ""],
+    ]))
+    assert grants == [{
+        "id": "360G-1",
+        "amountAwarded": 1000.5,
+        "recipientOrganization": [{"name": "Blue Trust"}, {"name": "Red Trust"}],
+    }]
+
+
+def test_url_streaming(get_file, m, monkeypatch):
+    with open(get_file("sample_data/ExampleTrust-grants-fixed.json"), 'rb') as f_:
+        contents = f_.read()
+    m.register_uri('GET', 'http://example.com/grants.json', content=contents)
+    m.register_uri('GET', 'http://example.com/grants-gzip.json',
+                   content=gzip.compress(contents), headers={"Content-Encoding": "gzip"})
+
+    g = ThreeSixtyGiving.from_url('http://example.com/grants-gzip.json')
+    assert g.is_valid()
+    assert len(list(g)) == 10
+
+    grants = ThreeSixtyGiving.iter_url('http://example.com/grants-gzip.json')
+    assert [x.id for x in grants] == [x.id for x in g]
+    assert len(list(ThreeSixtyGiving.iter_url('http://example.com/grants.json'))) == 10
+
+    # maximum size
+    with pytest.raises(ValueError):
+        ThreeSixtyGiving.from_url('http://example.com/grants.json', max_size=100)
+    with pytest.raises(ValueError):
+        ThreeSixtyGiving.from_url('http://example.com/grants-gzip.json', max_size=100)
+    with pytest.raises(ValueError):
+        list(ThreeSixtyGiving.iter_url('http://example.com/grants.json', max_size=100))
+    g = ThreeSixtyGiving.from_url('http://example.com/grants.json', max_size=len(contents))
+    assert g.is_valid()
+
+    # the response is closed if the file can't be streamed
+    closed = []
+    monkeypatch.setattr(requests.Response, "close", lambda r: closed.append(r.url))
+    for url in ('http://example.com/grants.unknown', 'http://example.com/grants.csv'):
+        m.register_uri('GET', url, content=contents)
+        with pytest.raises(ValueError):
+            ThreeSixtyGiving.iter_url(url)
+    assert closed == ['http://example.com/grants.unknown', 'http://example.com/grants.csv']
+
+
+def test_from_urls(get_file, m):
+    test_files = [
+        "sample_data/ExampleTrust-grants-fixed.xlsx",
+        "sample_data/ExampleTrust-grants-broken.xlsx",
+        "sample_data/ExampleTrust-grants-fixed.csv",
+        "sample_data/ExampleTrust-grants-fixed.json",
+    ]
+    urls = []
+    for f in test_files:
+        with open(get_file(f), 'rb') as f_:
+            url = 'http://example.com/{}'.format(f)
+            m.register_uri('GET', url, content=f_.read())
+            urls.append(url)
+    m.register_uri('GET', 'http://example.com/missing.json', status_code=404)
+    urls.append('http://example.com/missing.json')
+
+    results = dict(ThreeSixtyGiving.from_urls(urls, concurrency=3, processes=2))
+    assert set(results.keys()) == set(urls)
+    # the files are validated by the worker processes, so the schema isn't fetched here
+    assert ThreeSixtyGiving.schema_url not in [r.url for r in m.request_history]
+    for url, result in results.items():
+        if "broken" in url:
+            assert isinstance(result, ParseError)
+            assert result.errors
+        elif "missing" in url:
+            assert isinstance(result, requests.HTTPError)
+        else:
+            assert result.is_valid()
+            assert len(list(result)) == 10
+            # can be checked again after it has changed
+            result.update_grant(0, {"amountAwarded": "lots"})
+            assert not result.is_valid()
+
+    # files that haven't started aren't fetched if the results aren't all used
+    url = urls[-2]
+    results = ThreeSixtyGiving.from_urls(
+        ["{}?{}".format(url, i) for i in range(20)], concurrency=1, processes=1)
+    next(results)
+    results.close()
+    assert len([r for r in m.request_history if r.url.startswith(url + "?")]) < 20
+
+
+def test_dataset_cache(get_file, m):
+    cache = DatasetCache(tempfile.mkdtemp())
+    url = 'http://example.com/cached/grants.csv'
+    with open(get_file("sample_data/ExampleTrust-grants-fixed.csv"), 'rb') as f_:
+        contents = f_.read()
+    m.register_uri('GET', url, content=contents, headers={"ETag": '"v1"'})
+
+    g = ThreeSixtyGiving.from_url(url, cache=cache)
+    assert g.is_valid()
+    schema_url = ThreeSixtyGiving.schema_url
+    assert cache.get(url, schema_url)["valid"]
+    assert cache.get(url) is None
+
+    # not modified, so the schema isn't needed either
+    m.register_uri('GET', url, status_code=304)
+    requests_before = len(m.request_history)
+    h = ThreeSixtyGiving.from_url(url, cache=cache)
+    assert [r.url for r in m.request_history[requests_before:]] == [url]
+    assert m.request_history[-1].headers["If-None-Match"] == '"v1"'
+    assert h.valid
+    assert h.data == g.data
+
+    # the schema is fetched once it is needed
+    assert h.convert_fieldnames(["amountAwarded"]) == {"amountAwarded": "Amount Awarded"}
+    h = ThreeSixtyGiving.from_url(url, cache=cache)
+    h.update_grant(0, {"amountAwarded": "lots"})
+    assert h.is_valid() is False
+    assert [e.path for e in h.errors] == [("grants", 0, "amountAwarded")]
+
+    # same contents, served again with a new ETag
+    m.register_uri('GET', url, content=contents, headers={"ETag": '"v2"'})
+    h = ThreeSixtyGiving.from_url(url, cache=cache, validate=False)
+    assert h.valid
+    assert h.data == g.data
+    assert cache.get(url, schema_url)["etag"] == '"v2"'
+    m.register_uri('GET', url, status_code=304)
+    ThreeSixtyGiving.from_url(url, cache=cache)
+    assert m.request_history[-1].headers["If-None-Match"] == '"v2"'
+
+    # a file used with another schema is cached separately
+    other_schema_url = schema_url.replace('.json', '-other.json')
+    m.register_uri('GET', other_schema_url, json=g.schema_source)
+    m.register_uri('GET', url, content=contents)
+    h = ThreeSixtyGiving.from_url(url, cache=cache, schema_url=other_schema_url)
+    assert "If-None-Match" not in m.request_history[-1].headers
+    assert cache.get(url, other_schema_url)["valid"]
+
+    # changed file
+    with open(get_file("sample_data/ExampleTrust-grants-broken.csv"), 'rb') as f_:
+        m.register_uri('GET', url, content=f_.read())
+    with pytest.raises(ParseError):
+        ThreeSixtyGiving.from_url(url, cache=cache)
+
+
+def test_flat_output(get_file, m):
+    g = ThreeSixtyGiving.from_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json"))
+    g.data["grants"][3]["beneficiaryLocation"].append({"name": "Bristol"})
+    data, fieldnames = g.to_flatfile()
+    assert g.flat_fieldnames() == fieldnames
+    assert list(g.iter_flat()) == data
+    assert len(fieldnames) == len(set(fieldnames))
+    assert "beneficiaryLocation.1.name" in fieldnames
+    assert data[3]["beneficiaryLocation.1.name"] == "Bristol"
+
+    df = g.to_pandas(convert_fieldnames=False)
+    assert list(df.columns) == fieldnames
+    assert len(df) == 10
+    assert df["beneficiaryLocation.1.name"].isnull().sum() == 9
+    # missing values are NaN, as they are in a DataFrame created from the rows
+    assert not any(v is None for v in df["beneficiaryLocation.1.name"])
+    pandas.testing.assert_frame_equal(df, pandas.DataFrame(data))
+
+
+def test_convert_fieldnames(get_file, m):
+    g = ThreeSixtyGiving.from_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json"))
+    fieldnames = [
+        "id", "amountAwarded", "recipientOrganization.0.id",
+        "recipientOrganization.12.name",
+        "recipientOrganization.0", "recipientOrganization.x.id",
+        "recipientOrganization.0.id.extra", "Not in schema",
+    ]
+    fieldnames += ["beneficiaryLocation.{}.name".format(i) for i in range(2000)]
+
+    # same results as applying the regular expressions in replace_names
+    expected = {}
+    for field in fieldnames:
+        expected[field] = field
+        for old, new in g.replace_names.items():
+            if re.fullmatch(old, field):
+                expected[field] = re.sub(old, new, field)
+    converted = g.convert_fieldnames(fieldnames)
+    assert list(converted.keys()) == fieldnames
+    assert converted == expected
+    assert converted["recipientOrganization.12.name"] == "Recipient Org:12:Name"
+    assert converted["recipientOrganization.x.id"] == "recipientOrganization.x.id"
+    assert converted["Not in schema"] == "Not in schema"
+
+    # no schema means no conversion
+    h = ThreeSixtyGiving()
+    assert h.convert_fieldnames(["id", "amountAwarded"]) == {
+        "id": "id", "amountAwarded": "amountAwarded"}
+
+
+def test_fieldname_converter_cache_size(get_file, m, monkeypatch):
+    g = ThreeSixtyGiving.from_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json"))
+    monkeypatch.setattr(threesixty_schema, "FIELDNAME_CACHE_SIZE", 100)
+    converter = threesixty_schema.FieldnameConverter(
+        g.schema["properties"]["grants"]["items"]["properties"])
+    fieldnames = ["beneficiaryLocation.{}.name".format(i) for i in range(1000)]
+    converted = converter.convert_many(fieldnames)
+    assert converted["beneficiaryLocation.999.name"] == "Beneficiary Location:999:Name"
+    # only the most recent fieldnames are remembered
+    assert converter._converted.cache_info().currsize == 100
+
+
+def test_grant_views(get_file, m):
+    g = ThreeSixtyGiving.from_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json"))
+    grants = list(g)
+    assert grants[0].to_dict() is g.data["grants"][0]
+    assert grants[0]["id"] == grants[0].id
+    assert "amountAwarded" in grants[0]
+    assert grants[0].get("notAField") is None
+
+    # changes are made to the underlying data
+    grants[0].title = "New title"
+    grants[0]["amountAwarded"] = 100
+    assert g.data["grants"][0]["title"] == "New title"
+    assert g.data["grants"][0]["amountAwarded"] == 100
+
+    # grants created from keyword arguments still work
+    grant = Grant(id="360G-1", title="Grant")
+    assert grant["title"] == "Grant"
+    assert grant.to_flat() == {"id": "360G-1", "title": "Grant"}
+
+
+def test_parquet(get_file, m):
+    pyarrow = pytest.importorskip("pyarrow")
+    g = ThreeSixtyGiving.from_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json"))
+    g.data["grants"][0]["plannedDates"] = [{"startDate": "2018-01-01"}]
+    g.data["grants"][0]["extraField"] = {"count": 3}
+    table = g.to_arrow()
+    assert table.num_rows == 10
+    assert table.schema.field("amountAwarded").type == pyarrow.float64()
+    assert pyarrow.types.is_timestamp(table.schema.field("awardDate").type)
+    assert pyarrow.types.is_list(table.schema.field("recipientOrganization").type)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "grants.parquet")
+        g.to_parquet(path)
+        m.reset_mock()
+        h = ThreeSixtyGiving.from_parquet(path)
+
+    # loading the file doesn't validate the data again
+    assert not m.called
+    assert h.valid is True
+    assert h.data == g.data
+    assert list(h.data.keys()) == list(g.data.keys())
+
+    # the schema is fetched once it is needed
+    assert h.convert_fieldnames(["amountAwarded"]) == {"amountAwarded": "Amount Awarded"}
+    h.update_grant(1, {"amountAwarded": "lots"})
+    assert h.is_valid() is False
+    assert [e.path for e in h.errors] == [("grants", 1, "amountAwarded")]
+
+
+def test_arrow_round_trip(get_file, m):
+    pyarrow = pytest.importorskip("pyarrow")
+    g = ThreeSixtyGiving.from_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json"))
+    grants = g.data["grants"]
+    grants[0]["awardDate"] = "2018-01-01T10:00:00Z"
+    grants[1]["awardDate"] = "2018-01-01T10:00:00+01:00"
+    grants[2]["awardDate"] = "2018-01-01"
+    grants[0]["amountAwarded"] = 100.0
+    grants[1]["amountAwarded"] = 250.5
+    grants[0]["plannedDates"] = [{"startDate": "2018-01-01", "endDate": None}]
+    grants[1]["plannedDates"] = [{"startDate": "2018-02-01T00:00:00+00:00"}]
+    grants[0]["extraField"] = {"count": 3, "ratio": 0.5, "note": None}
+    grants[1]["extraField"] = {"count": 3.0}
+    grants[2]["description"] = None
+
+    table = g.to_arrow()
+    assert table.schema.field("awardDate").type == pyarrow.string()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "grants.parquet")
+        g.to_parquet(path)
+        h = ThreeSixtyGiving.from_parquet(path)
+
+    assert h.data == g.data
+    assert h.data["grants"][0]["amountAwarded"] == 100.0
+    assert isinstance(h.data["grants"][0]["amountAwarded"], float)
+    assert isinstance(h.data["grants"][3]["amountAwarded"], int)
+    assert isinstance(h.data["grants"][1]["extraField"]["count"], float)
+    assert "description" in h.data["grants"][2]
+    assert "endDate" in h.data["grants"][0]["plannedDates"][0]
+
+
+def test_pandas_typed(get_file, m):
+    g = ThreeSixtyGiving.from_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json"))
+    g.data["grants"][3]["beneficiaryLocation"].append({"name": "Bristol"})
+    df = g.to_pandas(convert_fieldnames=False, typed=True)
+    assert list(df.columns) == g.flat_fieldnames()
+    assert df["amountAwarded"].dtype == "float64"
+    assert str(df["awardDate"].dtype) == "datetime64[ns, UTC]"
+    assert df["currency"].dtype == "category"
+    assert df["id"].dtype == "object"
+    assert df["beneficiaryLocation.1.name"].isnull().sum() == 9
+    assert df["amountAwarded"].sum() == sum(
+        grant["amountAwarded"] for grant in g.data["grants"])
+
+    df = g.to_pandas(typed=True)
+    assert df["Amount Awarded"].dtype == "float64"
+
+
+def test_stream_to_csv(get_file, m):
+    pytest.importorskip("ijson")
+    path = get_file("sample_data/ExampleTrust-grants-fixed.json")
+    g = ThreeSixtyGiving.from_json(path)
+    expected = io.StringIO()
+    g.to_csv(expected)
+
+    output = io.StringIO()
+    ThreeSixtyGiving.stream_to_csv(path, output)
+    assert output.getvalue() == expected.getvalue()
+
+    # a seekable file object is read twice
+    with open(path, "rb") as f:
+        output = io.StringIO()
+        ThreeSixtyGiving.stream_to_csv(f, output, convert_fieldnames=False)
+    assert output.getvalue().splitlines()[0].startswith("id,title,")
+
+    # fieldnames are needed if the file can't be read twice
+    class Unseekable(io.BytesIO):
+        def seekable(self):
+            return False
+
+    with open(path, "rb") as f:
+        content = f.read()
+    with pytest.raises(ValueError):
+        ThreeSixtyGiving.stream_to_csv(Unseekable(content), io.StringIO())
+    output = io.StringIO()
+    ThreeSixtyGiving.stream_to_csv(
+        Unseekable(content), output, fieldnames=["id", "amountAwarded"])
+    rows = output.getvalue().splitlines()
+    assert rows[0] == "Identifier,Amount Awarded"
+    assert len(rows) == 11
+
+
+def test_excel_multiple_sheets(get_file, m):
+    openpyxl = pytest.importorskip("openpyxl")
+    g = ThreeSixtyGiving.from_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json"))
+    g.data["grants"][3]["beneficiaryLocation"].append({"name": "Bristol"})
+    g.data["grants"][3]["recipientOrganization"].append({"id": "GB-CHC-2", "name": "Another"})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "grants.xlsx")
+        g.to_excel(path, multiple_sheets=True, convert_fieldnames=False)
+        wb = openpyxl.load_workbook(path)
+        # the sheets come from the schema, not the data
+        assert wb.sheetnames == [
+            "grants", "plannedDates", "recipientOrganization", "fundingOrganization", "beneficiaryLocation"]
+
+        rows = list(wb["grants"].iter_rows(values_only=True))
+        assert len(rows) == 11
+        assert rows[0][0] == "id"
+        assert not any(h.startswith("beneficiaryLocation") for h in rows[0])
+
+        rows = list(wb["beneficiaryLocation"].iter_rows(values_only=True))
+        assert rows[0][:2] == ("grant_id", "name")
+        assert len(rows) == 12
+        assert rows[5][:2] == (g.data["grants"][3]["id"], "Bristol")
+
+        rows = list(wb["recipientOrganization"].iter_rows(values_only=True))
+        assert rows[0] == ("grant_id", "id", "name")
+        assert rows[5] == (g.data["grants"][3]["id"], "GB-CHC-2", "Another")
+
+        g.to_excel(path, multiple_sheets=True)
+        wb = openpyxl.load_workbook(path)
+        rows = list(wb["beneficiaryLocation"].iter_rows(values_only=True))
+        assert rows[0][:2] == ("Grant Identifier", "Name")
+        rows = list(wb["recipientOrganization"].iter_rows(values_only=True))
+        assert rows[0] == ("Grant Identifier", "Identifier", "Name")
+
+
+def test_revalidate_changed_grants(get_file, m):
+    g = ThreeSixtyGiving.from_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json"))
+    assert g.is_valid()
+
+    # only the changed grants are checked again
+    def fail(*args, **kwargs):
+        raise AssertionError("the whole dataset was checked")
+    g.get_errors = fail
+
+    g.update_grant(2, {"amountAwarded": "lots"})
+    g.data["grants"][7]["currency"] = 5
+    g.mark_changed(7)
+    assert not g.is_valid()
+    assert sorted(g.grant_errors) == [2, 7]
+    assert [list(e.path) for e in g.errors] == [
+        ["grants", 2, "amountAwarded"], ["grants", 7, "currency"]]
+
+    g.update_grant(2, {"amountAwarded": 100})
+    assert not g.is_valid()
+    assert list(g.grant_errors) == [7]
+
+    # grants must still be unique
+    g.set_grant(7, dict(g.data["grants"][0]))
+    assert not g.is_valid()
+    assert [e.validator for e in g.errors] == ["uniqueItems"]
+    g.update_grant(7, {"id": "360G-new"})
+    assert g.is_valid()
+    assert g.errors == []
+
+    # grants which were identical when the whole dataset was checked
+    del g.get_errors
+    g.data["grants"][7] = dict(g.data["grants"][0])
+    g.data["grants"][8]["id"] = g.data["grants"][0]["id"]
+    g.mark_changed()
+    assert not g.is_valid()
+    g.get_errors = fail
+    g.update_grant(3, {"title": "Changed"})
+    assert not g.is_valid()
+    assert [e.validator for e in g.errors] == ["uniqueItems"]
+    g.update_grant(7, {"title": "Changed"})
+    assert g.is_valid()
+
+    # adding or removing grants means everything is checked again
+    del g.get_errors
+    grants = g.data["grants"]
+    grants.append(dict(grants[0], id="360G-added", amountAwarded="lots"))
+    g.update_grant(2, {"title": "Changed again"})
+    assert not g.is_valid()
+    assert [e.path for e in g.errors] == [("grants", 10, "amountAwarded")]
+    del grants[0]
+    assert not g.is_valid()
+    assert [e.path for e in g.errors] == [("grants", 9, "amountAwarded")]
+    del grants[-1]
+    g.mark_changed(0)
+    assert g.is_valid()
+
+    # changing the data means everything is checked again
+    g.data = {"grants": []}
+    assert g.valid is None
+    assert not g.is_valid()
+
+
+def test_max_errors(get_file, m):
+    g = ThreeSixtyGiving.from_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json"))
+    for i in (2, 5, 7):
+        g.data["grants"][i]["amountAwarded"] = "lots"
+    g.mark_changed()
+
+    assert not g.is_valid()
+    assert len(g.errors) == 3
+    assert not g.errors_truncated
+    e = g.errors[0]
+    assert isinstance(e, ErrorRecord)
+    assert e == (("grants", 2, "amountAwarded"), e.message, "type", 2)
+
+    g.mark_changed()
+    assert not g.is_valid(max_errors=2)
+    assert [e.grant_index for e in g.errors] == [2, 5]
+    assert g.errors_truncated
+
+    g.mark_changed()
+    assert not g.is_valid(workers=2, fail_fast=True)
+    assert [e.grant_index for e in g.errors] == [2]
+
+    # asking for more errors checks everything again
+    assert not g.is_valid(max_errors=1)
+    assert [e.grant_index for e in g.errors] == [2]
+    assert not g.is_valid(max_errors=2)
+    assert [e.grant_index for e in g.errors] == [2, 5]
+    assert g.errors_truncated
+
+    # the other grants haven't been checked, so fixing one checks everything again
+    g.update_grant(2, {"amountAwarded": 100})
+    assert not g.is_valid()
+    assert [e.grant_index for e in g.errors] == [5, 7]
+    assert not g.errors_truncated
+
+    # checking changed grants again stops at `max_errors` too
+    g.update_grant(0, {"amountAwarded": "lots"})
+    assert not g.is_valid(max_errors=2)
+    assert [e.grant_index for e in g.errors] == [0, 5]
+    assert g.errors_truncated
+    assert not g.is_valid()
+    assert [e.grant_index for e in g.errors] == [0, 5, 7]
+    assert not g.errors_truncated
+
+    with pytest.raises(ParseError) as exc:
+        ThreeSixtyGiving.from_csv(
+            get_file("sample_data/ExampleTrust-grants-broken.csv"), fail_fast=True)
+    assert len(exc.value.errors) == 1
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_lazy_json(get_file, use_numpy, monkeypatch):
+    monkeypatch.setattr(LazyGrants, "use_numpy", use_numpy)
+    monkeypatch.setattr(LazyGrants, "first_chunk_size", 7)
+    monkeypatch.setattr(LazyGrants, "chunk_size", 100)
+
+    path = get_file("sample_data/ExampleTrust-grants-fixed.json")
+    with open(path, encoding="utf8") as f:
+        expected = json.load(f)
+    with ThreeSixtyGiving.lazy_json(path) as grants:
+        assert grants[1].to_dict() == expected["grants"][1]
+        # only the start of the file has been scanned
+        assert len(grants._ends) < len(expected["grants"])
+        assert [g.id for g in grants[2:4]] == [g["id"] for g in expected["grants"][2:4]]
+        assert len(grants) == len(expected["grants"])
+        assert grants[-1].to_dict() == expected["grants"][-1]
+        assert [g.to_dict() for g in grants] == expected["grants"]
+        with pytest.raises(IndexError):
+            grants[len(expected["grants"])]
+
+    # brackets, quotes and backslashes in strings, and fields after the grants
+    data = {
+        "publisher": {"name": "A [Publisher] {Ltd}"},
+        "grants": [
+            {"id": "360G-1", "title": "Quote \" and bracket }", "description": "\\"},
+            {"id": "360G-2", "title": "]]]", "description": "\\\"{[", "amountAwarded": 10},
+            {"id": "360G-3", "nested": [[[[[[[[[[{"a": "}"}]]]]]]]]]]},
+        ],
+        "license": "CC-BY",
+    }
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, "grants.json")
+    with open(path, "w", encoding="utf8") as f:
+        json.dump(data, f, indent=2)
+    grants = ThreeSixtyGiving.lazy_json(path, save_index=True)
+    assert [g.to_dict() for g in grants] == data["grants"]
+    assert dict(grants.metadata) == {"publisher": data["publisher"], "license": "CC-BY"}
+    grants.close()
+
+    # the saved index is used the next time
+    assert os.path.exists(path + ".idx")
+    with ThreeSixtyGiving.lazy_json(path) as grants:
+        assert grants._complete
+        assert grants[1]["description"] == data["grants"][1]["description"]
+
+    # but not if the file has changed
+    data["grants"].pop()
+    with open(path, "w", encoding="utf8") as f:
+        json.dump(data, f)
+    with ThreeSixtyGiving.lazy_json(path) as grants:
+        assert not grants._complete
+        assert len(grants) == 2
+
+    # both scans reject values that aren't objects in the same way
+    for grants_json in ('[1, {"a": 2}, "x"]', '[{"a": 2}, [1]]', '[{"a": 2},' + ' ' * 100 + 'null]'):
+        with open(path, "w", encoding="utf8") as f:
+            f.write('{"grants": ' + grants_json + '}')
+        with ThreeSixtyGiving.lazy_json(path) as grants:
+            with pytest.raises(ValueError):
+                len(grants)
+
+
+def test_fast_validation(get_file, m, monkeypatch):
+    g = ThreeSixtyGiving.from_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json"), validate=False)
+    g.fetch_schema()
+    assert g.fast_grant_validator is not None
+    assert all(g.fast_grant_validator(grant) for grant in g.data["grants"])
+
+    g.data["grants"][2]["amountAwarded"] = "lots"
+    del g.data["grants"][5]["title"]
+    g.data["grants"][7]["recipientOrganization"][0]["id"] = 5
+    g.data["grants"][8] = g.data["grants"][0]
+    # the date-time check is ignored, as it is when using jsonschema
+    g.data["grants"][9]["awardDate"] = "not a date"
+    assert [g.fast_grant_validator(grant) for grant in g.data["grants"]] == [
+        True, True, False, True, True, False, True, False, True, True]
+
+    # the same errors are found with and without the compiled validator
+    errors = sorted((list(e.path), e.validator) for e in g.get_errors())
+    monkeypatch.setattr(ThreeSixtyGiving, "fast_validation", False)
+    assert sorted((list(e.path), e.validator) for e in g.get_errors()) == errors
+    assert [e[0] for e in errors] == [
+        ["grants"], ["grants", 2, "amountAwarded"], ["grants", 5],
+        ["grants", 7, "recipientOrganization", 0, "id"]]
+
+    check = compile_validator({
+        "type": "object",
+        "properties": {
+            "a": {"type": ["integer", "null"], "minimum": 0, "exclusiveMinimum": True},
+            "b": {"enum": [1, "x"]},
+            "c": {"type": "array", "items": {"type": "string", "pattern": "^G"}, "uniqueItems": True},
+        },
+        "additionalProperties": False,
+    })
+    assert check({"a": 1, "b": "x", "c": ["GB", "GBP"]})
+    assert check({"a": None, "b": 1})
+    assert not check({"a": 0})
+    assert not check({"a": 1.5})
+    assert not check({"b": True})
+    assert not check({"c": ["GB", "GB"]})
+    assert not check({"c": ["UK"]})
+    assert not check({"d": 1})
+    with pytest.raises(UnsupportedSchema):
+        compile_validator({"$ref": "#/definitions/grant"})
+
+
+def test_grant_indexes(get_file, m):
+    g = ThreeSixtyGiving.from_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json"))
+    grants = g.data["grants"]
+
+    grant = g.get(grants[4]["id"])
+    assert grant.to_dict() is grants[4]
+    assert g.get("not-a-grant") is None
+
+    recipient = grants[0]["recipientOrganization"][0]["id"]
+    assert [x.id for x in g.by_recipient(recipient)] == [
+        x["id"] for x in grants if x["recipientOrganization"][0]["id"] == recipient]
+    funder = grants[0]["fundingOrganization"][0]["id"]
+    assert len(g.by_funder(funder)) == len(
+        [x for x in grants if x["fundingOrganization"][0]["id"] == funder])
+    assert g.by_funder("not-a-funder") == []
+
+    amounts = sorted(x["amountAwarded"] for x in grants)
+    found = g.amount_between(amounts[2], amounts[5])
+    assert [x.amountAwarded for x in found] == amounts[2:6]
+    assert len(g.amount_between()) == len(grants)
+
+    assert len(g.awarded_between()) == len(grants)
+    assert g.awarded_between(end="1900-01-01") == []
+    assert len(g.awarded_between(start=datetime.date(1900, 1, 1))) == len(grants)
+
+    # the indexes are created again when grants change
+    g.update_grant(4, {"id": "360G-changed", "amountAwarded": 10 ** 9})
+    assert g.get("360G-changed").to_dict() is grants[4]
+    assert g.amount_between(10 ** 9)[0].id == "360G-changed"
+
+    # identifiers that are objects or arrays aren't included
+    g.update_grant(5, {"id": {"a": 1}, "recipientOrganization": [{"id": ["GB-1"]}]})
+    g.update_grant(6, {"id": ["360G-list"], "fundingOrganization": [{"id": {"a": 1}}]})
+    assert g.get("360G-changed").to_dict() is grants[4]
+    assert grants[5] not in [x.to_dict() for x in g.by_recipient(recipient)]
+    assert g.by_funder(funder)
+
+
+@pytest.mark.parametrize("backend", ["json", "orjson"])
+def test_json_backends(get_file, m, backend, monkeypatch):
+    if backend == "orjson":
+        pytest.importorskip("orjson")
+    monkeypatch.setattr(ThreeSixtyGiving, "json_backend", backend)
+    g = ThreeSixtyGiving.from_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json"))
+    g.data["grants"][0]["title"] = "Grant to Café £"
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "grants.json")
+        g.to_json(path, compact=True)
+        with open(path, "rb") as f:
+            content = f.read()
+        assert b"\n" not in content
+        assert ThreeSixtyGiving.from_json(path).data == g.data
+
+        # files with a byte order mark or in other encodings can still be read
+        with open(path, "wb") as f:
+            f.write(b"\xef\xbb\xbf" + content)
+        assert ThreeSixtyGiving.from_json(path).data == g.data
+        with open(path, "w", encoding="cp1252") as f:
+            g.to_json(f)
+        assert ThreeSixtyGiving.from_json(path).data == g.data
+
+    output = io.BytesIO()
+    g.to_json(output, compact=True)
+    assert output.getvalue() == content
+    output = io.StringIO()
+    g.to_json(output, compact=True)
+    assert output.getvalue() == content.decode("utf8")
+    assert ThreeSixtyGiving.from_json(io.BytesIO(content)).data == g.data
+
+
+def test_stats(get_file, m, monkeypatch):
+    path = get_file("sample_data/ExampleTrust-grants-fixed.json")
+    stages = []
+    stats = Stats(callback=lambda s, stage, seconds: stages.append(stage))
+    g = ThreeSixtyGiving.from_json(path, stats=stats)
+    assert g.stats is stats
+    assert list(stats.timings) == ["parse_json", "fetch_schema", "validate"]
+    assert stages == ["parse_json", "fetch_schema", "validate"]
+    assert stats.counters["bytes_read"] == os.path.getsize(path)
+    assert stats.counters["grants_loaded"] == 10
+    assert stats.counters["grants_validated"] == 10
+
+    g.to_csv(io.StringIO())
+    assert stats.calls["export_csv"] == 1
+    assert stats.counters["grants_exported"] == 10
+    assert stats.as_dict()["timings"]["export_csv"] >= 0
+
+    # stats aren't collected by default
+    g = ThreeSixtyGiving.from_json(path)
+    assert not g.stats.enabled
+    assert g.stats.timings == {}
+
+    # or can be turned on for every object
+    with open(path, "rb") as f_:
+        m.register_uri("GET", "http://example.com/grants.json", content=f_.read())
+    monkeypatch.setattr(ThreeSixtyGiving, "collect_stats", True)
+    g = ThreeSixtyGiving.from_url("http://example.com/grants.json")
+    assert g.stats.enabled
+    assert g.stats.counters["bytes_downloaded"] == os.path.getsize(path)
+    assert "download" in g.stats.timings
+    if g.stats.peak_memory is not None:
+        assert g.stats.peak_memory > 0
@@ -1 +1,6 @@
-from .threesixty import ThreeSixtyGiving, Grant, ParseError
+from .threesixty import ThreeSixtyGiving, Grant, GrantStream, ParseError, ErrorRecord
+from .cache import SchemaCache, DatasetCache
+from .stats import Stats
+from .lazy import LazyGrants
+from .index import GrantIndexes
+from .schema import compile_schema, clear_compiled_schemas
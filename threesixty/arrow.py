@@ -0,0 +1,296 @@
+import datetime
+import json
+
+from .unflatten import _types
+
+# key used to store details of the dataset in the metadata of an Arrow table, and
+# how a column was stored (`_INTEGER` or `_JSON`) in the metadata of its field
+ARROW_METADATA_KEY = b'threesixty'
+# key used to store the fields that were explicitly null, which Arrow can't tell
+# apart from missing fields
+ARROW_NULLS_KEY = b'threesixty.nulls'
+
+# numbers that were all integers, stored as floats
+_INTEGER = b'integer'
+# values that can't be stored as an Arrow type without changing them, stored as JSON
+_JSON = b'json'
+
+_UTC = datetime.timezone.utc
+
+
+def _formats(prop):
+    """
+    Get the formats allowed for a string property, including any in a `oneOf`
+    """
+    formats = set()
+    if prop.get('format'):
+        formats.add(prop['format'])
+    for option in prop.get('oneOf', []):
+        if option.get('format'):
+            formats.add(option['format'])
+    return formats
+
+
+def _is_datetime(prop):
+    formats = _formats(prop)
+    return bool(formats) and formats <= {'date', 'date-time'}
+
+
+def _parse_datetime(value):
+    """
+    Turn a date or date-time string into a datetime in UTC
+    """
+    if value.endswith(('Z', 'z')):
+        value = value[:-1] + '+00:00'
+    if len(value) == 10:
+        d = datetime.date.fromisoformat(value)
+        return datetime.datetime(d.year, d.month, d.day, tzinfo=_UTC)
+    d = datetime.datetime.fromisoformat(value)
+    if d.tzinfo is None:
+        return d.replace(tzinfo=_UTC)
+    return d.astimezone(_UTC)
+
+
+def _format_datetime(value):
+    """
+    Turn a datetime from a timestamp column back into a string
+    """
+    return value.astimezone(_UTC).isoformat()
+
+
+def _is_integer(v):
+    return isinstance(v, int) and not isinstance(v, bool)
+
+
+def _arrow_type(prop, values):
+    """
+    Work out the Arrow type for a field, based on its schema and the values in the data
+
+    Values are only converted to another type if they can be turned back into
+    exactly the same values by `table_to_grants`.
+
+    :param dict prop: the schema for the field, or None if it isn't in the schema
+    :param list values: all the values of the field found in the data (not including missing values)
+    :return: tuple of `(arrow type, conversion function, kind)`. The conversion
+        function is used on each value before it is added to the column, and is None if
+        no conversion is needed. The kind is stored in the field's metadata so the
+        values can be turned back, and is None if they don't need to be
+    """
+    import pyarrow
+
+    prop = prop or {}
+    types = _types(prop)
+    present = [v for v in values if v is not None]
+
+    if present and all(isinstance(v, dict) for v in present):
+        return _struct_type(prop.get('properties', {}), present) + (None,)
+
+    if present and all(isinstance(v, list) for v in present):
+        items = [i for v in present for i in v]
+        item_type, item_convert, item_kind = _arrow_type(prop.get('items'), items)
+        item_field = pyarrow.field(
+            'item', item_type,
+            metadata={ARROW_METADATA_KEY: item_kind} if item_kind is not None else None)
+        if item_convert is None:
+            return pyarrow.list_(item_field), None, None
+        return pyarrow.list_(item_field), lambda v: [
+            item_convert(i) if i is not None else None for i in v], None
+
+    if types == ['string'] and _is_datetime(prop):
+        try:
+            if all(isinstance(v, str) and len(v) == 10 and
+                   datetime.date.fromisoformat(v).isoformat() == v for v in present):
+                return pyarrow.date32(), datetime.date.fromisoformat, None
+            # other formats (eg `Z` or another timezone) and a mix of dates and date-times
+            # would come back differently, so are kept as strings
+            if all(_format_datetime(_parse_datetime(v)) == v for v in present):
+                return pyarrow.timestamp('us', tz='UTC'), _parse_datetime, None
+        except (TypeError, ValueError, AttributeError):
+            pass
+        return pyarrow.string(), None, None
+
+    if types == ['number']:
+        if all(_is_integer(v) and abs(v) <= 2 ** 53 for v in present):
+            return pyarrow.float64(), None, _INTEGER
+        if all(isinstance(v, float) for v in present):
+            return pyarrow.float64(), None, None
+    if types == ['integer']:
+        if all(_is_integer(v) for v in present):
+            return pyarrow.int64(), None, None
+    if types == ['boolean']:
+        if all(isinstance(v, bool) for v in present):
+            return pyarrow.bool_(), None, None
+    if types == ['string']:
+        if all(isinstance(v, str) for v in present):
+            return pyarrow.string(), None, None
+
+    # fields that aren't in the schema (or don't match it) use the type Arrow would pick,
+    # unless it would change the values (eg a mix of integers and floats)
+    try:
+        arrow_type = pyarrow.array(present).type
+    except (pyarrow.ArrowException, TypeError, ValueError):
+        arrow_type = None
+    if arrow_type is not None and not (
+            pyarrow.types.is_floating(arrow_type) and any(_is_integer(v) for v in present)):
+        return arrow_type, None, None
+    return pyarrow.string(), json.dumps, _JSON
+
+
+def _struct_fields(props, values):
+    """
+    Work out the Arrow fields for an object, including every field that is used in the data
+
+    :return: tuple of `(list of fields, dict of conversion functions for each field name)`
+    """
+    import pyarrow
+
+    names = []
+    seen = set()
+    for v in values:
+        for k in v:
+            if k not in seen:
+                seen.add(k)
+                names.append(k)
+
+    fields = []
+    converters = {}
+    for k in names:
+        field_type, convert, kind = _arrow_type(
+            props.get(k), [v[k] for v in values if k in v])
+        fields.append(pyarrow.field(
+            k, field_type,
+            metadata={ARROW_METADATA_KEY: kind} if kind is not None else None))
+        if convert is not None:
+            converters[k] = convert
+    return fields, converters
+
+
+def _struct_type(props, values):
+    import pyarrow
+
+    fields, converters = _struct_fields(props, values)
+    if not converters:
+        return pyarrow.struct(fields), None
+
+    def convert(value):
+        return {
+            k: (converters[k](v) if k in converters and v is not None else v)
+            for k, v in value.items()
+        }
+    return pyarrow.struct(fields), convert
+
+
+def _null_paths(value, path):
+    """
+    Find the fields in a value that are explicitly set to null
+
+    :return: Iterator of paths to the null fields, as lists of keys and indexes
+    """
+    if isinstance(value, dict):
+        for k, v in value.items():
+            if v is None:
+                yield path + [k]
+            else:
+                yield from _null_paths(v, path + [k])
+    elif isinstance(value, list):
+        for i, v in enumerate(value):
+            yield from _null_paths(v, path + [i])
+
+
+def grants_to_table(grants, grant_schema=None, metadata=None):
+    """
+    Turn a list of grants into an Arrow table with a column for each top-level field
+
+    Types are taken from the grant schema where possible: amounts are floats, dates
+    are dates (or timestamps in UTC if they include a time), and nested objects and arrays are struct and list columns.
+    Fields that aren't in the schema use the type Arrow would choose for them. Values
+    that would be changed by using these types (eg date-times that don't use UTC)
+    are kept as strings or JSON, and fields that are explicitly null are recorded
+    in the table's metadata, so `table_to_grants` returns exactly the same grants.
+
+    :param list grants: the grants, as dicts
+    :param dict grant_schema: the schema for an individual grant, with references resolved
+    :param dict metadata: details stored with the table, which can be read by `table_to_grants`
+    :rtype: pyarrow.Table
+    """
+    import pyarrow
+
+    props = (grant_schema or {}).get('properties', {})
+    fields, converters = _struct_fields(props, grants)
+    columns = []
+    for field in fields:
+        convert = converters.get(field.name)
+        values = [g.get(field.name) for g in grants]
+        if convert is not None:
+            values = [convert(v) if v is not None else None for v in values]
+        columns.append(pyarrow.array(values, type=field.type))
+
+    schema_metadata = {}
+    if metadata is not None:
+        schema_metadata[ARROW_METADATA_KEY] = json.dumps(metadata).encode('utf8')
+    nulls = [[i, path] for i, grant in enumerate(grants) for path in _null_paths(grant, [])]
+    if nulls:
+        schema_metadata[ARROW_NULLS_KEY] = json.dumps(nulls).encode('utf8')
+
+    schema = pyarrow.schema(fields)
+    if schema_metadata:
+        schema = schema.with_metadata(schema_metadata)
+    return pyarrow.Table.from_arrays(columns, schema=schema)
+
+
+def _from_arrow(value, field):
+    """
+    Turn a value from an Arrow table back into JSON types, dropping missing fields
+    """
+    import pyarrow
+
+    if value is None:
+        return None
+    field_type = field.type
+    kind = (field.metadata or {}).get(ARROW_METADATA_KEY)
+    if kind == _JSON:
+        return json.loads(value)
+    if pyarrow.types.is_struct(field_type):
+        result = {}
+        for f in field_type:
+            v = _from_arrow(value.get(f.name), f)
+            if v is not None:
+                result[f.name] = v
+        return result
+    if pyarrow.types.is_list(field_type) or pyarrow.types.is_large_list(field_type):
+        return [_from_arrow(v, field_type.value_field) for v in value]
+    if pyarrow.types.is_timestamp(field_type):
+        return _format_datetime(value)
+    if pyarrow.types.is_date(field_type):
+        return value.isoformat()
+    if kind == _INTEGER:
+        return int(value)
+    return value
+
+
+def table_to_grants(table):
+    """
+    Turn an Arrow table created by `grants_to_table` back into a list of grants
+
+    :param pyarrow.Table table: the table
+    :return: tuple of `(grants, metadata)`, where metadata is the details stored
+        with the table, or None if there aren't any
+    """
+    schema_metadata = table.schema.metadata or {}
+    metadata = schema_metadata.get(ARROW_METADATA_KEY)
+    if metadata is not None:
+        metadata = json.loads(metadata.decode('utf8'))
+
+    grants = [{} for _ in range(table.num_rows)]
+    for field, column in zip(table.schema, table.columns):
+        for grant, value in zip(grants, column.to_pylist()):
+            value = _from_arrow(value, field)
+            if value is not None:
+                grant[field.name] = value
+
+    for i, path in json.loads(schema_metadata.get(ARROW_NULLS_KEY, b'[]').decode('utf8')):
+        parent = grants[i]
+        for k in path[:-1]:
+            parent = parent[k]
+        parent[path[-1]] = None
+    return grants, metadata
@@ -0,0 +1,288 @@
+import json
+import hashlib
+import os
+import tempfile
+
+import requests
+from jsonref import JsonRef
+
+
+def _resolve_refs(obj):
+    """
+    Turn a schema containing `JsonRef` proxies into plain dicts and lists,
+    so that it can be pickled or saved as a JSON file
+    """
+    if isinstance(obj, dict):
+        return {k: _resolve_refs(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_resolve_refs(v) for v in obj]
+    return obj
+
+
+def _write_atomic(filename, content):
+    """
+    Write bytes to a file so that other processes never see a half-written file
+    """
+    t_, t = tempfile.mkstemp(dir=os.path.dirname(filename))
+    with os.fdopen(t_, 'wb') as f:
+        f.write(content)
+    os.replace(t, filename)
+
+
+class SchemaCache:
+    """
+    Keeps copies of JSON schemas on disk so they don't need to be fetched
+    from the internet every time they are used
+
+    Each schema is stored in `cache_dir` using a name based on its URL, along with
+    the `ETag` and `Last-Modified` headers it was served with. The first time a
+    schema is requested by this object the copy on disk is revalidated using a
+    conditional request, and it is only downloaded again if it has changed. After
+    that the copy held in memory is used until `invalidate()` is called.
+
+    If `offline` is True then no requests are made, and only schemas already in
+    the cache can be used. If a request fails but there is a copy in the cache
+    then the cached copy is used instead.
+    """
+
+    user_agent = '360Giving data'
+
+    def __init__(self, cache_dir=None, offline=False, session=None):
+        """
+        :param str cache_dir: directory to store the schemas in. Defaults to `$THREESIXTY_CACHE_DIR` or `~/.cache/threesixty`
+        :param bool offline: only use schemas that are already in the cache
+        :param session: `requests.Session` used to make requests
+        """
+        if cache_dir is None:
+            cache_dir = os.environ.get(
+                'THREESIXTY_CACHE_DIR',
+                os.path.join(os.path.expanduser('~'), '.cache', 'threesixty')
+            )
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.session = session if session is not None else requests.Session()
+        self._documents = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def filename(self, url, suffix='.json'):
+        """
+        Path of the file used to store the schema for an URL
+        """
+        key = hashlib.sha1(url.encode('utf8')).hexdigest()
+        return os.path.join(self.cache_dir, key + suffix)
+
+    def _read_meta(self, url):
+        try:
+            with open(self.filename(url, '.meta.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _fetch(self, url):
+        """
+        Make sure the copy of the schema on disk is up to date
+        """
+        cached = os.path.exists(self.filename(url))
+        if self.offline:
+            if not cached:
+                raise ValueError("Schema [{}] is not in the cache".format(url))
+            return
+
+        meta = self._read_meta(url) if cached else {}
+        headers = {'User-Agent': self.user_agent}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        try:
+            r = self.session.get(url, headers=headers)
+            if r.status_code == 304 and cached:
+                return
+            r.raise_for_status()
+        except requests.RequestException:
+            if cached:
+                return
+            raise
+
+        _write_atomic(self.filename(url), r.content)
+        _write_atomic(self.filename(url, '.meta.json'), json.dumps({
+            'url': url,
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+        }).encode('utf8'))
+        # copies with the references resolved might include this schema, so are now out of date
+        for f in os.listdir(self.cache_dir):
+            if f.endswith('.resolved.json'):
+                os.remove(os.path.join(self.cache_dir, f))
+
+    def get(self, url):
+        """
+        Get a schema, fetching it if it isn't in the cache or has changed
+
+        Can be used as the `loader` for `JsonRef.replace_refs`
+
+        :param str url: URL of the schema
+        :return: The schema
+        :rtype: dict
+        """
+        if url not in self._documents:
+            self._fetch(url)
+            with open(self.filename(url), 'rb') as f:
+                self._documents[url] = json.loads(f.read().decode('utf8'))
+        return self._documents[url]
+
+    def path(self, url):
+        """
+        Get the path to a local copy of a schema with all references resolved
+
+        This can be given to tools like `flattentool` which expect a schema
+        file, without them needing to fetch the schema or its references.
+
+        :param str url: URL of the schema
+        :return: Path to the JSON file containing the schema
+        :rtype: str
+        """
+        schema = self.get(url)
+        resolved = self.filename(url, '.resolved.json')
+        if not os.path.exists(resolved):
+            schema = _resolve_refs(JsonRef.replace_refs(schema, base_uri=url, loader=self.get))
+            _write_atomic(resolved, json.dumps(schema).encode('utf8'))
+        return resolved
+
+    def invalidate(self, url=None):
+        """
+        Forget the schemas held in memory, so they are revalidated the next time they are used
+
+        :param str url: Only forget the schema for this URL
+        """
+        if url is None:
+            self._documents = {}
+        else:
+            self._documents.pop(url, None)
+
+
+class DatasetCache:
+    """
+    Keeps copies of 360Giving files fetched from URLs, so that files that
+    haven't changed don't need to be converted and validated again
+
+    For each URL the parsed data is stored in `cache_dir` as compact JSON, along
+    with the `ETag` and `Last-Modified` headers, a SHA-256 hash of the downloaded
+    file and whether it was valid. The raw file itself isn't kept. The same URL
+    used with a different schema is stored separately, as the schema changes both
+    how a flat file is converted and whether the data is valid.
+    """
+
+    def __init__(self, cache_dir=None):
+        """
+        :param str cache_dir: directory to store the files in. Defaults to `datasets` in the `SchemaCache` default directory
+        """
+        if cache_dir is None:
+            cache_dir = os.path.join(
+                os.environ.get(
+                    'THREESIXTY_CACHE_DIR',
+                    os.path.join(os.path.expanduser('~'), '.cache', 'threesixty')
+                ),
+                'datasets'
+            )
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def filename(self, url, suffix='.json', schema_url=None):
+        """
+        Path of the file used to store the data for an URL
+        """
+        key = url if schema_url is None else '{} {}'.format(url, schema_url)
+        key = hashlib.sha1(key.encode('utf8')).hexdigest()
+        return os.path.join(self.cache_dir, key + suffix)
+
+    def get(self, url, schema_url=None):
+        """
+        Get the details of the cached copy of an URL
+
+        :param str url: URL of the file
+        :param str schema_url: URL of the schema used with the file
+        :return: dict with the `etag`, `last_modified`, `sha256` and `valid` values
+            for the cached file, or None if it isn't in the cache
+        :rtype: dict
+        """
+        try:
+            with open(self.filename(url, '.meta.json', schema_url)) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get('url') != url or meta.get('schema_url') != schema_url or \
+                not os.path.exists(self.filename(url, schema_url=schema_url)):
+            return None
+        return meta
+
+    def headers(self, url, schema_url=None):
+        """
+        Headers to make a conditional request for an URL, based on the cached copy
+        """
+        meta = self.get(url, schema_url) or {}
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def load(self, url, schema_url=None):
+        """
+        Load the data stored for an URL
+
+        :param str url: URL of the file
+        :param str schema_url: URL of the schema used with the file
+        :rtype: dict
+        """
+        with open(self.filename(url, schema_url=schema_url), 'rb') as f:
+            return json.loads(f.read().decode('utf8'))
+
+    def store(self, url, data, valid=None, sha256=None, etag=None, last_modified=None, schema_url=None):
+        """
+        Store the data from an URL
+
+        :param str url: URL of the file
+        :param dict data: the parsed data
+        :param bool valid: whether the data was valid (None if it wasn't checked)
+        :param str sha256: hash of the downloaded file
+        :param str etag: `ETag` header the file was served with
+        :param str last_modified: `Last-Modified` header the file was served with
+        :param str schema_url: URL of the schema used to convert and validate the file
+        """
+        _write_atomic(
+            self.filename(url, schema_url=schema_url),
+            json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf8')
+        )
+        _write_atomic(self.filename(url, '.meta.json', schema_url), json.dumps({
+            'url': url,
+            'schema_url': schema_url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'sha256': sha256,
+            'valid': valid,
+        }).encode('utf8'))
+
+    def update(self, url, schema_url=None, **fields):
+        """
+        Change the details stored for an URL, without storing the data again
+
+        :param str url: URL of the file
+        :param str schema_url: URL of the schema used with the file
+        :param fields: the values to change (any of `valid`, `sha256`, `etag` and `last_modified`)
+        """
+        meta = self.get(url, schema_url)
+        if meta is None:
+            raise KeyError(url)
+        meta.update(fields)
+        _write_atomic(self.filename(url, '.meta.json', schema_url), json.dumps(meta).encode('utf8'))
+
+    def remove(self, url, schema_url=None):
+        """
+        Remove the cached copy of an URL
+        """
+        for suffix in ('.json', '.meta.json'):
+            if os.path.exists(self.filename(url, suffix, schema_url)):
+                os.remove(self.filename(url, suffix, schema_url))
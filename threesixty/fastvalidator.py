@@ -0,0 +1,353 @@
+import numbers
+import re
+
+from jsonschema import FormatChecker
+
+
+class UnsupportedSchema(Exception):
+    """
+    Raised when a schema uses something that can't be compiled
+    """
+
+
+def _is_number(x):
+    return isinstance(x, numbers.Number) and not isinstance(x, bool)
+
+
+_TYPES = {
+    'object': lambda x: isinstance(x, dict),
+    'array': lambda x: isinstance(x, list),
+    'string': lambda x: isinstance(x, str),
+    'integer': lambda x: isinstance(x, int) and not isinstance(x, bool),
+    'number': _is_number,
+    'boolean': lambda x: isinstance(x, bool),
+    'null': lambda x: x is None,
+}
+
+# python types that only match a single JSON type, for a quicker check
+_PYTHON_TYPES = {
+    'object': dict,
+    'array': list,
+    'string': str,
+}
+
+# keywords used by draft 4 validators. Any others (eg `title`) are ignored, as they are by
+# jsonschema. `exclusiveMinimum` and `exclusiveMaximum` are checked with `minimum` and `maximum`
+_DRAFT4_KEYWORDS = {
+    'additionalItems', 'additionalProperties', 'allOf', 'anyOf', 'dependencies', 'enum',
+    'format', 'items', 'maxItems', 'maxLength', 'maxProperties', 'maximum', 'minItems',
+    'minLength', 'minProperties', 'minimum', 'multipleOf', 'not', 'oneOf', 'pattern',
+    'patternProperties', 'properties', 'required', 'type', 'uniqueItems', '$ref',
+}
+
+
+def _valid(instance):
+    return True
+
+
+def _freeze(value):
+    """
+    Turn a JSON value into something hashable, keeping `True` and `1` apart as jsonschema does
+    """
+    if isinstance(value, dict):
+        return ('object', frozenset((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return ('array', tuple(_freeze(v) for v in value))
+    if isinstance(value, bool):
+        return ('boolean', value)
+    return value
+
+
+def _unique(items):
+    return len(set(_freeze(i) for i in items)) == len(items)
+
+
+def _is_datetime_one_of(schema):
+    """
+    Whether a `oneOf` is the check for a date or date-time, whose errors are
+    ignored when validating (see `threesixty._ignore_error`)
+    """
+    options = schema['oneOf']
+    return bool(options) and options[0] == {'format': 'date-time'}
+
+
+def compile_validator(schema, format_checker=None):
+    """
+    Compile a JSON schema (draft 4, with references already resolved) into a function
+    which checks whether a value is valid
+
+    The schema is only read once, when it is compiled, so checking a value doesn't
+    need to look anything up in the schema. The function only says whether the value
+    is valid - use a `jsonschema` validator to find out what the errors are.
+
+    As when validating with `ThreeSixtyGiving`, errors from a `oneOf` where the first
+    option is the `date-time` format are ignored.
+
+    :param dict schema: the schema
+    :param format_checker: `jsonschema.FormatChecker` used to check formats. Defaults to a new `FormatChecker`
+    :return: function taking a value and returning True if it is valid
+    :raises: UnsupportedSchema if the schema can't be compiled (eg it has references that haven't been resolved)
+    """
+    if format_checker is None:
+        format_checker = FormatChecker()
+    return _Compiler(format_checker).compile(schema)
+
+
+class _Compiler:
+
+    def __init__(self, format_checker):
+        self.format_checker = format_checker
+        # schemas already compiled (or being compiled), so references to the same
+        # schema (including recursive ones) are only compiled once
+        self._compiled = {}
+
+    def compile(self, schema):
+        key = id(getattr(schema, '__subject__', schema))
+        if key in self._compiled:
+            return self._compiled[key]
+
+        # a recursive schema refers to itself before it has finished compiling,
+        # so it is looked up when it is used
+        compiled = []
+        self._compiled[key] = lambda instance: compiled[0](instance)
+        compiled.append(self._compile(schema))
+        self._compiled[key] = compiled[0]
+        return compiled[0]
+
+    def _compile(self, schema):
+        if not isinstance(schema, dict):
+            raise UnsupportedSchema("Schema must be an object: {!r}".format(schema))
+        if '$ref' in schema:
+            raise UnsupportedSchema("Schema references must be resolved before compiling")
+
+        checks = []
+        # check the type first, as it's quick and many invalid values have the wrong type
+        for keyword in sorted(schema, key=lambda k: k != 'type'):
+            if keyword not in _DRAFT4_KEYWORDS:
+                continue
+            check = getattr(self, '_' + keyword)(schema[keyword], schema)
+            if check is not None:
+                checks.append(check)
+
+        if not checks:
+            return _valid
+        if len(checks) == 1:
+            return checks[0]
+
+        def validate(instance):
+            for check in checks:
+                if not check(instance):
+                    return False
+            return True
+        return validate
+
+    # types
+
+    def _type(self, value, schema):
+        types = [value] if isinstance(value, str) else list(value)
+        if any(t not in _TYPES for t in types):
+            raise UnsupportedSchema("Unknown type in {!r}".format(types))
+        if len(types) == 1 and types[0] in _PYTHON_TYPES:
+            python_type = _PYTHON_TYPES[types[0]]
+            return lambda instance: isinstance(instance, python_type)
+        checks = [_TYPES[t] for t in types]
+        return lambda instance: any(check(instance) for check in checks)
+
+    def _enum(self, value, schema):
+        allowed = set(_freeze(v) for v in value)
+        if all(isinstance(v, str) for v in value):
+            return lambda instance: isinstance(instance, str) and instance in allowed
+        return lambda instance: _freeze(instance) in allowed
+
+    def _format(self, value, schema):
+        if value not in self.format_checker.checkers:
+            return None
+        conforms = self.format_checker.conforms
+        return lambda instance: conforms(instance, value)
+
+    # objects
+
+    def _properties(self, value, schema):
+        props = {}
+        for k, prop in value.items():
+            check = self.compile(prop)
+            if check is not _valid:
+                props[k] = check
+        if not props:
+            return None
+        get = props.get
+
+        def validate(instance):
+            if not isinstance(instance, dict):
+                return True
+            for k, v in instance.items():
+                check = get(k)
+                if check is not None and not check(v):
+                    return False
+            return True
+        return validate
+
+    def _patternProperties(self, value, schema):
+        patterns = [(re.compile(p), self.compile(s)) for p, s in value.items()]
+
+        def validate(instance):
+            if not isinstance(instance, dict):
+                return True
+            for pattern, check in patterns:
+                for k, v in instance.items():
+                    if pattern.search(k) and not check(v):
+                        return False
+            return True
+        return validate
+
+    def _additionalProperties(self, value, schema):
+        known = set(schema.get('properties', {}))
+        patterns = [re.compile(p) for p in schema.get('patternProperties', {})]
+        if value is True or value == {}:
+            return None
+        check = None if value is False else self.compile(value)
+
+        def validate(instance):
+            if not isinstance(instance, dict):
+                return True
+            for k, v in instance.items():
+                if k in known or any(p.search(k) for p in patterns):
+                    continue
+                if check is None or not check(v):
+                    return False
+            return True
+        return validate
+
+    def _required(self, value, schema):
+        required = list(value)
+        if not required:
+            return None
+        return lambda instance: not isinstance(instance, dict) or all(k in instance for k in required)
+
+    def _minProperties(self, value, schema):
+        return lambda instance: not isinstance(instance, dict) or len(instance) >= value
+
+    def _maxProperties(self, value, schema):
+        return lambda instance: not isinstance(instance, dict) or len(instance) <= value
+
+    def _dependencies(self, value, schema):
+        dependencies = []
+        for k, dependency in value.items():
+            if isinstance(dependency, list):
+                dependencies.append((k, list(dependency), None))
+            else:
+                dependencies.append((k, None, self.compile(dependency)))
+
+        def validate(instance):
+            if not isinstance(instance, dict):
+                return True
+            for k, required, check in dependencies:
+                if k not in instance:
+                    continue
+                if required is not None and not all(r in instance for r in required):
+                    return False
+                if check is not None and not check(instance):
+                    return False
+            return True
+        return validate
+
+    # arrays
+
+    def _items(self, value, schema):
+        if isinstance(value, dict):
+            check = self.compile(value)
+            if check is _valid:
+                return None
+
+            def validate(instance):
+                if not isinstance(instance, list):
+                    return True
+                for item in instance:
+                    if not check(item):
+                        return False
+                return True
+            return validate
+
+        checks = [self.compile(s) for s in value]
+        return lambda instance: not isinstance(instance, list) or all(
+            check(item) for check, item in zip(checks, instance))
+
+    def _additionalItems(self, value, schema):
+        items = schema.get('items', {})
+        if isinstance(items, dict) or value is True or value == {}:
+            return None
+        start = len(items)
+        if value is False:
+            return lambda instance: not isinstance(instance, list) or len(instance) <= start
+        check = self.compile(value)
+        return lambda instance: not isinstance(instance, list) or all(
+            check(item) for item in instance[start:])
+
+    def _minItems(self, value, schema):
+        return lambda instance: not isinstance(instance, list) or len(instance) >= value
+
+    def _maxItems(self, value, schema):
+        return lambda instance: not isinstance(instance, list) or len(instance) <= value
+
+    def _uniqueItems(self, value, schema):
+        if not value:
+            return None
+        return lambda instance: not isinstance(instance, list) or _unique(instance)
+
+    # strings
+
+    def _minLength(self, value, schema):
+        return lambda instance: not isinstance(instance, str) or len(instance) >= value
+
+    def _maxLength(self, value, schema):
+        return lambda instance: not isinstance(instance, str) or len(instance) <= value
+
+    def _pattern(self, value, schema):
+        search = re.compile(value).search
+        return lambda instance: not isinstance(instance, str) or search(instance) is not None
+
+    # numbers
+
+    def _minimum(self, value, schema):
+        if schema.get('exclusiveMinimum', False):
+            return lambda instance: not _is_number(instance) or instance > value
+        return lambda instance: not _is_number(instance) or instance >= value
+
+    def _maximum(self, value, schema):
+        if schema.get('exclusiveMaximum', False):
+            return lambda instance: not _is_number(instance) or instance < value
+        return lambda instance: not _is_number(instance) or instance <= value
+
+    def _multipleOf(self, value, schema):
+        def validate(instance):
+            if not _is_number(instance):
+                return True
+            # the same as jsonschema, so floats give the same results
+            if isinstance(value, float):
+                quotient = instance / value
+                try:
+                    return int(quotient) == quotient
+                except OverflowError:
+                    return False
+            return instance % value == 0
+        return validate
+
+    # combining schemas
+
+    def _allOf(self, value, schema):
+        checks = [self.compile(s) for s in value]
+        return lambda instance: all(check(instance) for check in checks)
+
+    def _anyOf(self, value, schema):
+        checks = [self.compile(s) for s in value]
+        return lambda instance: any(check(instance) for check in checks)
+
+    def _oneOf(self, value, schema):
+        if _is_datetime_one_of(schema):
+            return None
+        checks = [self.compile(s) for s in value]
+        return lambda instance: sum(1 for check in checks if check(instance)) == 1
+
+    def _not(self, value, schema):
+        check = self.compile(value)
+        return lambda instance: not check(instance)
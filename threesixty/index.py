@@ -0,0 +1,120 @@
+import bisect
+import datetime
+
+from .arrow import _parse_datetime
+
+
+def _key(value):
+    """
+    A value used as a key in an index, or None if it can't be used as one (eg an object or array)
+    """
+    if isinstance(value, (dict, list)):
+        return None
+    return value
+
+
+def _org_ids(grant, field):
+    """
+    Get the identifiers of the organisations in a field such as `recipientOrganization`
+    """
+    orgs = grant.get(field)
+    if isinstance(orgs, dict):
+        orgs = [orgs]
+    elif not isinstance(orgs, list):
+        return ()
+    ids = []
+    for o in orgs:
+        org_id = _key(o.get('id')) if isinstance(o, dict) else None
+        if org_id is not None:
+            ids.append(org_id)
+    return ids
+
+
+def _to_datetime(value):
+    """
+    Turn a date, datetime or ISO format string into a datetime in UTC
+    """
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            return value.replace(tzinfo=datetime.timezone.utc)
+        return value.astimezone(datetime.timezone.utc)
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day, tzinfo=datetime.timezone.utc)
+    return _parse_datetime(value)
+
+
+class GrantIndexes:
+    """
+    Indexes of a list of grants, for finding grants without looking through all of them
+
+    All the indexes are built in a single pass through the grants. They hold the
+    positions of the grants in the list, so they need to be created again if the
+    grants change. Grants with a missing or invalid value for a field aren't
+    included in the index for that field.
+    """
+
+    def __init__(self, grants):
+        """
+        :param list grants: the grants, as dicts
+        """
+        self.ids = {}
+        self.recipients = {}
+        self.funders = {}
+        dates, date_positions = [], []
+        amounts, amount_positions = [], []
+
+        for i, grant in enumerate(grants):
+            if not isinstance(grant, dict):
+                continue
+            grant_id = _key(grant.get('id'))
+            if grant_id is not None and grant_id not in self.ids:
+                self.ids[grant_id] = i
+            for org_id in _org_ids(grant, 'recipientOrganization'):
+                self.recipients.setdefault(org_id, []).append(i)
+            for org_id in _org_ids(grant, 'fundingOrganization'):
+                self.funders.setdefault(org_id, []).append(i)
+
+            award_date = grant.get('awardDate')
+            if isinstance(award_date, str):
+                try:
+                    dates.append(_parse_datetime(award_date))
+                    date_positions.append(i)
+                except ValueError:
+                    pass
+            amount = grant.get('amountAwarded')
+            if isinstance(amount, (int, float)) and not isinstance(amount, bool):
+                amounts.append(amount)
+                amount_positions.append(i)
+
+        order = sorted(range(len(dates)), key=dates.__getitem__)
+        self.date_keys = [dates[j] for j in order]
+        self.date_positions = [date_positions[j] for j in order]
+        order = sorted(range(len(amounts)), key=amounts.__getitem__)
+        self.amount_keys = [amounts[j] for j in order]
+        self.amount_positions = [amount_positions[j] for j in order]
+
+    def awarded_between(self, start=None, end=None):
+        """
+        Find the grants awarded from `start` up to (but not including) `end`
+
+        :param start: date, datetime or ISO format string. If None there is no lower limit
+        :param end: date, datetime or ISO format string. If None there is no upper limit
+        :return: positions of the grants, in order of award date
+        :rtype: list
+        """
+        lo = 0 if start is None else bisect.bisect_left(self.date_keys, _to_datetime(start))
+        hi = len(self.date_keys) if end is None else bisect.bisect_left(self.date_keys, _to_datetime(end))
+        return self.date_positions[lo:hi]
+
+    def amount_between(self, minimum=None, maximum=None):
+        """
+        Find the grants with an amount awarded from `minimum` up to and including `maximum`
+
+        :param minimum: the lowest amount. If None there is no lower limit
+        :param maximum: the highest amount. If None there is no upper limit
+        :return: positions of the grants, in order of amount
+        :rtype: list
+        """
+        lo = 0 if minimum is None else bisect.bisect_left(self.amount_keys, minimum)
+        hi = len(self.amount_keys) if maximum is None else bisect.bisect_right(self.amount_keys, maximum)
+        return self.amount_positions[lo:hi]
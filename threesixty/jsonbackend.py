@@ -0,0 +1,83 @@
+import codecs
+import json
+
+
+class StdlibBackend:
+    """
+    Reads and writes JSON using the `json` module from the standard library
+    """
+
+    name = 'json'
+
+    def loads(self, data):
+        """
+        Parse JSON from bytes (in UTF-8, UTF-16 or UTF-32) or a string
+        """
+        return json.loads(data)
+
+    def dumps(self, obj):
+        """
+        Write an object as compact JSON
+
+        :rtype: bytes
+        """
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf8')
+
+
+class OrjsonBackend(StdlibBackend):
+    """
+    Reads and writes JSON using `orjson`, which is much quicker than the standard library
+
+    Anything `orjson` can't handle (eg files in UTF-16 or integers that are
+    too big) falls back to the standard library.
+    """
+
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+
+    def loads(self, data):
+        if isinstance(data, bytes) and data.startswith(codecs.BOM_UTF8):
+            data = data[len(codecs.BOM_UTF8):]
+        try:
+            return self.orjson.loads(data)
+        except self.orjson.JSONDecodeError:
+            # give the standard library a chance to read it (eg other
+            # unicode encodings), which also gives the same errors
+            return super().loads(data)
+
+    def dumps(self, obj):
+        try:
+            return self.orjson.dumps(obj)
+        except TypeError:
+            return super().dumps(obj)
+
+
+BACKENDS = {
+    'orjson': OrjsonBackend,
+    'json': StdlibBackend,
+}
+
+_backends = {}
+
+
+def get_backend(name=None):
+    """
+    Get a JSON backend
+
+    :param str name: the backend to use (`orjson` or `json`). If None then `orjson`
+        is used if it is installed, otherwise `json`
+    :raises: ImportError if the backend's library isn't installed
+    """
+    if name is None:
+        try:
+            return get_backend('orjson')
+        except ImportError:
+            return get_backend('json')
+    if name not in _backends:
+        if name not in BACKENDS:
+            raise ValueError("Unknown JSON backend [{}]".format(name))
+        _backends[name] = BACKENDS[name]()
+    return _backends[name]
@@ -0,0 +1,476 @@
+import codecs
+import json
+import mmap
+import os
+import re
+import sys
+from array import array
+from collections import OrderedDict
+from collections.abc import Sequence
+
+from .cache import _write_atomic
+from .jsonbackend import get_backend
+from .threesixty import Grant
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.idx'
+
+_WHITESPACE = re.compile(rb'[ \t\r\n]*')
+# what can come between the grants in the array
+_SEPARATOR = b' \t\r\n,'
+_SEPARATOR_RE = re.compile(rb'[ \t\r\n,]*')
+_STRING = rb'"[^"\\]*(?:\\.[^"\\]*)*"'
+_STRING_RE = re.compile(_STRING)
+_SCALAR_RE = re.compile(rb'[^,}\] \t\r\n]+')
+_TOKEN_RE = re.compile(_STRING + rb'|[{}\[\]]')
+
+
+def _nested_pattern(depth):
+    """
+    A regular expression matching an object or array nested up to `depth` levels deep
+
+    Regular expressions can't match brackets nested to any depth, but this
+    covers nearly all grants in one match, which is much quicker than finding each bracket.
+    """
+    other = rb'[^"{}\[\]]*'
+    inner = _STRING if depth == 0 else rb'(?:' + _STRING + rb'|' + _nested_pattern(depth - 1) + rb')'
+    return rb'[{\[]' + other + rb'(?:' + inner + other + rb')*[}\]]'
+
+
+_NESTED_RE = re.compile(_nested_pattern(8))
+
+
+def _skip_value(buf, pos):
+    """
+    Find the end of the JSON value starting at `pos`, without parsing it
+
+    :return: the position just after the value
+    :raises: ValueError if it isn't a valid value
+    """
+    char = buf[pos:pos + 1]
+    if char in (b'{', b'['):
+        m = _NESTED_RE.match(buf, pos)
+        if m is not None:
+            return m.end()
+        # nested too deeply for the regular expression, so count the brackets
+        depth = 0
+        for m in _TOKEN_RE.finditer(buf, pos):
+            token = m.group()
+            if token in (b'{', b'['):
+                depth += 1
+            elif token in (b'}', b']'):
+                depth -= 1
+                if depth == 0:
+                    return m.end()
+    elif char == b'"':
+        m = _STRING_RE.match(buf, pos)
+        if m is not None:
+            return m.end()
+    else:
+        m = _SCALAR_RE.match(buf, pos)
+        if m is not None:
+            return m.end()
+    raise ValueError("Invalid JSON value at position {}".format(pos))
+
+
+class LazyGrants(Sequence):
+    """
+    The grants in a 360Giving JSON file, which are only parsed when they are used
+
+    The file is memory-mapped rather than read. An index of where each grant starts
+    and ends in the file is built by scanning the `grants` array without parsing
+    it, so getting a grant only parses that grant. The index is built as far as
+    it is needed, so the first grants can be used without scanning the whole file,
+    although `len()` needs the whole file to be scanned.
+
+    The scan uses `numpy` if it is installed (and `use_numpy` is True), which is
+    several times quicker. It reads small chunks at first, so the first grants are
+    found quickly, and bigger chunks (up to `chunk_size`) as it goes on. The
+    index can be saved to a file (by default next to the JSON file, with `.idx`
+    added to the name) so the file doesn't need to be scanned again. A saved index
+    is only used if the size and modification time of the JSON file haven't changed.
+
+    Only files in UTF-8 are supported, and each grant must be a JSON object. A
+`ValueError` is raised when anything else is found in the `grants` array.
+    """
+
+    use_numpy = True
+    chunk_size = 16 * 1024 * 1024
+    first_chunk_size = 1024 * 1024
+
+    def __init__(self, f, root_id='grants', save_index=False, index_path=None, json_backend=None):
+        """
+        :param str f: file path to a JSON file
+        :param str root_id: the field holding the grants
+        :param bool save_index: save the index once the whole file has been scanned
+        :param str index_path: where to save (and look for) the index. Defaults to the path of the file with `.idx` added
+        :param str json_backend: the JSON backend used to parse each grant (see `threesixty.jsonbackend`)
+        """
+        self.f = f
+        self.root_id = root_id
+        self.save_index = save_index
+        self.index_path = index_path if index_path is not None else f + INDEX_SUFFIX
+        self._backend = get_backend(json_backend)
+
+        self._file = open(f, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError("Can't read an empty file")
+        self._stat = os.fstat(self._file.fileno())
+
+        self._starts = array('q')
+        self._ends = array('q')
+        self._fields = []
+        self._complete = False
+        if not self._load_index():
+            try:
+                self._start_scan()
+            except ValueError:
+                self.close()
+                raise
+
+    def __len__(self):
+        self._scan_to(None)
+        return len(self._ends)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [Grant.from_dict(self._parse(i)) for i in self._range(index)]
+        if index < 0:
+            index += len(self)
+        self._scan_to(index)
+        if not 0 <= index < len(self._ends):
+            raise IndexError("grant index out of range")
+        return Grant.from_dict(self._parse(index))
+
+    def __iter__(self):
+        for g in self.iter_raw():
+            yield Grant.from_dict(g)
+
+    def iter_raw(self):
+        """
+        Yield each grant as a plain dictionary
+        """
+        i = 0
+        while True:
+            self._scan_to(i)
+            if i >= len(self._ends):
+                return
+            yield self._parse(i)
+            i += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Close the file
+        """
+        self._mm.close()
+        self._file.close()
+
+    @property
+    def metadata(self):
+        """
+        The package-level fields (everything outside the `grants` array)
+
+        Any fields that come after the grants in the file are only found once the whole file has been scanned.
+        """
+        self._scan_to(None)
+        return OrderedDict(
+            (k, self._backend.loads(self._mm[start:end])) for k, start, end in self._fields)
+
+    def offsets(self, index):
+        """
+        Get the position in the file of the start and end of a grant
+
+        :return: tuple of `(start, end)` in bytes
+        """
+        if index < 0:
+            index += len(self)
+        self._scan_to(index)
+        return self._starts[index], self._ends[index]
+
+    def build_index(self):
+        """
+        Scan the whole file, and save the index if `save_index` is set
+        """
+        self._scan_to(None)
+
+    def _range(self, s):
+        """
+        Get the positions of the grants in a slice, only scanning as far as needed
+        """
+        if s.step is None or s.step > 0:
+            if (s.start or 0) >= 0 and s.stop is not None and s.stop >= 0:
+                self._scan_to(s.stop - 1)
+                return range(*s.indices(len(self._ends)))
+        return range(*s.indices(len(self)))
+
+    def _parse(self, index):
+        return self._backend.loads(self._mm[self._starts[index]:self._ends[index]])
+
+    # finding the grants
+
+    def _start_scan(self):
+        """
+        Find the start of the `grants` array, noting any package-level fields before it
+        """
+        buf = self._mm
+        if buf[:2] in (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE) or b'\x00' in buf[:4]:
+            raise ValueError("Only JSON files in UTF-8 can be loaded lazily")
+        pos = len(codecs.BOM_UTF8) if buf[:3] == codecs.BOM_UTF8 else 0
+        pos = _WHITESPACE.match(buf, pos).end()
+        if buf[pos:pos + 1] != b'{':
+            raise ValueError("The file must contain a JSON object")
+        self._pos = self._scan_fields(pos + 1)
+        self._last_end = self._pos
+        self._depth = 0
+        self._in_string = 0
+        self._chunk_size = min(self.first_chunk_size, self.chunk_size)
+        if self._pos is None:
+            self._finish_scan()
+
+    def _scan_fields(self, pos):
+        """
+        Note where the package-level fields are, until the `grants` array or the end of the package
+
+        :return: the position just inside the `grants` array, or None if the end of the package is reached
+        """
+        buf = self._mm
+        while True:
+            pos = _WHITESPACE.match(buf, pos).end()
+            char = buf[pos:pos + 1]
+            if char == b',':
+                pos += 1
+                continue
+            if char == b'}':
+                return None
+            m = _STRING_RE.match(buf, pos)
+            if m is None:
+                raise ValueError("Invalid JSON at position {}".format(pos))
+            key = json.loads(m.group().decode('utf8'))
+            pos = _WHITESPACE.match(buf, m.end()).end()
+            if buf[pos:pos + 1] != b':':
+                raise ValueError("Invalid JSON at position {}".format(pos))
+            pos = _WHITESPACE.match(buf, pos + 1).end()
+            if key == self.root_id and buf[pos:pos + 1] == b'[':
+                return pos + 1
+            end = _skip_value(buf, pos)
+            self._fields.append((key, pos, end))
+            pos = end
+
+    def _scan_to(self, index):
+        """
+        Scan the file until the grant at `index` has been found (or the whole file if `index` is None)
+        """
+        while not self._complete and (index is None or index >= len(self._ends)):
+            self._scan_more()
+
+    def _scan_more(self):
+        numpy = None
+        if self.use_numpy:
+            try:
+                import numpy
+            except ImportError:
+                pass
+        if numpy is None:
+            array_end = self._scan_grant()
+        else:
+            error = None
+            try:
+                array_end = self._scan_chunk(numpy)
+            except ValueError as e:
+                error = str(e)
+            if error is not None:
+                # raised again outside the `except`, as the traceback holds views of the
+                # memory map which would stop it being closed
+                raise ValueError(error)
+        if array_end is not None:
+            self._scan_fields(array_end + 1)
+            self._finish_scan()
+
+    def _scan_grant(self):
+        """
+        Find the next grant using regular expressions
+
+        :return: the position of the end of the `grants` array if it has been reached
+        """
+        buf = self._mm
+        pos = _WHITESPACE.match(buf, self._pos).end()
+        if buf[pos:pos + 1] == b',':
+            pos = _WHITESPACE.match(buf, pos + 1).end()
+        if buf[pos:pos + 1] == b']':
+            return pos
+        if buf[pos:pos + 1] != b'{':
+            raise ValueError("Grant at position {} isn't a JSON object".format(pos))
+        end = _skip_value(buf, pos)
+        self._starts.append(pos)
+        self._ends.append(end)
+        self._pos = end
+        return None
+
+    def _scan_chunk(self, numpy):
+        """
+        Find the grants in the next chunk of the file using `numpy`
+
+        Each bracket that isn't in a string is found, and the depth of each
+        one is worked out from a running total. The grants start with the
+        brackets that open at depth 1 and end with those that close at depth 0.
+        A bracket is in a string if there is an odd number of (unescaped) quotes before it.
+        Anything other than objects in the array is found by checking that there
+        are only commas and whitespace between the grants.
+
+        :return: the position of the end of the `grants` array if it has been reached
+        """
+        buf = numpy.frombuffer(self._mm, dtype=numpy.uint8)
+        pos = self._pos
+        if pos >= len(buf):
+            raise ValueError("The grants array isn't closed")
+        chunk = buf[pos:pos + self._chunk_size]
+        self._chunk_size = min(self._chunk_size * 2, self.chunk_size)
+
+        quotes = numpy.flatnonzero(chunk == ord('"'))
+        if len(quotes):
+            quotes = self._unescaped_quotes(buf, quotes, pos)
+
+        # `{`, `}`, `[` and `]` are the only bytes (other than `Y`, `_`, `y` and DEL) matching this mask
+        brackets = numpy.flatnonzero((chunk & 0xD9) == 0x59)
+        values = chunk[brackets]
+        is_bracket = (values == ord('{')) | (values == ord('}')) | (values == ord('[')) | (values == ord(']'))
+        brackets, values = brackets[is_bracket], values[is_bracket]
+        outside = (numpy.searchsorted(quotes, brackets) + self._in_string) % 2 == 0
+        brackets, values = brackets[outside], values[outside]
+
+        # opening brackets have the second bit set
+        steps = numpy.where(values & 2, 1, -1)
+        depths = numpy.cumsum(steps) + self._depth
+
+        array_end = None
+        closed = numpy.flatnonzero(depths < 0)
+        if len(closed):
+            k = closed[0]
+            array_end = pos + int(brackets[k])
+            brackets, steps, depths = brackets[:k], steps[:k], depths[:k]
+
+        starts = brackets[(steps == 1) & (depths == 1)]
+        if not (chunk[starts] == ord('{')).all():
+            k = int(starts[numpy.flatnonzero(chunk[starts] != ord('{'))[0]])
+            raise ValueError("Grant at position {} isn't a JSON object".format(pos + k))
+        starts = (starts + pos).astype('q')
+        ends = (brackets[(steps == -1) & (depths == 0)] + pos + 1).astype('q')
+
+        # each grant comes after the end of the one before it (or the start of the array)
+        previous = numpy.concatenate((numpy.array([self._last_end], dtype='q'), ends))
+        self._check_separators(numpy, buf, previous[numpy.searchsorted(previous, starts) - 1], starts)
+        self._last_end = int(previous[-1])
+        if array_end is not None:
+            self._check_separators(
+                numpy, buf, previous[-1:], numpy.array([array_end], dtype='q'))
+
+        self._starts.frombytes(starts.tobytes())
+        self._ends.frombytes(ends.tobytes())
+        if len(depths):
+            self._depth = int(depths[-1])
+        self._in_string = (self._in_string + len(quotes)) % 2
+        self._pos = pos + len(chunk)
+        return array_end
+
+    def _check_separators(self, numpy, buf, starts, ends, max_length=64):
+        """
+        Check there are only commas and whitespace between each pair of positions
+
+        Short gaps (the usual `,\\n  ` between grants) are checked together, and any
+        longer ones are checked one at a time.
+
+        :raises: ValueError if there is anything else, ie a value that isn't an object
+        """
+        lengths = ends - starts
+        short = lengths <= max_length
+        if short.any():
+            offsets = numpy.arange(int(lengths[short].max()))
+            positions = numpy.minimum(starts[short, None] + offsets, len(buf) - 1)
+            found = (offsets < lengths[short, None]) & \
+                ~numpy.isin(buf[positions], numpy.frombuffer(_SEPARATOR, dtype=numpy.uint8))
+            if found.any():
+                k, offset = numpy.argwhere(found)[0]
+                raise ValueError("Grant at position {} isn't a JSON object".format(
+                    int(starts[short][k] + offset)))
+        for start, end in zip(starts[~short].tolist(), ends[~short].tolist()):
+            m = _SEPARATOR_RE.match(self._mm, start, end)
+            if m.end() != end:
+                raise ValueError("Grant at position {} isn't a JSON object".format(m.end()))
+
+    @staticmethod
+    def _unescaped_quotes(buf, quotes, pos):
+        """
+        Remove any quotes which are escaped by a backslash
+
+        :param buf: the whole file
+        :param quotes: positions of the quotes, relative to `pos`
+        """
+        # the grants array starts after the opening `{`, so the byte before a quote always exists
+        preceded = (buf[quotes + pos - 1] == ord('\\')).nonzero()[0]
+        if not len(preceded):
+            return quotes
+        keep = [True] * len(quotes)
+        for k in preceded.tolist():
+            # an odd number of backslashes before the quote means it's escaped
+            i = quotes[k] + pos - 1
+            while buf[i] == ord('\\'):
+                i -= 1
+            if (quotes[k] + pos - 1 - i) % 2:
+                keep[k] = False
+        return quotes[keep]
+
+    def _finish_scan(self):
+        self._complete = True
+        if self.save_index:
+            self._save_index()
+
+    # saving the index
+
+    def _index_header(self):
+        return {
+            'version': INDEX_VERSION,
+            'size': self._stat.st_size,
+            'mtime_ns': self._stat.st_mtime_ns,
+            'root_id': self.root_id,
+            'byteorder': sys.byteorder,
+            'count': len(self._ends),
+            'fields': self._fields,
+        }
+
+    def _save_index(self):
+        header = json.dumps(self._index_header()).encode('utf8') + b'\n'
+        _write_atomic(self.index_path, header + self._starts.tobytes() + self._ends.tobytes())
+
+    def _load_index(self):
+        """
+        Load a saved index, if there is one for this version of the file
+
+        :return: True if the index was loaded
+        """
+        try:
+            with open(self.index_path, 'rb') as f:
+                header = json.loads(f.readline().decode('utf8'))
+                expected = self._index_header()
+                if any(header.get(k) != expected[k] for k in ('version', 'size', 'mtime_ns', 'root_id')):
+                    return False
+                starts, ends = array('q'), array('q')
+                starts.fromfile(f, header['count'])
+                ends.fromfile(f, header['count'])
+        except (OSError, ValueError, EOFError):
+            return False
+        if header['byteorder'] != sys.byteorder:
+            starts.byteswap()
+            ends.byteswap()
+        self._starts, self._ends = starts, ends
+        self._fields = [tuple(field) for field in header['fields']]
+        self._complete = True
+        return True
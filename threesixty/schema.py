@@ -0,0 +1,219 @@
+import functools
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+from jsonref import JsonRef
+from jsonschema import Draft4Validator, FormatChecker
+
+from .fastvalidator import compile_validator, UnsupportedSchema
+
+# maximum number of compiled schemas kept in memory
+COMPILED_SCHEMA_CACHE_SIZE = 16
+# maximum number of converted fieldnames remembered by each `FieldnameConverter`
+FIELDNAME_CACHE_SIZE = 65536
+
+_compiled_schemas = OrderedDict()
+_compiled_schemas_lock = threading.Lock()
+
+
+class CompiledSchema:
+    """
+    A schema with its references resolved, and the validators and field
+    names that are created from it
+
+    These are expensive to create, so are shared between every `ThreeSixtyGiving`
+    object that uses the same schema (see `compile_schema`). They shouldn't be changed.
+    """
+
+    def __init__(self, schema, root_id='grants', loader=None):
+        """
+        :param dict schema: the JSON schema for a 360Giving package
+        :param str root_id: the property of the package containing the grants
+        :param loader: function used by `JsonRef` to fetch any referenced schemas
+        """
+        self.root_id = root_id
+
+        # fetch the whole schema including references
+        if loader is not None:
+            self.schema = JsonRef.replace_refs(schema, loader=loader)
+        else:
+            self.schema = JsonRef.replace_refs(schema)
+        self.grant_schema = self.schema['properties'][root_id]['items']
+
+        # create a validator
+        self.validator = Draft4Validator(
+            self.schema, format_checker=FormatChecker())
+        self.grant_validator = Draft4Validator(
+            self.grant_schema, format_checker=FormatChecker())
+        package_schema = dict(self.schema)
+        package_schema['properties'] = dict(package_schema['properties'])
+        package_schema['properties'][root_id] = {
+            k: v for k, v in package_schema['properties'][root_id].items()
+            if k not in ('items', 'uniqueItems')
+        }
+        self.package_validator = Draft4Validator(
+            package_schema, format_checker=FormatChecker())
+
+        # a quicker check for whether a grant is valid, or None if the schema can't be compiled
+        try:
+            self.fast_grant_validator = compile_validator(self.grant_schema, FormatChecker())
+        except UnsupportedSchema:
+            self.fast_grant_validator = None
+
+        self.replace_names = self._recurse_names(self.grant_schema['properties'])
+        self.fieldname_converter = FieldnameConverter(self.grant_schema['properties'])
+
+    @classmethod
+    def _recurse_names(cls, props, replace_names=None, prefix_k='', prefix_v=''):
+        """
+        Recursively find property names and titles
+        """
+        if replace_names is None:
+            replace_names = OrderedDict()
+        for i, prop in props.items():
+            name_k = '{}.([0-9]+).{}'.format(prefix_k, i) if prefix_k != '' else i
+            name_v = '{}:\\1:{}'.format(prefix_v, prop.get(
+                "title", i)) if prefix_v != '' else prop.get("title", i)
+            if prop.get("type") == 'array':
+                replace_names = cls._recurse_names(
+                    prop.get("items", {}).get("properties", {}),
+                    replace_names,
+                    name_k,
+                    name_v
+                )
+            else:
+                replace_names[name_k] = name_v
+        return replace_names
+
+
+class FieldnameConverter:
+    """
+    Converts flattened field paths (eg `recipientOrganization.0.id`) into the
+    titles used in 360Giving flat files (eg `Recipient Org:0:Identifier`)
+
+    The property names from the schema are held in a tree, so each fieldname is
+    converted by looking up one segment of the path at a time rather than by
+    trying every pattern in `CompiledSchema.replace_names`. The results for the
+    last `FIELDNAME_CACHE_SIZE` fieldnames used are remembered, as the converter
+    is shared by every object using the same schema.
+    """
+
+    def __init__(self, props):
+        """
+        :param dict props: the properties of the grant schema, with references resolved
+        """
+        self.tree = self._build_tree(props)
+        self._converted = functools.lru_cache(maxsize=FIELDNAME_CACHE_SIZE)(self._convert)
+
+    @classmethod
+    def _build_tree(cls, props):
+        """
+        Create a dict of property name to `(title, children)`, where children
+        is None unless the property is an array of objects
+        """
+        tree = {}
+        for k, prop in props.items():
+            children = None
+            if prop.get("type") == 'array':
+                children = cls._build_tree(prop.get("items", {}).get("properties", {}))
+            tree[k] = (prop.get("title", k), children)
+        return tree
+
+    def convert(self, fieldname):
+        """
+        Convert a single fieldname
+
+        :param str fieldname: the flattened field path
+        :return: the title for the field, or the fieldname unchanged if it isn't in the schema
+        :rtype: str
+        """
+        return self._converted(fieldname)
+
+    def convert_many(self, fieldnames):
+        """
+        Convert a list of fieldnames
+
+        :param list[str] fieldnames: the flattened field paths
+        :return: Dictionary of old:new values for fieldnames
+        :rtype: OrderedDict
+        """
+        converted = self._converted
+        return OrderedDict((f, converted(f)) for f in fieldnames)
+
+    def _convert(self, fieldname):
+        segments = fieldname.split('.')
+        tree = self.tree
+        parts = []
+        i = 0
+        while i < len(segments):
+            node = tree.get(segments[i]) if tree is not None else None
+            if node is None:
+                return fieldname
+            title, tree = node
+            parts.append(title)
+            i += 1
+            if tree is None:
+                # only complete paths to a property are converted
+                return ':'.join(parts) if i == len(segments) else fieldname
+            # arrays of objects must be followed by an index
+            if i == len(segments) or not (segments[i].isascii() and segments[i].isdigit()):
+                return fieldname
+            parts.append(segments[i])
+            i += 1
+        return fieldname
+
+
+def schema_hash(schema):
+    """
+    Create a hash of the contents of a schema
+
+    :param dict schema: A JSON schema (without any references resolved)
+    :rtype: str
+    """
+    return hashlib.sha1(
+        json.dumps(schema, sort_keys=True).encode('utf8')).hexdigest()
+
+
+def compile_schema(schema, schema_url=None, root_id='grants', loader=None):
+    """
+    Get a `CompiledSchema` for a schema, reusing one that has already been
+    created in this process if possible
+
+    Compiled schemas are kept in a least-recently-used cache keyed by the URL
+    and a hash of the schema contents, which holds up to `COMPILED_SCHEMA_CACHE_SIZE`
+    schemas. Referenced schemas aren't part of the hash, so use
+    `clear_compiled_schemas` if they change.
+
+    :param dict schema: the JSON schema for a 360Giving package
+    :param str schema_url: the URL the schema came from
+    :param str root_id: the property of the package containing the grants
+    :param loader: function used by `JsonRef` to fetch any referenced schemas
+    :rtype: CompiledSchema
+    """
+    key = (schema_url, root_id, schema_hash(schema))
+    with _compiled_schemas_lock:
+        if key in _compiled_schemas:
+            _compiled_schemas.move_to_end(key)
+            return _compiled_schemas[key]
+
+    compiled = CompiledSchema(schema, root_id=root_id, loader=loader)
+
+    with _compiled_schemas_lock:
+        _compiled_schemas[key] = compiled
+        while len(_compiled_schemas) > COMPILED_SCHEMA_CACHE_SIZE:
+            _compiled_schemas.popitem(last=False)
+    return compiled
+
+
+def clear_compiled_schemas(schema_url=None):
+    """
+    Remove compiled schemas from the cache
+
+    :param str schema_url: Only remove schemas from this URL
+    """
+    with _compiled_schemas_lock:
+        for key in list(_compiled_schemas):
+            if schema_url is None or key[0] == schema_url:
+                del _compiled_schemas[key]
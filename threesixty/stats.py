@@ -0,0 +1,121 @@
+import contextlib
+import sys
+import time
+from collections import Counter, OrderedDict
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_memory():
+    """
+    The most memory (resident set size) used by this process so far
+
+    :return: number of bytes, or None if it isn't available on this platform
+    :rtype: int
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in kilobytes on Linux but bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Stats:
+    """
+    Records how long each stage of loading, validating and exporting data takes,
+    along with counts of things like bytes downloaded and grants validated
+
+    Stages are timed using `stage()`. Each time a stage finishes, `callback` is
+    called with this object, the name of the stage and the time it took in seconds.
+    """
+
+    enabled = True
+
+    def __init__(self, callback=None):
+        """
+        :param callback: function called as `callback(stats, stage, seconds)` whenever a stage finishes
+        """
+        self.callback = callback
+        self.timings = OrderedDict()
+        self.calls = Counter()
+        self.counters = Counter()
+        self.peak_memory = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time a stage, adding it to the total for stages with the same name
+
+        :param str name: the name of the stage (eg `download`, `validate`)
+        """
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[name] = self.timings.get(name, 0) + elapsed
+            self.calls[name] += 1
+            self.peak_memory = peak_memory()
+            if self.callback is not None:
+                self.callback(self, name, elapsed)
+
+    def count(self, name, n=1):
+        """
+        Add to a counter
+
+        :param str name: the name of the counter (eg `bytes_downloaded`)
+        :param int n: the amount to add
+        """
+        self.counters[name] += n
+
+    def merge(self, other):
+        """
+        Add the timings and counters from another `Stats` object (eg one used in a worker process)
+
+        `callback` isn't called for the stages that are added.
+        """
+        for name, seconds in other.timings.items():
+            self.timings[name] = self.timings.get(name, 0) + seconds
+        self.calls.update(other.calls)
+        self.counters.update(other.counters)
+
+    def as_dict(self):
+        """
+        Get the stats as a dictionary, eg for logging as JSON
+        """
+        return {
+            'timings': dict(self.timings),
+            'calls': dict(self.calls),
+            'counters': dict(self.counters),
+            'peak_memory': self.peak_memory,
+        }
+
+    def __repr__(self):
+        return '<Stats {}>'.format(', '.join(
+            '{}={:.3f}s'.format(k, v) for k, v in self.timings.items()))
+
+
+class NullStats(Stats):
+    """
+    Used when stats aren't being collected. Timing a stage or adding to
+    a counter does nothing.
+    """
+
+    enabled = False
+
+    def __init__(self):
+        super().__init__()
+        self._null_stage = contextlib.nullcontext(self)
+
+    def stage(self, name):
+        return self._null_stage
+
+    def count(self, name, n=1):
+        pass
+
+
+# shared by every object that isn't collecting stats
+NULL_STATS = NullStats()
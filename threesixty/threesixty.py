@@ -1,17 +1,33 @@
+import io
+import codecs
 import json
+import hashlib
 import tempfile
 import os
 import csv
+import functools
 import re
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 import flattentool
 import requests
 from urllib.parse import urlparse
-from jsonref import JsonRef
 from jsonschema import Draft4Validator, FormatChecker
+from jsonschema.exceptions import ValidationError
+
+from .arrow import grants_to_table, table_to_grants, _is_datetime
+from .cache import _resolve_refs
+from .fastvalidator import compile_validator, UnsupportedSchema, _unique
+from .index import GrantIndexes
+from .jsonbackend import get_backend as get_json_backend
+from .schema import compile_schema
+from .stats import Stats, NULL_STATS
+from .unflatten import Unflattener, _types
 
 ENCODINGS_TO_CHECK = ['utf-8-sig', 'cp1252', 'latin_1', 'ansi']
+ENCODING_CHUNK_SIZE = 1024 * 1024
+ENCODING_DETECT_SIZE = 1024 * 1024
 CONTENT_TYPE_MAP = {
     'application/json': 'json',
     'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': 'xlsx',
@@ -23,16 +39,284 @@ class ParseError(Exception):
         super().__init__(message)
         self.errors = errors
 
+    def __reduce__(self):
+        # so the errors are kept when it is sent from a worker process
+        return (self.__class__, (self.args[0], self.errors))
+
+
+class ErrorRecord(namedtuple('ErrorRecord', ['path', 'message', 'validator', 'grant_index'])):
+    """
+    The details of a validation error that are kept after checking a dataset
+
+    Unlike a `ValidationError` it doesn't hold references to the schema or the
+    data, so many of them can be kept without using much memory.
+
+    - `path`: tuple of the keys and positions of the invalid value (eg `('grants', 2, 'amountAwarded')`)
+    - `message`: description of the error
+    - `validator`: the schema keyword that failed (eg `type` or `required`)
+    - `grant_index`: position of the grant with the error, or None for package-level errors
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_error(cls, e, root_id='grants'):
+        """
+        Create a record from a `jsonschema.exceptions.ValidationError`
+        """
+        path = tuple(e.path)
+        grant_index = None
+        if len(path) > 1 and path[0] == root_id and isinstance(path[1], int):
+            grant_index = path[1]
+        return cls(path, e.message, e.validator, grant_index)
+
+    def __str__(self):
+        return '{}: {}'.format('/'.join(str(p) for p in self.path), self.message)
+
+
+# keyword arguments of `ThreeSixtyGiving.__init__` that are passed on when creating an object
+_INIT_KWARGS = ('schema_url', 'schema', 'schema_cache', 'stats')
+
+# validators used by each worker process when validating grants in parallel
+_worker_validator = None
+_worker_fast_validator = None
+
+
+def _init_validation_worker(grant_schema, fast=True):
+    """
+    Create the grant validators once when each worker process starts
+    """
+    global _worker_validator, _worker_fast_validator
+    _worker_validator = Draft4Validator(grant_schema, format_checker=FormatChecker())
+    _worker_fast_validator = None
+    if fast:
+        try:
+            _worker_fast_validator = compile_validator(grant_schema, FormatChecker())
+        except UnsupportedSchema:
+            pass
+
+
+def _validate_grants(root_id, start, grants, unique=False):
+    """
+    Validate a chunk of grants in a worker process
+
+    The path of each error is made relative to the whole package, so that
+    they look the same as errors from `ThreeSixtyGiving.get_errors`. If `unique`
+    is True then a digest of each grant is also returned so that duplicate
+    grants can be found across the chunks.
+    """
+    errors = []
+    digests = []
+    for i, grant in enumerate(grants, start=start):
+        for e in _iter_grant_errors(grant, _worker_validator, _worker_fast_validator):
+            e.path.extendleft([i, root_id])
+            errors.append(e)
+        if unique:
+            digests.append(hashlib.sha1(
+                json.dumps(grant, sort_keys=True).encode('utf8')).digest())
+    return errors, digests
+
+
+def _load_downloaded_file(cls, f, filetype, kwargs):
+    """
+    Parse (and validate) a downloaded file in a worker process used by `ThreeSixtyGiving.from_urls`
+
+    The object itself can't be sent back to the main process (its validators
+    can't be pickled), so the data, the results of validating it and any stats
+    are returned instead.
+    """
+    c = cls.from_file(f, filetype, **kwargs)
+    return c.data, c.valid, c.errors, c.errors_truncated, c.stats if c.stats.enabled else None
+
+
+class _BorrowedTextIOWrapper(io.TextIOWrapper):
+    """
+    A text wrapper around a binary file object that belongs to someone else
+
+    Closing the wrapper (including when it is garbage collected) detaches it
+    rather than closing the file object.
+    """
+
+    def close(self):
+        try:
+            self.detach()
+        except ValueError:
+            # already detached
+            pass
+
+
+def _decodes(fileobj, decoder, sample_size=None):
+    """
+    Check whether a file can be decoded, reading it in chunks and stopping at the first error
+
+    :param fileobj: binary file object, read from its current position
+    :param decoder: incremental decoder from `codecs.getincrementaldecoder`
+    :param int sample_size: maximum number of bytes to check (checks the whole file if None)
+    :rtype: bool
+    """
+    remaining = sample_size
+    try:
+        while remaining is None or remaining > 0:
+            size = ENCODING_CHUNK_SIZE if remaining is None else min(ENCODING_CHUNK_SIZE, remaining)
+            chunk = fileobj.read(size)
+            if not chunk:
+                # only check for incomplete characters at the end of the whole file
+                decoder.decode(b'', final=True)
+                break
+            decoder.decode(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def _detect_encoding(sample, min_confidence=0.5):
+    """
+    Use `charset_normalizer` or `chardet` (if installed) to guess the encoding of some bytes
+
+    :return: The encoding, or None if it couldn't be found with enough confidence
+    """
+    try:
+        from charset_normalizer import detect
+    except ImportError:
+        try:
+            from chardet import detect
+        except ImportError:
+            return None
+    result = detect(sample)
+    if result.get('encoding') and (result.get('confidence') or 0) >= min_confidence:
+        return result['encoding']
+    return None
+
+
+def _ignore_error(e):
+    """
+    Whether a validation error should be ignored
+
+    Ignores the error where the datetime value is one of a type
+    """
+    return e.validator == 'oneOf' and e.validator_value[0] == {'format': 'date-time'}
+
+
+def _iter_grant_errors(grant, validator, fast_validator=None):
+    """
+    Yield the errors (that aren't ignored) for a single grant
+
+    If a `fast_validator` (see `fastvalidator.compile_validator`) is given then
+    `validator` is only used to find the errors in grants it says aren't valid.
+    """
+    if fast_validator is not None and fast_validator(grant):
+        return
+    for e in validator.iter_errors(grant):
+        if not _ignore_error(e):
+            yield e
+
+
+def _grant_key(grant):
+    """
+    The identifier of a grant, used to group grants which might be identical
+    """
+    grant_id = grant.get('id') if isinstance(grant, dict) else None
+    if isinstance(grant_id, (dict, list)):
+        # an identifier that can't be used as a key
+        return None
+    return grant_id
+
+
+def _has_duplicates(grants):
+    """
+    Whether any of the grants are identical
+
+    Identical grants have the same identifier, so only grants which share an
+    identifier are compared, rather than every pair of grants as `jsonschema` does.
+    """
+    by_id = {}
+    for g in grants:
+        by_id.setdefault(_grant_key(g), []).append(g)
+    return any(len(same_id) > 1 and not _unique(same_id) for same_id in by_id.values())
+
+
+def _flat_fieldnames(rows):
+    """
+    Find all the fieldnames used by flattened grants, in the order they first appear
+    """
+    fieldnames = OrderedDict()
+    for row in rows:
+        for f in row:
+            fieldnames[f] = None
+    return list(fieldnames)
+
+
+def _write_csv(f, fieldnames, rows, header=None):
+    """
+    Write flattened grants to a CSV file one row at a time
+
+    :param f: Either a file path or an open fileobj. A fileobj isn't closed afterwards
+    :param list fieldnames: the columns to include. Any other fields in the rows are left out
+    :param rows: iterator of flattened grants
+    :param dict header: the heading to use for each fieldname, if not the fieldname itself
+    """
+    closefile = False
+    if isinstance(f, str):
+        f = open(f, 'w')
+        closefile = True
+    try:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction='ignore')
+        if header is not None:
+            writer.writerow(header)
+        else:
+            writer.writeheader()
+        writer.writerows(rows)
+    finally:
+        if closefile:
+            f.close()
+
+
+def _export_stage(stage):
+    """
+    Decorator which times an export method as a stage in `self.stats`,
+    and counts the grants exported
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.stats.stage(stage):
+                grants = self.data.get(self.root_id)
+                self.stats.count('grants_exported', len(grants) if isinstance(grants, list) else 0)
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 class ThreeSixtyGiving:
 
     root_id = 'grants'
     schema_url = 'https://raw.githubusercontent.com/ThreeSixtyGiving/standard/master/schema/360-giving-package-schema.json'
+    grant_schema_url = 'https://raw.githubusercontent.com/ThreeSixtyGiving/standard/master/schema/360-giving-schema.json'
     user_agent = '360Giving data'
-
-    def __init__(self, data=None, schema_url=None, schema=None):
+    download_chunk_size = 64 * 1024
+    schema_cache = None  # a `SchemaCache` used to store schemas on disk
+    json_backend = None  # `orjson` or `json`, or None to use `orjson` if it is installed
+    collect_stats = False  # whether to record a `Stats` object for each object
+    stats_callback = None  # function called by `Stats` objects whenever a stage finishes
+    fast_validation = True  # whether to check grants with a compiled validator before using `jsonschema`
+
+    def __init__(self, data=None, schema_url=None, schema=None, schema_cache=None, stats=None):
+        self.stats = stats if stats is not None else self._new_stats()
+        if schema_cache is not None:
+            self.schema_cache = schema_cache
         self.schema = None
+        self.schema_source = None
         self.validator = None
+        self.grant_validator = None
+        self.package_validator = None
+        self.fast_grant_validator = None
         self.replace_names = OrderedDict()
+        self.fieldname_converter = None
+        # set when the data is already known to be valid (eg from a cache), so the
+        # schema is only fetched once it is needed (see `_fetch_deferred_schema()`)
+        self._schema_deferred = False
 
         if schema_url:
             self.schema_url = schema_url
@@ -43,54 +327,387 @@ class ThreeSixtyGiving:
         if schema:
             self.fetch_schema(schema=schema)
 
-        self.errors = []
-        self.valid = None
+        # setting the data also resets the results of validating it
         if data:
             self.data = data
         else:
             self.data = {}
 
+    @classmethod
+    def _new_stats(cls):
+        """
+        Create a `Stats` object if stats are being collected
+        """
+        if cls.collect_stats:
+            return Stats(callback=cls.stats_callback)
+        return NULL_STATS
+
+    @classmethod
+    def _stats(cls, kwargs):
+        """
+        Get the `Stats` object used while creating an object, adding it to the
+        keyword arguments so it is passed on to the new object
+        """
+        stats = kwargs.get('stats')
+        if stats is None:
+            stats = cls._new_stats()
+            if stats.enabled:
+                kwargs['stats'] = stats
+        return stats
+
+    @property
+    def data(self):
+        """
+        The 360Giving data package
+
+        Setting this resets `valid` and `errors`. If grants are changed in place then
+        use `mark_changed()` so they are checked again by `is_valid()`.
+        """
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self.errors = []
+        self.grant_errors = {}
+        self.errors_truncated = False
+        self.valid = None
+        self._package_errors = []
+        self._unique_error = None
+        self._changed = set()
+        self._grant_ids = None
+        self._id_positions = None
+        self._duplicate_ids = None
+        self._checked_length = None
+        self._indexes = None
+
     def __iter__(self):
         """
         Iterating the object yields grant objects for each of the loaded grants
+
+        The grant objects are views of the grants in `self.data` rather than
+        copies, so any changes made to them are made to the data too.
         """
         for g in self.data.get(self.root_id, []):
-            yield Grant(**g)
+            yield Grant.from_dict(g)
+
+    @property
+    def indexes(self):
+        """
+        A `GrantIndexes` object for the grants, which is created the first time it is used
+
+        The indexes are created again after the data is set or `mark_changed()` is called.
+        """
+        if self._indexes is None:
+            grants = self.data.get(self.root_id)
+            self._indexes = GrantIndexes(grants if isinstance(grants, list) else [])
+        return self._indexes
+
+    def _grants_at(self, positions):
+        grants = self.data[self.root_id]
+        return [Grant.from_dict(grants[i]) for i in positions]
+
+    def get(self, grant_id, default=None):
+        """
+        Find a grant by its identifier
+
+        :param str grant_id: the identifier of the grant
+        :param default: returned if there isn't a grant with the identifier
+        :return: the first grant with the identifier
+        :rtype: Grant
+        """
+        i = self.indexes.ids.get(grant_id)
+        if i is None:
+            return default
+        return Grant.from_dict(self.data[self.root_id][i])
+
+    def by_recipient(self, org_id):
+        """
+        Find the grants made to an organisation
+
+        :param str org_id: the identifier of the recipient organisation
+        :return: list of `Grant` objects
+        """
+        return self._grants_at(self.indexes.recipients.get(org_id, []))
+
+    def by_funder(self, org_id):
+        """
+        Find the grants made by an organisation
+
+        :param str org_id: the identifier of the funding organisation
+        :return: list of `Grant` objects
+        """
+        return self._grants_at(self.indexes.funders.get(org_id, []))
+
+    def awarded_between(self, start=None, end=None):
+        """
+        Find the grants awarded from `start` up to (but not including) `end`
+
+        :param start: date, datetime or ISO format string. If None there is no lower limit
+        :param end: date, datetime or ISO format string. If None there is no upper limit
+        :return: list of `Grant` objects, in order of award date
+        """
+        return self._grants_at(self.indexes.awarded_between(start, end))
+
+    def amount_between(self, minimum=None, maximum=None):
+        """
+        Find the grants with an amount awarded from `minimum` up to and including `maximum`
+
+        :param minimum: the lowest amount. If None there is no lower limit
+        :param maximum: the highest amount. If None there is no upper limit
+        :return: list of `Grant` objects, in order of amount
+        """
+        return self._grants_at(self.indexes.amount_between(minimum, maximum))
 
     @classmethod
-    def from_url(cls, url, filetype=None, **kwargs):
+    def from_url(cls, url, filetype=None, max_size=None, session=None, cache=None, **kwargs):
         """
         Fetches a 360Giving format file from an URL (using requests),
         guesses the filetype if not given, and then parses the file
+
+        The file is downloaded in chunks to a temporary file, so it is never
+        held in memory all at once. Compressed responses (using gzip or deflate)
+        are decompressed as they are downloaded.
+
+        If a `DatasetCache` is given then a conditional request is made using the
+        headers from the cached copy. If the file hasn't changed (the server responds
+        with `304 Not Modified`, or the downloaded file has the same hash) then the
+        cached data is used without parsing or validating the file again.
+
+        :param str url: URL of the file
+        :param str filetype: The type of file (one of ['csv', 'json', 'xlsx']), guessed if not given
+        :param int max_size: Maximum size of the (decompressed) file in bytes
+        :param session: `requests.Session` used to fetch the file
+        :param DatasetCache cache: cache used to store the results
+        :return: Object of this class with data loaded
+
+        Additional keyword arguments are passed to the opening methods
         """
+        return cls._from_url(url, filetype, max_size, session, cache, None, kwargs)
+
+    @classmethod
+    def _from_url(cls, url, filetype, max_size, session, cache, pool, kwargs):
+        """
+        Fetch and parse a file for `from_url()`. If `pool` is given then the file
+        is parsed and validated by a process in that `ProcessPoolExecutor`
+        """
+        # the same file is converted and validated differently with another schema
+        schema_url = kwargs.get('schema_url') or cls.schema_url
+        cached = cache.get(url, schema_url) if cache is not None else None
+        stats = cls._stats(kwargs)
 
         # Attempt to fetch the file
-        r = requests.get(url, headers={'User-Agent': cls.user_agent})
-        r.raise_for_status()
-
-        # work out the filetype if not given
-        if not filetype:
-            content_type = r.headers.get('content-type', '').split(';')[0].lower()
-            if content_type and content_type in CONTENT_TYPE_MAP:
-                filetype = CONTENT_TYPE_MAP[content_type]
-            elif 'content-disposition' in r.headers:
-                d = r.headers['content-disposition']
-                filetype = re.search('filename=(.+)', d)
-                if filetype:
-                    filetype = filetype[0].split('.')[-1].strip('"')
+        with stats.stage('download'), \
+                cls._request(url, session, cache.headers(url, schema_url) if cached else None) as r:
+            if r.status_code == 304 and cached:
+                return cls._from_cache(cache, url, schema_url, cached['valid'], **kwargs)
+
+            # work out the filetype if not given
+            if not filetype:
+                filetype = cls._guess_filetype(url, r.headers)
+
+            # write the content to a temporary file
+            sha256 = hashlib.sha256()
+            reader = DownloadReader(r, max_size, cls.download_chunk_size)
+            t_, t = tempfile.mkstemp(suffix='.{}'.format(filetype))
+            try:
+                with os.fdopen(t_, 'wb') as f_:
+                    for chunk in iter(lambda: reader.read(cls.download_chunk_size), b''):
+                        sha256.update(chunk)
+                        f_.write(chunk)
+                        stats.count('bytes_downloaded', len(chunk))
+            except Exception:
+                os.remove(t)
+                raise
+
+        try:
+            if cached and cached.get('sha256') == sha256.hexdigest():
+                # the file hasn't changed, but the server may have sent new headers for it
+                cache.update(
+                    url,
+                    schema_url,
+                    etag=r.headers.get('ETag'),
+                    last_modified=r.headers.get('Last-Modified'),
+                )
+                return cls._from_cache(cache, url, schema_url, cached['valid'], **kwargs)
+            if pool is None:
+                c = cls.from_file(t, filetype, **kwargs)
             else:
-                filetype = urlparse(url).path.split('.')[-1]
-            if filetype not in CONTENT_TYPE_MAP.values():
-                raise ValueError("Unrecognised file type [{}]".format(filetype))
-
-        # write the content to a temporary file
-        t_, t = tempfile.mkstemp(suffix='.{}'.format(filetype))
-        os.write(t_, r.content)
-        os.close(t_)
-        c = cls.from_file(t, filetype, **kwargs)
-        os.remove(t)
+                c = cls._from_worker(pool, t, filetype, kwargs)
+        finally:
+            os.remove(t)
+
+        if cache is not None:
+            cache.store(
+                url,
+                c.data,
+                valid=c.valid,
+                sha256=sha256.hexdigest(),
+                etag=r.headers.get('ETag'),
+                last_modified=r.headers.get('Last-Modified'),
+                schema_url=schema_url,
+            )
+        return c
+
+    @classmethod
+    def _from_cache(cls, cache, url, schema_url, valid, validate=True, workers=None,
+                    max_errors=None, fail_fast=False, **kwargs):
+        """
+        Create an object from the data stored in a `DatasetCache`
+
+        The file is only validated (and the schema fetched) if it wasn't validated
+        before it was cached. Otherwise the schema is fetched the first time it is
+        needed, eg by `is_valid()` after the data is changed or by `convert_fieldnames()`
+        """
+        c = cls(cache.load(url, schema_url), **{k: v for k, v in kwargs.items() if k in _INIT_KWARGS})
+        if validate and valid is None:
+            c.fetch_schema()
+            c.is_valid(workers=workers, max_errors=max_errors, fail_fast=fail_fast)
+            cache.update(url, schema_url, valid=c.valid)
+        elif valid is not None:
+            c._defer_schema(valid)
+        if validate and not c.valid:
+            raise ParseError("Invalid file", c.errors)
         return c
 
+    @classmethod
+    def _from_worker(cls, pool, f, filetype, kwargs):
+        """
+        Parse (and validate) a file using a process in `pool`, and create an object from the results
+        """
+        worker_kwargs = {k: v for k, v in kwargs.items() if k != 'stats'}
+        stats = kwargs.get('stats')
+        if stats is not None and stats.enabled:
+            # stats can't be shared between processes, so are added to `stats` afterwards
+            worker_kwargs['stats'] = Stats()
+        data, valid, errors, errors_truncated, worker_stats = pool.submit(
+            _load_downloaded_file, cls, f, filetype, worker_kwargs).result()
+
+        c = cls(data, **{k: v for k, v in kwargs.items() if k in _INIT_KWARGS})
+        if worker_stats is not None:
+            c.stats.merge(worker_stats)
+        if valid is not None:
+            c._defer_schema(valid, errors, errors_truncated)
+        return c
+
+    @classmethod
+    def from_urls(cls, urls, concurrency=4, processes=None, session=None, **kwargs):
+        """
+        Fetches and parses a number of 360Giving files from URLs at the same time
+
+        Files are fetched by a pool of `concurrency` threads, which share a
+        `requests.Session` so connections are reused. Each downloaded file is then
+        parsed and validated by one of a pool of `processes` processes, shared by all
+        the files. The schema is only fetched by the main process once it is needed
+        (eg when a grant is changed and checked again). Results are yielded as soon as each file is finished, so won't be
+        in the same order as `urls`. If the caller stops iterating through the
+        results then any files that haven't started yet aren't fetched.
+
+        :param list urls: URLs of the files
+        :param int concurrency: Maximum number of files fetched at once
+        :param int processes: Number of processes used to parse and validate the files (defaults to the number of CPUs)
+        :param session: `requests.Session` used to fetch the files
+        :return: Iterator of `(url, result)` tuples, where result is either an
+            object of this class or the exception raised when fetching the file
+
+        Additional keyword arguments (including `workers`, the number of processes
+        used to validate each file) are passed to `cls.from_url()`
+        """
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=concurrency, pool_maxsize=concurrency)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+        url_kwargs = {k: kwargs.pop(k) for k in ('filetype', 'max_size', 'cache') if k in kwargs}
+        # processes are only started once a file needs parsing
+        pool = ProcessPoolExecutor(max_workers=processes)
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            futures = {
+                executor.submit(
+                    cls._from_url, url, url_kwargs.get('filetype'), url_kwargs.get('max_size'),
+                    session, url_kwargs.get('cache'), pool, dict(kwargs)): url
+                for url in urls
+            }
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = e
+                yield futures[future], result
+        finally:
+            # if the caller stops early, don't fetch or parse the files that haven't started
+            executor.shutdown(wait=False, cancel_futures=True)
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    @classmethod
+    def iter_url(cls, url, max_size=None, session=None):
+        """
+        Streams the grants from a JSON format 360Giving file at an URL, parsing
+        them as they are downloaded rather than saving the file first
+
+        :param str url: URL of a JSON file
+        :param int max_size: Maximum size of the (decompressed) file in bytes
+        :param session: `requests.Session` used to fetch the file
+        :return: A `GrantStream` which yields a `Grant` object for each grant in the file
+        """
+        r = cls._request(url, session)
+        try:
+            filetype = cls._guess_filetype(url, r.headers)
+            if filetype != 'json':
+                raise ValueError("Only JSON files can be streamed, not [{}]".format(filetype))
+            return GrantStream(
+                DownloadReader(r, max_size, cls.download_chunk_size),
+                root_id=cls.root_id
+            )
+        except Exception:
+            r.close()
+            raise
+
+    @classmethod
+    def _request(cls, url, session=None, headers=None):
+        """
+        Start a streamed request for an URL, checking the response was successful
+        """
+        request_headers = {'User-Agent': cls.user_agent, 'Accept-Encoding': 'gzip, deflate'}
+        if headers:
+            request_headers.update(headers)
+        r = (session or requests).get(
+            url,
+            headers=request_headers,
+            stream=True,
+        )
+        try:
+            r.raise_for_status()
+        except requests.HTTPError:
+            r.close()
+            raise
+        return r
+
+    @classmethod
+    def _guess_filetype(cls, url, headers):
+        """
+        Work out the type of a file from the headers of the response, or the URL
+
+        Uses the content-type header if possible, then the filename in the
+        content-disposition header, then the extension of the URL
+        """
+        content_type = headers.get('content-type', '').split(';')[0].lower()
+        if content_type and content_type in CONTENT_TYPE_MAP:
+            filetype = CONTENT_TYPE_MAP[content_type]
+        elif 'content-disposition' in headers:
+            d = headers['content-disposition']
+            filetype = re.search('filename=(.+)', d)
+            if filetype:
+                filetype = filetype[0].split('.')[-1].strip('"')
+        else:
+            filetype = urlparse(url).path.split('.')[-1]
+        if filetype not in CONTENT_TYPE_MAP.values():
+            raise ValueError("Unrecognised file type [{}]".format(filetype))
+        return filetype
+
     @classmethod
     def from_file(cls, f, filetype, **kwargs):
         """
@@ -115,18 +732,20 @@ class ThreeSixtyGiving:
             return cls.from_excel(f, **kwargs)
 
     @classmethod
-    def from_csv(cls, f, encoding=None, **kwargs):
+    def from_csv(cls, f, encoding=None, engine='flattentool', **kwargs):
         """
         Opens a CSV format 360Giving file, and return an object for accessing the data
 
         :param str f: file path to be opened
         :param str encoding: will be passed to open(), will be guessed if not given
+        :param str engine: how to convert the file - either 'flattentool' or 'native' (see `cls.unflatten()`)
         :return: Object of this class with data loaded
 
         Additional keyword arguments are passed to `cls.to_json()` which is used to parse the converted file
-
-        @TODO: better version of unflatten which allows for returning the data not a temporary file
         """
+        stats = cls._stats(kwargs)
+        if engine == 'native':
+            return cls._from_rows(cls._csv_rows(f, encoding), **kwargs)
 
         # `flattentool.unflatten` is designed to accept a directory of CSV files
         # so need to create a dummy directory
@@ -141,58 +760,62 @@ class ThreeSixtyGiving:
         with open(destination, 'wb') as dest_write:
             dest_write.write(fileobj.read())
         if not encoding:
-            destfileobj, encoding = cls.guess_encoding(destination)
-            destfileobj.close()
+            with stats.stage('guess_encoding'):
+                destfileobj, encoding = cls.guess_encoding(destination)
+                destfileobj.close()
 
         json_file, json_output = tempfile.mkstemp(suffix='.json')
         os.close(json_file)
-        flattentool.unflatten(
-            tmp_dir,
-            output_name=json_output,
-            input_format="csv",
-            root_list_path=cls.root_id,
-            root_id='',
-            # @TODO: Need to better handle the schema here - there's duplication with the flattentool also fetching it
-            schema='https://raw.githubusercontent.com/ThreeSixtyGiving/standard/master/schema/360-giving-schema.json',
-            convert_titles=True,
-            encoding=encoding,
-            # I don't think this is used properly here
-            metatab_schema=cls.schema_url,
-            metatab_name='Meta',
-            metatab_vertical_orientation=True,
-        )
+        with stats.stage('unflatten'):
+            flattentool.unflatten(
+                tmp_dir,
+                output_name=json_output,
+                input_format="csv",
+                root_list_path=cls.root_id,
+                root_id='',
+                schema=cls._unflatten_schema(cls.grant_schema_url, kwargs.get('schema_cache')),
+                convert_titles=True,
+                encoding=encoding,
+                # I don't think this is used properly here
+                metatab_schema=cls._unflatten_schema(cls.schema_url, kwargs.get('schema_cache')),
+                metatab_name='Meta',
+                metatab_vertical_orientation=True,
+            )
         c = cls.from_json(json_output, **kwargs)
         os.remove(json_output)
         return c
 
     @classmethod
-    def from_excel(cls, f, **kwargs):
+    def from_excel(cls, f, engine='flattentool', **kwargs):
         """
         Opens an Excel format 360Giving file, and return an object for accessing the data
 
         :param str f: file path to an Excel file
+        :param str engine: how to convert the file - either 'flattentool' or 'native' (see `cls.unflatten()`)
         :return: Object of this class with data loaded
 
         Additional keyword arguments are passed to `cls.to_json()` which is used to parse the converted file
-
-        @TODO: better version of unflatten which allows for returning the data not a temporary file
         """
+        stats = cls._stats(kwargs)
+        if engine == 'native':
+            return cls._from_rows(cls._excel_rows(f), **kwargs)
+
         json_file, json_output = tempfile.mkstemp(suffix='.json')
         os.close(json_file)
-        flattentool.unflatten(
-            f,
-            output_name=json_output,
-            input_format="xlsx",
-            root_list_path=cls.root_id,
-            root_id='',
-            # @TODO: Need to better handle the schema here - there's duplication with the flattentool also fetching it
-            schema='https://raw.githubusercontent.com/ThreeSixtyGiving/standard/master/schema/360-giving-schema.json',
-            convert_titles=True,
-            # I don't think this is used properly here
-            metatab_schema=cls.schema_url,
-            metatab_name='Meta',
-            metatab_vertical_orientation=True,
-        )
+        with stats.stage('unflatten'):
+            flattentool.unflatten(
+                f,
+                output_name=json_output,
+                input_format="xlsx",
+                root_list_path=cls.root_id,
+                root_id='',
+                schema=cls._unflatten_schema(cls.grant_schema_url, kwargs.get('schema_cache')),
+                convert_titles=True,
+                # I don't think this is used properly here
+                metatab_schema=cls._unflatten_schema(cls.schema_url, kwargs.get('schema_cache')),
+                metatab_name='Meta',
+                metatab_vertical_orientation=True,
+            )
         c = cls.from_json(json_output, **kwargs)
         os.remove(json_output)
         return c
@@ -200,56 +823,316 @@ class ThreeSixtyGiving:
     from_xlsx = from_excel  # alias for to_excel
 
     @classmethod
-    def from_json(cls, f, validate=True, **kwargs):
+    def iter_csv(cls, f, encoding=None, **kwargs):
+        """
+        Streams the grants from a CSV format 360Giving file one row at a time,
+        without loading the whole file into memory
+
+        :param str f: file path to be opened, or a file-like object
+        :param str encoding: will be passed to open(), will be guessed if not given
+        :return: Iterator of `Grant` objects
+
+        Additional keyword arguments are passed to `cls.__init__()` to find the schema.
+        The grants aren't validated.
+        """
+        c = cls(**kwargs)
+        c.fetch_schema()
+        for g in c.unflatten(cls._csv_rows(f, encoding)):
+            yield Grant.from_dict(g)
+
+    @classmethod
+    def iter_excel(cls, f, **kwargs):
+        """
+        Streams the grants from an Excel format 360Giving file one row at a time,
+        without converting the whole file first
+
+        :param str f: file path to an Excel file, or a file-like object
+        :return: Iterator of `Grant` objects
+
+        Additional keyword arguments are passed to `cls.__init__()` to find the schema.
+        The grants aren't validated.
+        """
+        c = cls(**kwargs)
+        c.fetch_schema()
+        for g in c.unflatten(cls._excel_rows(f)):
+            yield Grant.from_dict(g)
+
+    iter_xlsx = iter_excel  # alias for iter_excel
+
+    @classmethod
+    def _from_rows(cls, rows, validate=True, workers=None,
+                   max_errors=None, fail_fast=False, **kwargs):
+        """
+        Create an object from the rows of a flat file using `cls.unflatten()`
+        """
+        c = cls(**kwargs)
+        c.fetch_schema()
+        with c.stats.stage('unflatten'):
+            c.data = {cls.root_id: list(c.unflatten(rows))}
+        c.stats.count('grants_loaded', len(c.data[cls.root_id]))
+        if validate:
+            if not c.is_valid(workers=workers, max_errors=max_errors, fail_fast=fail_fast):
+                raise ParseError("Invalid file", c.errors)
+        return c
+
+    @classmethod
+    def _csv_rows(cls, f, encoding=None):
+        """
+        Yield the rows of a CSV file as lists of values
+        """
+        if isinstance(f, str):
+            if encoding:
+                fileobj = open(f, encoding=encoding, newline='')
+            else:
+                fileobj, encoding = cls.guess_encoding(f)
+            with fileobj:
+                yield from csv.reader(fileobj)
+        elif isinstance(f, io.TextIOBase):
+            yield from csv.reader(f)
+        else:
+            fileobj = io.TextIOWrapper(f, encoding=encoding or ENCODINGS_TO_CHECK[0], newline='')
+            try:
+                yield from csv.reader(fileobj)
+            finally:
+                # don't close the file we've been given
+                fileobj.detach()
+
+    @classmethod
+    def _excel_rows(cls, f):
+        """
+        Yield the rows of the grants sheet in an Excel file as lists of values
+
+        Uses the sheet with the same name as `cls.root_id` if there is one,
+        otherwise the first sheet.
+        """
+        import openpyxl
+
+        workbook = openpyxl.load_workbook(f, read_only=True, data_only=True)
+        try:
+            if cls.root_id in workbook.sheetnames:
+                worksheet = workbook[cls.root_id]
+            else:
+                worksheet = workbook.worksheets[0]
+            for row in worksheet.iter_rows():
+                yield [cell.value for cell in row]
+        finally:
+            workbook.close()
+
+    def unflatten(self, rows):
+        """
+        Turn the rows of a flat file into grants, one row at a time
+
+        This is an alternative to `flattentool` which works with the rows in memory
+        rather than converting the file to JSON. The column headings are matched against
+        the titles and field names in the schema fetched by `fetch_schema`, and values are
+        converted to the type given in the schema. Only files with all the data on one
+        sheet are supported.
+
+        :param rows: iterable of rows (lists of values), the first row containing the column headings
+        :return: Iterator of grants as dicts
+        """
+        if self.schema is None:
+            raise ValueError("No schema available to unflatten")
+        return Unflattener(self.schema['properties'][self.root_id]['items']).unflatten(rows)
+
+    @classmethod
+    def _unflatten_schema(cls, url, schema_cache=None):
+        """
+        Get the schema to give to `flattentool.unflatten`
+
+        If a schema cache is available this is the path to a local copy of the
+        schema, otherwise flattentool will fetch it from the URL
+        """
+        if schema_cache is None:
+            schema_cache = cls.schema_cache
+        if schema_cache is None:
+            return url
+        return schema_cache.path(url)
+
+    @classmethod
+    def from_json(cls, f, validate=True, workers=None,
+                  max_errors=None, fail_fast=False, **kwargs):
         """
         Opens a json format 360Giving file, and return an object for accessing the data
 
+        The file is parsed using the JSON backend in `cls.json_backend` (`orjson`
+        if it is installed). Files are read as bytes, and the encoding is only
+        guessed if they aren't in UTF-8 (or UTF-16/32 with the standard library).
+
         :param str f: file path to an json file or a file-like object with a `read()` method
         :param bool validate: Whether to validate the file after the data is loaded
+        :param int workers: If more than 1, the number of processes used to validate the file
+        :param int max_errors: Stop validating once this many errors have been found
+        :param bool fail_fast: Stop validating at the first error
         :return: Object of this class with data loaded
 
         Additional keyword arguments are passed to `cls.__init__()` to produce the data
         """
-        opened_file = False
-        if isinstance(f, str):
-            fileobj, encoding = cls.guess_encoding(f)
-            opened_file = True
-        else:
-            fileobj = f
-        c = cls(json.load(fileobj), **kwargs)
-        if opened_file:
-            fileobj.close()
+        backend = get_json_backend(cls.json_backend)
+        stats = cls._stats(kwargs)
+        with stats.stage('parse_json'):
+            if isinstance(f, str):
+                with open(f, 'rb') as fileobj:
+                    content = fileobj.read()
+                stats.count('bytes_read', len(content))
+                try:
+                    data = backend.loads(content)
+                except ValueError:
+                    # not in a unicode encoding, so decode it before parsing
+                    del content
+                    with stats.stage('guess_encoding'):
+                        fileobj, encoding = cls.guess_encoding(f)
+                    with fileobj:
+                        data = backend.loads(fileobj.read())
+            else:
+                data = backend.loads(f.read())
+        if isinstance(data, dict) and isinstance(data.get(cls.root_id), list):
+            stats.count('grants_loaded', len(data[cls.root_id]))
+        c = cls(data, **kwargs)
+        if validate:
+            c.fetch_schema()
+            if not c.is_valid(workers=workers, max_errors=max_errors, fail_fast=fail_fast):
+                raise ParseError("Invalid file", c.errors)
+        return c
+
+    @classmethod
+    def from_parquet(cls, f, validate=False, workers=None,
+                     max_errors=None, fail_fast=False, **kwargs):
+        """
+        Opens a Parquet file created by `to_parquet()`, and return an object for accessing the data
+
+        The package-level fields and whether the data was valid are stored in the
+        file, so the data doesn't need to be validated again.
+
+        :param str f: file path to a Parquet file or a binary file-like object
+        :param bool validate: Whether to validate the data again after it is loaded
+        :param int workers: If more than 1, the number of processes used to validate the file
+        :param int max_errors: Stop validating once this many errors have been found
+        :param bool fail_fast: Stop validating at the first error
+        :return: Object of this class with data loaded
+        :raises: ImportError if pyarrow is not installed
+
+        Additional keyword arguments are passed to `cls.__init__()` to produce the data
+        """
+        import pyarrow.parquet
+        grants, metadata = table_to_grants(pyarrow.parquet.read_table(f))
+        metadata = metadata or {}
+
+        data = OrderedDict(metadata.get('package') or {})
+        data[cls.root_id] = grants
+        if metadata.get('schema_url'):
+            kwargs.setdefault('schema_url', metadata['schema_url'])
+        c = cls(data, **kwargs)
         if validate:
             c.fetch_schema()
-            if not c.is_valid():
+            if not c.is_valid(workers=workers, max_errors=max_errors, fail_fast=fail_fast):
                 raise ParseError("Invalid file", c.errors)
+        elif metadata.get('valid') is not None:
+            # the schema is fetched if the data is changed and checked again
+            c._defer_schema(metadata['valid'])
         return c
 
     @classmethod
-    def guess_encoding(cls, f, encodings=None):
+    def iter_json(cls, f):
+        """
+        Streams the grants from a json format 360Giving file without loading
+        the whole file into memory
+
+        :param str f: file path to an json file or a binary file-like object with a `read()` method
+        :return: A `GrantStream` which yields a `Grant` object for each grant in the file
+
+        Any package-level fields (everything outside the `grants` array) are
+        available through the `metadata` attribute of the stream. Fields that
+        come after the grants in the file are only available once the stream
+        has been fully iterated.
+        """
+        return GrantStream(f, root_id=cls.root_id)
+
+    @classmethod
+    def lazy_json(cls, f, save_index=False, index_path=None):
+        """
+        Opens a json format 360Giving file without parsing it, giving access to the
+        grants by position
+
+        Each grant is only parsed when it is used, using the JSON backend in
+        `cls.json_backend`. An index of where each grant is in the file is built as
+        the file is used, and can be saved so it is quicker to open the file again.
+
+        :param str f: file path to a json file in UTF-8
+        :param bool save_index: Whether to save the index once the whole file has been scanned
+        :param str index_path: where to save the index. Defaults to the path of the file with `.idx` added
+        :return: A `LazyGrants` sequence, which supports `len()`, indexing and slicing
+        """
+        from .lazy import LazyGrants
+        return LazyGrants(f, root_id=cls.root_id, save_index=save_index,
+                          index_path=index_path, json_backend=cls.json_backend)
+
+    @classmethod
+    def guess_encoding(cls, f, encodings=None, sample_size=None, min_confidence=0.5):
         """
         Given a file will try to work out the encoding, based on running through
         a list of encodings and seeing whether any UnicodeDecodeErrors occur.
 
-        :param str f: path of the file to test
-        :param list(str) encodings: list of encodings to test
-        :return: Best guess at the file encoding
-        :rtype: str
+        Each encoding is checked by decoding the file in chunks, stopping at the
+        first error, so the decoded text is never held in memory. By default the
+        whole file is checked - pass `sample_size` to only check the start of the
+        file, which is faster but could miss characters further on.
+
+        If none of the encodings work then the sample is passed to `charset_normalizer`
+        (or `chardet`) if available, and its guess is used if the confidence is
+        at least `min_confidence`.
 
-        @TODO: Could be more efficient by just opening the first part of the file
+        :param f: path of the file to test, the contents of the file as bytes, or a binary file-like object
+        :param list(str) encodings: list of encodings to test
+        :param int sample_size: maximum number of bytes to check
+        :param float min_confidence: minimum confidence needed to use a detected encoding
+        :return: tuple of an open text file object and the best guess at the file encoding, or None if no encoding is found.
+            The text file object is opened with `newline=''` (so it can be passed to `csv.reader`), and
+            closing it leaves a file object that was passed in open
+        :rtype: tuple
         """
         if encodings is None:
             encodings = ENCODINGS_TO_CHECK
 
+        if isinstance(f, io.TextIOBase):
+            return f, getattr(f, 'encoding', None)
+        if isinstance(f, (bytes, bytearray)):
+            fileobj = io.BytesIO(f)
+        elif isinstance(f, str):
+            fileobj = open(f, 'rb')
+        else:
+            fileobj = f
+        start = fileobj.tell()
+
+        encoding = None
         for e in encodings:
             try:
-                encoding_file = open(f, encoding=e)
-                encoding_file.read()
-                encoding_file.seek(0)
-                return encoding_file, e
-            except UnicodeDecodeError:
+                decoder = codecs.getincrementaldecoder(e)()
+            except LookupError:
+                # not all encodings are available on every system
                 continue
-        return None
+            fileobj.seek(start)
+            if _decodes(fileobj, decoder, sample_size):
+                encoding = e
+                break
+
+        if encoding is None:
+            fileobj.seek(start)
+            encoding = _detect_encoding(
+                fileobj.read(sample_size or ENCODING_DETECT_SIZE), min_confidence)
+
+        fileobj.seek(start)
+        if encoding is None:
+            if isinstance(f, str):
+                fileobj.close()
+            return None
+        if isinstance(f, str):
+            fileobj.close()
+            return open(f, encoding=encoding, newline=''), encoding
+        if fileobj is f:
+            # the file object belongs to the caller, so closing the wrapper mustn't close it
+            return _BorrowedTextIOWrapper(fileobj, encoding=encoding, newline=''), encoding
+        return io.TextIOWrapper(fileobj, encoding=encoding, newline=''), encoding
 
     def fetch_schema(self, schema_url=None, schema=None):
         """
@@ -258,7 +1141,12 @@ class ThreeSixtyGiving:
         As well as fetching the initial schema file, the function will also:
          - replace any references in the schema with the actual definitions (using JsonRed)
          - use `jsonschema` to create a validator that can be used to check documents against the schema
-         - create a dictionary of field name conversions (as regex) that can be used to replace field names with more user friendly ones
+         - create a second validator for the schema of an individual grant, used to check grants one at a time
+         - create a third validator for the package without the individual grants (or the check that they are unique), used when checking grants in parallel
+         - compile the schema for an individual grant into a function that quickly checks whether a grant is valid (see `fastvalidator`)
+         - create a dictionary of field name conversions (as regex), and a faster converter built from the same names, that can be used to replace field names with more user friendly ones
+
+        These are shared with any other object that has used the same schema (see `compile_schema`).
 
         The order of preference for loading a schema is:
 
@@ -267,56 +1155,50 @@ class ThreeSixtyGiving:
         3. A schema fetched from schema_url provided to this method
         4. A schema fetched from the schema_url provided to this object
 
+        If `self.schema_cache` is set then schemas (and any references in them)
+        are loaded through the cache rather than being fetched every time.
+
         :param str schema_url: URL of a JSON schema
         :param dict schema: dictionary containing a JSON schema
         :return: The full schema
         """
-
-        # if no schema_url given then use the default one
-        if schema_url is None:
-            schema_url = self.schema_url
-
-        # if no schema is given or present already then load from URL
-        if self.schema is None and schema is None:
-            self.schema = requests.get(schema_url).json()
-
-        # else if a schema has been given then use that one
-        elif schema is not None:
-            self.schema = schema
-
-        if self.schema is None:
-            raise ValueError("No schema found")
-
-        # fetch the whole schema including references
-        self.schema = JsonRef.replace_refs(self.schema)
-
-        # create a validator
-        self.validator = Draft4Validator(
-            self.schema, format_checker=FormatChecker())
-
-        # recursively find property names and titles
-        def recurse_names(props, replace_names=OrderedDict(), prefix_k='', prefix_v=''):
-            for i, prop in props.items():
-                name_k = '{}.([0-9]+).{}'.format(prefix_k, i) if prefix_k != '' else i
-                name_v = '{}:\\1:{}'.format(prefix_v, prop.get(
-                    "title", i)) if prefix_v != '' else prop.get("title", i)
-                if prop.get("type") == 'array':
-                    replace_names = recurse_names(
-                        prop.get("items", {}).get("properties", {}),
-                        replace_names,
-                        name_k,
-                        name_v
-                    )
+        with self.stats.stage('fetch_schema'):
+            # if no schema_url given then use the default one
+            if schema_url is None:
+                schema_url = self.schema_url
+
+            # if a schema has been given then use that one, otherwise
+            # use the one already present
+            if schema is None:
+                schema = self.schema_source
+
+            # if no schema is given or present already then load from URL
+            if schema is None:
+                if self.schema_cache is not None:
+                    schema = self.schema_cache.get(schema_url)
                 else:
-                    replace_names[name_k] = name_v
-            return replace_names
-
-        self.replace_names = recurse_names(
-            self.schema['properties'][self.root_id]['items']['properties'],
-            self.replace_names
-        )
-
-        return self.schema
+                    schema = requests.get(schema_url).json()
+
+            if schema is None:
+                raise ValueError("No schema found")
+
+            # reuse the references, validators and names if this schema has been seen before
+            compiled = compile_schema(
+                schema,
+                schema_url=schema_url,
+                root_id=self.root_id,
+                loader=self.schema_cache.get if self.schema_cache is not None else None,
+            )
+            self.schema_source = schema
+            self.schema = compiled.schema
+            self.validator = compiled.validator
+            self.grant_validator = compiled.grant_validator
+            self.package_validator = compiled.package_validator
+            self.fast_grant_validator = compiled.fast_grant_validator
+            self.replace_names = compiled.replace_names
+            self.fieldname_converter = compiled.fieldname_converter
+
+            return self.schema
 
 
     def get_errors(self, data=None):
@@ -334,31 +1216,414 @@ class ThreeSixtyGiving:
         if data is None:
             data = self.data
 
+        fast_validator = self._fast_validator()
+        if fast_validator is not None and isinstance(data, dict) and \
+                isinstance(data.get(self.root_id), list):
+            yield from self._get_errors_fast(data, fast_validator)
+            return
+
         for e in self.validator.iter_errors(data):
-            # ignore error where the datetime value is one of a type
-            if e.validator == 'oneOf' and e.validator_value[0] == {'format': 'date-time'}:
+            if _ignore_error(e):
+                continue
+            yield e
+
+    def _fast_validator(self):
+        """
+        Get the compiled validator for grants, if it is being used
+        """
+        return self.fast_grant_validator if self.fast_validation else None
+
+    def _get_errors_fast(self, data, fast_validator):
+        """
+        Validate a dataset using the compiled validator to check each grant
+
+        The full `jsonschema` validator is only used to find the errors in grants that
+        aren't valid. Package-level errors come first, then the errors in each grant,
+        followed by an error if the grants must be unique but aren't.
+        """
+        for e in self.package_validator.iter_errors(data):
+            if _ignore_error(e):
+                continue
+            yield e
+
+        grants = data[self.root_id]
+        for i, grant in enumerate(grants):
+            for e in _iter_grant_errors(grant, self.grant_validator, fast_validator):
+                e.path.extendleft([i, self.root_id])
+                yield e
+
+        unique = self.schema['properties'][self.root_id].get('uniqueItems', False)
+        if unique and _has_duplicates(grants):
+            yield self._non_unique_error(grants, unique)
+
+    def iter_grant_errors(self, grants=None):
+        """
+        Validate grants one at a time against the schema for an individual grant,
+        yielding any errors as soon as they are found
+
+        Unlike `get_errors` this doesn't need the whole package to be loaded, so
+        can be used with the output of `iter_json` to check very large files.
+        Package-level rules (eg that the `grants` array isn't empty) aren't checked.
+
+        :param grants: An iterable of grants (as dicts, `Grant` objects or a `GrantStream`). Defaults to the grants in this object
+        :return: Iterator of `(index, grant_id, error)` tuples for any errors found
+        """
+        if self.grant_validator is None:
+            raise ValueError("No schema available to check")
+
+        if grants is None:
+            grants = self.data.get(self.root_id, [])
+        elif isinstance(grants, GrantStream):
+            grants = grants.iter_raw()
+
+        fast_validator = self._fast_validator()
+        for i, grant in enumerate(grants):
+            if isinstance(grant, Grant):
+                grant = grant.__dict__
+            for e in _iter_grant_errors(grant, self.grant_validator, fast_validator):
+                yield (i, grant.get('id'), e)
+
+    def get_errors_parallel(self, data=None, workers=None, chunk_size=None):
+        """
+        Validate a dataset using a pool of processes, yielding any errors that result
+
+        The grants are split into chunks which are checked in separate processes,
+        with each process creating its own validator. Errors are yielded in the
+        same order as the grants, with package-level errors first. If the schema
+        requires grants to be unique, duplicates are found by comparing a digest
+        of each grant and reported after the other errors.
+
+        :param dict data: Data to check for errors
+        :param int workers: Number of processes to use (defaults to the number of CPUs)
+        :param int chunk_size: Number of grants sent to a process at a time
+        :return: Iterator of any errors found in the data
+        """
+        if self.schema is None or self.package_validator is None:
+            raise ValueError("No schema available to check")
+
+        if data is None:
+            data = self.data
+
+        for e in self.package_validator.iter_errors(data):
+            if _ignore_error(e):
                 continue
             yield e
 
-    def is_valid(self):
+        grants = data.get(self.root_id, [])
+        if not isinstance(grants, list) or not grants:
+            return
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if chunk_size is None:
+            # aim for a few chunks per process to even out the work
+            chunk_size = max(1, -(-len(grants) // (workers * 4)))
+
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_validation_worker,
+                initargs=(_resolve_refs(self.schema['properties'][self.root_id]['items']),
+                          self._fast_validator() is not None)) as executor:
+            unique = self.schema['properties'][self.root_id].get('uniqueItems', False)
+            futures = [
+                executor.submit(_validate_grants, self.root_id, i, grants[i:i + chunk_size], unique)
+                for i in range(0, len(grants), chunk_size)
+            ]
+            seen = set()
+            duplicates = False
+            try:
+                for future in futures:
+                    errors, digests = future.result()
+                    yield from errors
+                    for d in digests:
+                        duplicates = duplicates or d in seen
+                        seen.add(d)
+            finally:
+                # if the caller stops early (eg `is_valid()` has found enough
+                # errors) don't wait for the chunks that haven't started
+                for future in futures:
+                    future.cancel()
+
+        if duplicates:
+            yield self._non_unique_error(grants, unique)
+
+    def _non_unique_error(self, grants, unique):
+        """
+        The error for when the schema requires grants to be unique but some aren't
+        """
+        return ValidationError(
+            "{} has non-unique elements".format(self.root_id),
+            validator='uniqueItems',
+            validator_value=unique,
+            instance=grants,
+            schema=self.schema['properties'][self.root_id],
+            path=[self.root_id],
+            schema_path=['properties', self.root_id, 'uniqueItems'],
+        )
+
+    def _defer_schema(self, valid, errors=(), errors_truncated=False):
+        """
+        Record the result of validating the data somewhere else (eg in a cache or
+        another process), leaving the schema to be fetched when it is first needed
+        """
+        self.errors = list(errors)
+        self.errors_truncated = errors_truncated
+        self.valid = valid
+        self._split_errors()
+        if self.schema is None:
+            self._schema_deferred = True
+
+    def _fetch_deferred_schema(self):
+        """
+        Fetch the schema if fetching it was put off by `_defer_schema()`
+        """
+        if self._schema_deferred:
+            self._schema_deferred = False
+            if self.schema is None:
+                self.fetch_schema()
+
+    def is_valid(self, workers=None, max_errors=None, fail_fast=False):
         """
         Check whether the current object has a valid file against the schema
 
+        The first time this is called the whole dataset is checked. After that only
+        grants that have changed (see `mark_changed()`) are checked again, and their
+        errors replace the ones found before.
+
+        The errors are kept in `self.errors` as `ErrorRecord` objects. If `max_errors`
+        (or `fail_fast`) is given then checking stops once that many errors have been
+        found, and `self.errors_truncated` is set to True. Calling this again with a
+        bigger `max_errors` (or none) checks the whole dataset again to find the rest.
+
+        :param int workers: If more than 1, the number of processes used to validate the grants in parallel
+        :param int max_errors: Stop checking once this many errors have been found
+        :param bool fail_fast: Stop checking at the first error (the same as `max_errors=1`)
         :return: True|False whether the file is valid or not. Returns None if validity hasn't been checked (eg not data)
         :rtype: bool or None
         """
+        if fail_fast:
+            max_errors = 1
+
+        if self.valid is not None and self.errors_truncated and \
+                (max_errors is None or max_errors > len(self.errors)):
+            # checking stopped early last time, and more errors have been asked for
+            self.mark_changed()
+
+        if self._changed or self._grants_resized() or (self.valid is None and self.data):
+            self._fetch_deferred_schema()
+
+        if self.valid is not None and (self._changed or self._grants_resized()):
+            with self.stats.stage('revalidate'):
+                self.stats.count('grants_validated', len(self._changed))
+                self._revalidate(max_errors)
+
         if self.valid is None and self.data:
-            self.errors = list(self.get_errors(self.data))
-            self.valid = len(self.errors) == 0
+            with self.stats.stage('validate'):
+                grants = self.data.get(self.root_id)
+                self.stats.count('grants_validated', len(grants) if isinstance(grants, list) else 0)
+                if workers and workers > 1:
+                    errors = self.get_errors_parallel(self.data, workers=workers)
+                else:
+                    errors = self.get_errors(self.data)
+                self._collect_errors(errors, max_errors)
+                self.valid = len(self.errors) == 0
+                self._split_errors()
 
         return self.valid
 
-    def to_json(self, f):
+    def _collect_errors(self, errors, max_errors=None):
+        """
+        Keep a record of each error in `self.errors`, stopping once there are `max_errors`
+        """
+        self.errors = []
+        self.errors_truncated = False
+        for e in errors:
+            self.errors.append(ErrorRecord.from_error(e, self.root_id))
+            if max_errors is not None and len(self.errors) >= max_errors:
+                self.errors_truncated = True
+                # stop the validator (and any worker processes) from doing any more
+                errors.close()
+                break
+
+    def mark_changed(self, *indexes):
+        """
+        Record that grants have been changed, so they are checked again the next time `is_valid()`
+        is called, and the indexes used by `get()` and the other lookups are created again
+
+        :param int indexes: The positions of the grants that have changed. If none are
+            given then the whole dataset (eg package-level fields) is treated as changed
+            and is checked again. The whole dataset is also checked again if grants
+            have been added or removed
+        """
+        self._indexes = None
+        if not indexes:
+            self.valid = None
+            self._changed = set()
+            return
+        self._changed.update(indexes)
+
+    def set_grant(self, index, grant):
+        """
+        Replace a grant, marking it as changed
+
+        :param int index: The position of the grant
+        :param grant: The new grant (as a dict or `Grant` object)
+        """
+        if isinstance(grant, Grant):
+            grant = grant.to_dict()
+        self.data[self.root_id][index] = grant
+        self.mark_changed(index)
+
+    def update_grant(self, index, fields):
+        """
+        Change the fields of a grant, marking it as changed
+
+        :param int index: The position of the grant
+        :param dict fields: The fields to set
+        """
+        self.data[self.root_id][index].update(fields)
+        self.mark_changed(index)
+
+    def _split_errors(self):
+        """
+        Sort the errors from checking the whole dataset into the errors for each grant,
+        so they can be replaced when grants are checked again
+        """
+        self.grant_errors = {}
+        self._package_errors = []
+        self._unique_error = None
+        self._changed = set()
+        self._id_positions = None
+        grants = self.data.get(self.root_id)
+        # grants added or removed since then means everything is checked again
+        self._checked_length = len(grants) if isinstance(grants, list) else None
+        for e in self.errors:
+            if e.grant_index is not None:
+                self.grant_errors.setdefault(e.grant_index, []).append(e)
+            elif e.path == (self.root_id,) and e.validator == 'uniqueItems':
+                self._unique_error = e
+            else:
+                self._package_errors.append(e)
+
+    def _grants_resized(self):
+        """
+        Whether grants have been added or removed since all the grants were last checked
+        """
+        grants = self.data.get(self.root_id)
+        return self._checked_length is not None and \
+            (not isinstance(grants, list) or len(grants) != self._checked_length)
+
+    def _revalidate(self, max_errors=None):
+        """
+        Check the grants that have changed since the data was last checked, keeping
+        only the first `max_errors` errors in `self.errors`
+        """
+        grants = self.data.get(self.root_id)
+        if self.grant_validator is None or not isinstance(grants, list) or \
+                (not self.valid and not self.errors) or self.errors_truncated or \
+                self._grants_resized() or \
+                any(i >= len(grants) or i < -len(grants) for i in self._changed):
+            # can't check the grants one at a time (or don't know the errors for the
+            # other grants, or grants have been added or removed), so check everything
+            self.mark_changed()
+            return
+
+        changed = sorted(i % len(grants) for i in self._changed)
+        self._changed = set()
+        fast_validator = self._fast_validator()
+        for i in changed:
+            errors = []
+            for e in _iter_grant_errors(grants[i], self.grant_validator, fast_validator):
+                e.path.extendleft([i, self.root_id])
+                errors.append(ErrorRecord.from_error(e, self.root_id))
+            if errors:
+                self.grant_errors[i] = errors
+            else:
+                self.grant_errors.pop(i, None)
+
+        unique = self.schema['properties'][self.root_id].get('uniqueItems', False)
+        if unique:
+            self._check_unique(grants, changed, unique)
+
+        self.errors = list(self._package_errors)
+        for i in sorted(self.grant_errors):
+            self.errors.extend(self.grant_errors[i])
+        if self._unique_error is not None:
+            self.errors.append(self._unique_error)
+        self.valid = len(self.errors) == 0
+        if max_errors is not None and len(self.errors) > max_errors:
+            self.errors = self.errors[:max_errors]
+            self.errors_truncated = True
+
+    def _check_unique(self, grants, changed, unique):
+        """
+        Check whether the grants are still unique after some have changed
+
+        Identical grants must have the same identifier, so only grants which share
+        an identifier with a changed grant need to be compared. The positions of the
+        grants with each identifier are found the first time this is used, and
+        kept up to date as grants change.
+        """
+        if self._id_positions is None:
+            self._grant_ids = [_grant_key(g) for g in grants]
+            self._id_positions = {}
+            for i, grant_id in enumerate(self._grant_ids):
+                positions = self._id_positions.get(grant_id)
+                if positions is None:
+                    self._id_positions[grant_id] = {i}
+                else:
+                    positions.add(i)
+            if self._unique_error is None:
+                # the grants were unique when they were all checked
+                self._duplicate_ids = set()
+            else:
+                self._duplicate_ids = set(
+                    grant_id for grant_id, positions in self._id_positions.items()
+                    if len(positions) > 1 and not _unique([grants[i] for i in positions]))
+
+        to_check = set()
+        for i in changed:
+            old_id = self._grant_ids[i]
+            new_id = _grant_key(grants[i])
+            if old_id != new_id:
+                self._id_positions[old_id].discard(i)
+                self._id_positions.setdefault(new_id, set()).add(i)
+                self._grant_ids[i] = new_id
+            to_check.update([old_id, new_id])
+
+        for grant_id in to_check:
+            positions = self._id_positions.get(grant_id, ())
+            if len(positions) > 1 and not _unique([grants[i] for i in positions]):
+                self._duplicate_ids.add(grant_id)
+            else:
+                self._duplicate_ids.discard(grant_id)
+
+        if not self._duplicate_ids:
+            self._unique_error = None
+        elif self._unique_error is None:
+            self._unique_error = ErrorRecord.from_error(
+                self._non_unique_error(grants, unique), self.root_id)
+
+    @_export_stage('export_json')
+    def to_json(self, f, compact=False):
         """
         Convert data into a JSON file
 
         :param f: Either a file path or an open fileobj. If a fileobj is provided it won't close it afterwards
+        :param bool compact: Whether to leave out the indentation and spaces. Compact
+            files are written using the JSON backend in `self.json_backend` (`orjson` if it is installed)
         """
+        if compact:
+            content = get_json_backend(self.json_backend).dumps(self.data)
+            if isinstance(f, str):
+                with open(f, 'wb') as fileobj:
+                    fileobj.write(content)
+            elif isinstance(f, io.TextIOBase):
+                f.write(content.decode('utf8'))
+            else:
+                f.write(content)
+            return
+
         closefile = False
         if isinstance(f, str):
             f = open(f, 'w')
@@ -367,6 +1632,66 @@ class ThreeSixtyGiving:
         if closefile:
             f.close()
 
+    def iter_flat(self):
+        """
+        Yield each grant as a "flat" dict, one at a time
+
+        The dicts will have keys that represent the path to the value
+        in the nested object (eg grants['recipientOrganization'][0]['name']
+        is turned into `recipientOrganization.0.name`)
+
+        :return: Iterator of flattened grants
+        """
+        for g in self:
+            yield g.to_flat()
+
+    def _flat_columns(self, missing=None):
+        """
+        Flatten the grants into columns, without creating a dict for each grant
+
+        The fieldnames are the same as those used by `iter_flat()`, in the order they first appear.
+
+        :param missing: the value used where a grant doesn't have a field
+        :return: OrderedDict of fieldnames and lists of values
+        """
+        columns = OrderedDict()
+        row = 0
+
+        def flatten(vals, prefix):
+            items = enumerate(vals) if isinstance(vals, list) else vals.items()
+            for k, v in items:
+                key = prefix + k if isinstance(k, str) else prefix + str(k)
+                if isinstance(v, (list, dict)):
+                    flatten(v, key + '.')
+                    continue
+                column = columns.get(key)
+                if column is None:
+                    column = columns[key] = [missing] * row
+                elif len(column) < row:
+                    column.extend([missing] * (row - len(column)))
+                elif len(column) > row:
+                    # the same fieldname twice in a grant (eg `a.0` and `a: [...]`), so the last one is kept
+                    column[-1] = v
+                    continue
+                column.append(v)
+
+        for g in self.data.get(self.root_id, []):
+            flatten(g, '')
+            row += 1
+        for column in columns.values():
+            if len(column) < row:
+                column.extend([missing] * (row - len(column)))
+        return columns
+
+    def flat_fieldnames(self):
+        """
+        Find all the fieldnames used by the flattened grants, in the order they first appear
+
+        :return: List of fieldnames
+        :rtype: list
+        """
+        return _flat_fieldnames(self.iter_flat())
+
     def to_flatfile(self):
         """
         Turn the object stored in the data into a "flat" list of dicts
@@ -375,49 +1700,81 @@ class ThreeSixtyGiving:
         in the nested object (eg grants['recipientOrganization'][0]['name']
         is turned into `recipientOrganization.0.name`)
 
+        For large datasets use `iter_flat()` and `flat_fieldnames()` instead, which
+        don't need every flattened grant to be held in memory at once.
+
         :return: A tuple with the flattened data and the fieldnames within the data
         :rtype: tuple
         """
         data = []
-        fieldnames = []
-        for g in self:
-            g_flat = g.to_flat()
+        fieldnames = OrderedDict()
+        for g_flat in self.iter_flat():
             data.append(g_flat)
-            for f in g_flat.keys():
-                if f not in fieldnames:
-                    fieldnames.append(f)
-        return (data, fieldnames)
+            for f in g_flat:
+                fieldnames[f] = None
+        return (data, list(fieldnames))
 
-    def to_csv(self, f, convert_fieldnames=True):
+    @_export_stage('export_csv')
+    def to_csv(self, f, convert_fieldnames=True, fieldnames=None):
         """
         Convert data into a CSV file
 
-        :param f: Either a file path or an open fileobj
+        The grants are flattened twice - once to find the fieldnames and once
+        to write the rows - so the flattened grants aren't held in memory. If
+        `fieldnames` are given then the first pass is skipped.
+
+        To convert a JSON file that is too big to load, use `stream_to_csv()`.
+
+        :param f: Either a file path or an open fileobj (eg `sys.stdout`). If a fileobj is provided it won't close it afterwards
         :param bool convert_fieldnames: Whether to convert fieldnames into a more friendly format or not (uses the dictionary created in `self.fetch_schema()`)
+        :param list fieldnames: The flattened fields to include as columns. Other fields are left out
+        """
+        if fieldnames is None:
+            fieldnames = self.flat_fieldnames()
+        header = self.convert_fieldnames(fieldnames) if convert_fieldnames else None
+        _write_csv(f, fieldnames, self.iter_flat(), header)
 
-        Note: closes the file after writing the data
+    @classmethod
+    def stream_to_csv(cls, source, f, convert_fieldnames=True, fieldnames=None, **kwargs):
         """
-        closefile = False
-        if isinstance(f, str):
-            f = open(f, 'w')
-            closefile = True
+        Convert a 360Giving JSON file into a CSV file one grant at a time, without
+        loading the whole file, so memory use stays the same however big the file is
+
+        Unless `fieldnames` are given, the JSON file is read twice - once to find the
+        fieldnames and once to write the rows - so it must be a file path or a
+        seekable file-like object. The grants aren't validated.
 
-        data, fieldnames = self.to_flatfile()
+        :param source: file path to a JSON file or a binary file-like object with a `read()` method
+        :param f: Either a file path or an open fileobj (eg `sys.stdout`). If a fileobj is provided it won't close it afterwards
+        :param bool convert_fieldnames: Whether to convert fieldnames into a more friendly format (fetches the schema)
+        :param list fieldnames: The flattened fields to include as columns. Other fields are left out
+        :raises: ValueError if fieldnames aren't given and the source can't be read twice
 
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        Additional keyword arguments are passed to `cls.__init__()` to find the schema.
+        """
+        stream = cls.iter_json(source)
+        if fieldnames is None:
+            fieldnames = stream.flat_fieldnames()
+        header = None
         if convert_fieldnames:
-            writer.writerow(self.convert_fieldnames(fieldnames))
-        else:
-            writer.writeheader()
-        for r in data:
-            writer.writerow(r)
-        if closefile:
-            f.close()
+            c = cls(**kwargs)
+            c.fetch_schema()
+            header = c.convert_fieldnames(fieldnames)
+        _write_csv(f, fieldnames, stream.iter_flat(), header)
 
+    @_export_stage('export_excel')
     def to_excel(self, f, multiple_sheets=False, convert_fieldnames=True):
         """
         Convert data into an Excel file
 
+        The rows are written as each grant is flattened using the `constant_memory`
+        mode of `xlsxwriter`, so the whole workbook isn't held in memory.
+
+        With `multiple_sheets` each field that the schema (fetched if needed) says holds
+        a list of objects (eg `beneficiaryLocation`) is put on its own sheet, with one row
+        per object and a `grant_id` column with the identifier of the grant it belongs to.
+        Other fields are on the first sheet.
+
         :param f: file path for excel file
         :param bool multiple_sheets: Whether the output will be all on one sheet, or with one sheet for each sub-category
         :param bool convert_fieldnames: Whether to convert fieldnames into a more friendly format or not (uses the dictionary created in `self.fetch_schema()`)
@@ -426,13 +1783,11 @@ class ThreeSixtyGiving:
         """
         import xlsxwriter
 
+        workbook = xlsxwriter.Workbook(f, {'constant_memory': True})
         if multiple_sheets:
-            raise NotImplementedError("Not yet able to do multiple sheets")
+            self._write_excel_sheets(workbook, convert_fieldnames)
         else:
-
-            data, fieldnames = self.to_flatfile()
-
-            workbook = xlsxwriter.Workbook(f)
+            fieldnames = self.flat_fieldnames()
             worksheet = workbook.add_worksheet()
 
             # write header
@@ -442,73 +1797,419 @@ class ThreeSixtyGiving:
                 worksheet.write_row(0, 0, fieldnames)
 
             # write rows
-            for row, r in enumerate(data):
+            for row, r in enumerate(self.iter_flat()):
                 worksheet.write_row(row+1, 0, [r.get(f) for f in fieldnames])
-            workbook.close()
+        workbook.close()
+
+    # the column on each sub-object sheet written by `to_excel(multiple_sheets=True)`
+    # that holds the identifier of the grant, and its title when converting fieldnames
+    sheet_grant_id = 'grant_id'
+    sheet_grant_id_title = 'Grant Identifier'
+
+    def _sub_sheet_fields(self):
+        """
+        Find the top-level fields that the schema says hold a list of objects,
+        fetching the schema if needed
+        """
+        if self.schema is None:
+            self.fetch_schema()
+        properties = self.schema['properties'][self.root_id]['items'].get('properties', {})
+        fields = []
+        for k, prop in properties.items():
+            items = prop.get('items', {})
+            if 'array' in _types(prop) and isinstance(items, dict) and \
+                    ('object' in _types(items) or 'properties' in items):
+                fields.append(k)
+        return fields
+
+    def _iter_sheet_rows(self, sub_fields):
+        """
+        Yield each grant split into the rows for each sheet
+
+        :param list sub_fields: the fields that are put on their own sheets
+        :return: Iterator of `(grant, flattened grant, dict of lists of flattened sub-objects)`
+        """
+        for g in self.data.get(self.root_id, []):
+            main = Grant.from_dict(OrderedDict(
+                (k, v) for k, v in g.items() if k not in sub_fields)).to_flat()
+            subs = OrderedDict()
+            for k in sub_fields:
+                items = g.get(k)
+                if items is None:
+                    continue
+                if not isinstance(items, list):
+                    items = [items]
+                subs[k] = [
+                    Grant.from_dict(i).to_flat() if isinstance(i, dict) else OrderedDict([(k, i)])
+                    for i in items
+                ]
+            yield g, main, subs
+
+    def _write_excel_sheets(self, workbook, convert_fieldnames=True):
+        """
+        Write the grants to a workbook with a sheet for each repeated sub-object (see `to_excel()`)
+        """
+        sub_fields = self._sub_sheet_fields()
+
+        # find the columns for each sheet
+        fieldnames = OrderedDict()
+        sub_fieldnames = OrderedDict((k, OrderedDict()) for k in sub_fields)
+        for g, main, subs in self._iter_sheet_rows(sub_fields):
+            for f in main:
+                fieldnames[f] = None
+            for k, items in subs.items():
+                for item in items:
+                    for f in item:
+                        sub_fieldnames[k][f] = None
+        fieldnames = list(fieldnames)
+        sub_fieldnames = OrderedDict((k, list(v)) for k, v in sub_fieldnames.items())
+
+        # write the headers
+        worksheet = workbook.add_worksheet(self.root_id)
+        sub_worksheets = OrderedDict(
+            (k, workbook.add_worksheet(k[:31])) for k in sub_fields)
+        if convert_fieldnames:
+            worksheet.write_row(0, 0, self.convert_fieldnames(fieldnames).values())
+            for k, sub_worksheet in sub_worksheets.items():
+                # use the titles of the fields within the sub-object
+                headers = sub_fieldnames[k]
+                if self.fieldname_converter is not None and k in self.fieldname_converter.tree:
+                    prefix = '{}:0:'.format(self.fieldname_converter.tree[k][0])
+                    converted = self.convert_fieldnames(
+                        ['{}.0.{}'.format(k, f) for f in headers]).values()
+                    headers = [c[len(prefix):] if c.startswith(prefix) else f
+                               for c, f in zip(converted, headers)]
+                sub_worksheet.write_row(0, 0, [self.sheet_grant_id_title] + headers)
+        else:
+            worksheet.write_row(0, 0, fieldnames)
+            for k, sub_worksheet in sub_worksheets.items():
+                sub_worksheet.write_row(0, 0, [self.sheet_grant_id] + sub_fieldnames[k])
+
+        # write the rows, one grant at a time
+        sub_rows = OrderedDict((k, 1) for k in sub_fields)
+        for row, (g, main, subs) in enumerate(self._iter_sheet_rows(sub_fields)):
+            worksheet.write_row(row + 1, 0, [main.get(f) for f in fieldnames])
+            for k, items in subs.items():
+                for item in items:
+                    sub_worksheets[k].write_row(
+                        sub_rows[k], 0, [g.get('id')] + [item.get(f) for f in sub_fieldnames[k]])
+                    sub_rows[k] += 1
 
     to_xlsx = to_excel # alias for to_excel
 
-    def to_pandas(self, convert_fieldnames=True):
+    @_export_stage('export_pandas')
+    def to_pandas(self, convert_fieldnames=True, typed=False):
         """
         Convert the data to a pandas DataFrame.
 
         :param bool convert_fieldnames: Whether to convert fieldnames into a more friendly format or not (uses the dictionary created in `self.fetch_schema()`)
+        :param bool typed: Whether to give the columns types based on the schema (which is fetched if needed), rather than the types guessed by pandas
         :return: Pandas dataframe
         :raises: ImportError if pandas is not installed
         """
+        import numpy
         import pandas
-        data, fieldnames = self.to_flatfile()
-        df = pandas.DataFrame(data)
+
+        # missing values are NaN, as they are when a DataFrame is created from a list of rows
+        columns = self._flat_columns(numpy.nan)
+        fieldnames = list(columns.keys())
+
+        if typed:
+            if self.schema is None:
+                self.fetch_schema()
+            unflattener = Unflattener(self.schema['properties'][self.root_id]['items'])
+            for f, column in columns.items():
+                columns[f] = self._pandas_column(column, unflattener.parse_header(f)[1])
+        df = pandas.DataFrame(columns)
         if convert_fieldnames:
             df = df.rename(columns=self.convert_fieldnames(fieldnames))
 
         return df
 
+    # string columns with fewer distinct values than this proportion of
+    # their values are turned into categories by `to_pandas(typed=True)`
+    category_threshold = 0.5
+
+    @classmethod
+    def _pandas_column(cls, values, prop):
+        """
+        Turn a list of values into a pandas series or numpy array with a type
+        based on their schema. Values that don't match the type are left as they are.
+        """
+        import numpy
+        import pandas
+
+        if prop is None:
+            return values
+        types = _types(prop)
+        present = [v for v in values if v is not None and v is not numpy.nan]
+        try:
+            if types == ['number'] or (types == ['integer'] and len(present) < len(values)):
+                if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in present):
+                    return numpy.array(
+                        [numpy.nan if v is None else v for v in values], dtype='float64')
+            elif types == ['integer']:
+                if all(isinstance(v, int) and not isinstance(v, bool) for v in present):
+                    return numpy.array(values, dtype='int64')
+            elif types == ['boolean']:
+                if len(present) == len(values) and all(isinstance(v, bool) for v in present):
+                    return numpy.array(values, dtype='bool')
+            elif types == ['string'] and _is_datetime(prop):
+                return pandas.to_datetime(values, utc=True)
+            elif types == ['string']:
+                if len(set(present)) <= len(present) * cls.category_threshold:
+                    return pandas.Categorical(values)
+        except (TypeError, ValueError, OverflowError):
+            pass
+        return values
+
+    @_export_stage('export_arrow')
+    def to_arrow(self):
+        """
+        Convert the grants to an Arrow table, with a column for each top-level field
+
+        The column types are based on the schema (which is fetched if needed):
+        amounts are floats, dates are dates or timestamps, and nested objects and
+        arrays become struct and list columns. The package-level fields and whether
+        the data is valid are stored in the table's metadata.
+
+        :return: Arrow table
+        :raises: ImportError if pyarrow is not installed
+        """
+        if self.schema is None:
+            self.fetch_schema()
+        package = OrderedDict(
+            (k, None if k == self.root_id else v) for k, v in self.data.items())
+        return grants_to_table(
+            self.data.get(self.root_id, []),
+            grant_schema=self.schema['properties'][self.root_id]['items'],
+            metadata={
+                'package': package,
+                'valid': self.valid,
+                'schema_url': self.schema_url,
+            },
+        )
+
+    def to_parquet(self, f, **kwargs):
+        """
+        Convert the grants into a Parquet file, which can be loaded again using `from_parquet()`
+
+        :param f: Either a file path or an open binary fileobj
+        :return: None
+        :raises: ImportError if pyarrow is not installed
+
+        Additional keyword arguments (eg `compression`) are passed to `pyarrow.parquet.write_table()`
+        """
+        import pyarrow.parquet
+        table = self.to_arrow()
+        with self.stats.stage('export_parquet'):
+            pyarrow.parquet.write_table(table, f, **kwargs)
+
     def convert_fieldnames(self, fieldnames):
         """
-        Applies the transformations in `self.replace_names` to a set of fieldnames
+        Converts a set of fieldnames into the titles used in the schema,
+        using the `FieldnameConverter` created in `self.fetch_schema()`
+
+        Fieldnames are left unchanged if no schema has been fetched.
 
         :param list[str] fieldnames: A list of fieldnames to replace
         :return: Dictionary of old:new values for fieldnames
         """
-        fieldnames = OrderedDict(zip(fieldnames, fieldnames))
-        for old, new in self.replace_names.items():
-            for field in fieldnames:
-                if re.fullmatch(old, field):
-                    fieldnames[field] = re.sub(old, new, field)
-        return fieldnames
+        self._fetch_deferred_schema()
+        if self.fieldname_converter is None:
+            return OrderedDict(zip(fieldnames, fieldnames))
+        return self.fieldname_converter.convert_many(fieldnames)
+
+
+class DownloadReader:
+    """
+    A file-like object for reading the body of a streamed `requests` response
+
+    Any gzip or deflate content encoding is decoded, and an error is raised if
+    more than `max_size` bytes are read. The response is closed once all of it has been read.
+    """
+
+    def __init__(self, response, max_size=None, chunk_size=64 * 1024):
+        length = response.headers.get('content-length')
+        if max_size and length and length.isdigit() and not response.headers.get('content-encoding'):
+            if int(length) > max_size:
+                response.close()
+                raise ValueError("File is larger than the maximum size of {} bytes".format(max_size))
+        self.response = response
+        self.max_size = max_size
+        self.size = 0
+        self._chunks = response.iter_content(chunk_size)
+        self._buffer = b''
+
+    def read(self, n=-1):
+        while n is None or n < 0 or len(self._buffer) < n:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self.response.close()
+                break
+            self.size += len(chunk)
+            if self.max_size and self.size > self.max_size:
+                self.response.close()
+                raise ValueError("File is larger than the maximum size of {} bytes".format(self.max_size))
+            self._buffer += chunk
+        if n is None or n < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:n], self._buffer[n:]
+        return data
+
+
+class GrantStream:
+    """
+    Iterates through the grants in a 360Giving JSON file using an incremental
+    parser, so only one grant is held in memory at a time
+
+    Requires the `ijson` library to be installed
+    """
+
+    def __init__(self, f, root_id='grants'):
+        self.f = f
+        self.root_id = root_id
+        self.metadata = OrderedDict()
+
+    def __iter__(self):
+        for g in self.iter_raw():
+            yield Grant.from_dict(g)
+
+    def iter_flat(self):
+        """
+        Yield each grant in the file as a "flat" dict (see `Grant.to_flat()`)
+        """
+        for g in self:
+            yield g.to_flat()
+
+    def flat_fieldnames(self):
+        """
+        Find all the fieldnames used by the flattened grants, by reading through the file
+
+        The file is read again when the grants are iterated, so it must be a
+        file path or a seekable file-like object.
+
+        :return: List of fieldnames
+        :rtype: list
+        :raises: ValueError if the file can't be read twice
+        """
+        if isinstance(self.f, str):
+            return _flat_fieldnames(self.iter_flat())
+        if not (hasattr(self.f, 'seekable') and self.f.seekable()):
+            raise ValueError("The fieldnames must be given when the file can't be read twice")
+        start = self.f.tell()
+        try:
+            return _flat_fieldnames(self.iter_flat())
+        finally:
+            self.f.seek(start)
+
+    def iter_raw(self):
+        """
+        Yield each grant in the file as a plain dictionary
+        """
+        if isinstance(self.f, str):
+            with open(self.f, 'rb') as fileobj:
+                yield from self._parse(fileobj)
+        else:
+            yield from self._parse(self.f)
+
+    def _parse(self, fileobj):
+        import ijson
+
+        item_prefix = '{}.item'.format(self.root_id)
+        key = None
+        builder = None
+        depth = 0
+        for prefix, event, value in ijson.parse(fileobj, use_float=True):
+
+            # look for the start of a grant or a package-level field
+            if builder is None:
+                if prefix == '' and event == 'map_key':
+                    key = value
+                    continue
+                if prefix == item_prefix or (key != self.root_id and prefix == key):
+                    builder = ijson.ObjectBuilder()
+                else:
+                    continue
+
+            builder.event(event, value)
+            if event in ('start_map', 'start_array'):
+                depth += 1
+            elif event in ('end_map', 'end_array'):
+                depth -= 1
+
+            # the object is complete once we're back at the level we started
+            if depth == 0:
+                if prefix == item_prefix:
+                    yield builder.value
+                else:
+                    self.metadata[key] = builder.value
+                builder = None
 
 
 class Grant:
     """
     A class to hold details about a particular grant in the 360Giving standard
+
+    Fields can be accessed as attributes (`grant.id`) or like a dictionary (`grant["id"]`).
     """
 
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
 
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Create a grant object that uses an existing dictionary to hold its fields,
+        without copying it
+
+        Changes to the grant object change the dictionary, and vice versa.
+
+        :param dict data: the grant
+        :rtype: Grant
+        """
+        grant = cls.__new__(cls)
+        grant.__dict__ = data
+        return grant
+
     def __repr__(self):
         return '<Grant {}>'.format(self.id)
 
+    def __getitem__(self, key):
+        return self.__dict__[key]
+
+    def __setitem__(self, key, value):
+        self.__dict__[key] = value
+
+    def __contains__(self, key):
+        return key in self.__dict__
+
+    def get(self, key, default=None):
+        return self.__dict__.get(key, default)
+
+    def to_dict(self):
+        """
+        Get the dictionary holding the grant's fields
+        """
+        return self.__dict__
+
     def to_flat(self):
         """
         Turn the nested grant object into a flat dictionary of key:values
 
         Nested fields are turned into the form `key.0.subkey`
         """
-        def flatten(vals, prefix=''):
-            new_vals = []
-            if isinstance(vals, list):
-                vals = dict(zip(map(str, range(len(vals))), vals))
-
-            for v in vals:
-                new_key = '{}.{}'.format(prefix, v) if prefix != '' else v
-                if isinstance(vals[v], list):
-                    new_vals.extend(flatten(vals[v], new_key))
-                elif isinstance(vals[v], dict):
-                    new_vals.extend(flatten(vals[v], new_key))
+        flat = OrderedDict()
+
+        def flatten(vals, prefix):
+            items = enumerate(vals) if isinstance(vals, list) else vals.items()
+            for k, v in items:
+                new_key = prefix + k if isinstance(k, str) else prefix + str(k)
+                if isinstance(v, (list, dict)):
+                    flatten(v, new_key + '.')
                 else:
-                    new_vals.append((new_key, vals[v]))
-            return new_vals
+                    flat[new_key] = v
 
-        return OrderedDict(flatten(self.__dict__))
+        flatten(self.__dict__, '')
+        return flat
@@ -0,0 +1,208 @@
+import datetime
+
+
+def _types(prop):
+    """
+    Get the list of JSON types allowed for a property
+    """
+    t = prop.get('type', [])
+    if isinstance(t, str):
+        return [t]
+    return list(t)
+
+
+class Unflattener:
+    """
+    Turns rows from a 360Giving flat file (eg a CSV file or an Excel sheet)
+    into nested grant objects, without going through `flattentool`
+
+    Column headings can either be titles from the schema (eg `Recipient Org:0:Identifier`)
+    or field paths (eg `recipientOrganization.0.id`). Values are converted to
+    the type given in the schema. Columns that aren't found in the schema are
+    added to the grant using the heading as the key.
+
+    Only a single sheet is supported - sub-objects on separate sheets
+    (which `flattentool` can join together) aren't.
+    """
+
+    array_separator = ';'
+
+    def __init__(self, grant_schema):
+        """
+        :param dict grant_schema: the schema for an individual grant, with references resolved
+        """
+        self.properties = grant_schema.get('properties', {})
+        self._lookups = {}
+        self._headers = {}
+
+    def _lookup(self, props, name):
+        """
+        Find a property by either its name or its title (ignoring case)
+        """
+        lookup = self._lookups.get(id(props))
+        if lookup is None:
+            lookup = {}
+            for k, prop in props.items():
+                lookup[prop.get('title', k).lower()] = k
+            for k in props:
+                lookup[k] = k
+            self._lookups[id(props)] = lookup
+        return lookup.get(name, lookup.get(name.lower()))
+
+    def parse_header(self, header):
+        """
+        Work out where a column fits in a grant
+
+        :param str header: the column heading
+        :return: tuple of `(path, property schema)`, where path is a list of keys and
+            array indexes. The property schema is None if the column isn't in the schema
+        """
+        if header not in self._headers:
+            result = None
+            for separator in (':', '.'):
+                if separator in header or separator == '.':
+                    result = self._resolve(header.split(separator))
+                if result is not None:
+                    break
+            if result is None:
+                result = ([header], None)
+            self._headers[header] = result
+        return self._headers[header]
+
+    def _resolve(self, segments):
+        path = []
+        props = self.properties
+        i = 0
+        while i < len(segments):
+            if props is None:
+                return None
+            name = self._lookup(props, segments[i].strip())
+            if name is None:
+                return None
+            prop = props[name]
+            path.append(name)
+            i += 1
+            types = _types(prop)
+            if 'array' in types and 'object' in _types(prop.get('items', {})):
+                # the index can be left out if there is only one item
+                index = 0
+                if i < len(segments) and segments[i].strip().isdigit():
+                    index = int(segments[i])
+                    i += 1
+                path.append(index)
+                props = prop['items'].get('properties', {})
+            elif 'object' in types:
+                props = prop.get('properties', {})
+            elif i < len(segments):
+                return None
+            else:
+                return (path, prop)
+        return None
+
+    def convert(self, value, prop):
+        """
+        Convert a value from a flat file into the type given in the schema
+
+        Values that can't be converted are returned unchanged so they
+        are picked up when the data is validated.
+        """
+        if prop is None:
+            return value
+        types = _types(prop)
+
+        if isinstance(value, datetime.datetime):
+            if prop.get('format') == 'date':
+                return value.date().isoformat()
+            if value.tzinfo is None:
+                value = value.replace(tzinfo=datetime.timezone.utc)
+            return value.isoformat()
+        if isinstance(value, datetime.date):
+            return value.isoformat()
+
+        if 'array' in types:
+            if isinstance(value, str):
+                return [v.strip() for v in value.split(self.array_separator)]
+            return [value]
+
+        if isinstance(value, bool):
+            return value
+        if 'boolean' in types and isinstance(value, str):
+            v = value.strip().lower()
+            if v in ('true', 'yes', '1'):
+                return True
+            if v in ('false', 'no', '0'):
+                return False
+            return value
+
+        if 'integer' in types or 'number' in types:
+            if isinstance(value, float) and value.is_integer():
+                return int(value)
+            if isinstance(value, str):
+                v = value.strip()
+                try:
+                    return int(v)
+                except ValueError:
+                    pass
+                if 'number' in types:
+                    try:
+                        f = float(v)
+                        return int(f) if f.is_integer() else f
+                    except ValueError:
+                        pass
+            return value
+
+        if 'string' in types and not isinstance(value, str):
+            if isinstance(value, float) and value.is_integer():
+                value = int(value)
+            return str(value)
+        return value
+
+    def unflatten_row(self, headers, row):
+        """
+        Turn a single row into a grant
+
+        :param list headers: the column headings
+        :param list row: the values in the row
+        :return: the grant as a dict, or None if the row is empty
+        """
+        grant = {}
+        for header, value in zip(headers, row):
+            if value is None or header is None or header == '':
+                continue
+            if isinstance(value, str):
+                value = value.strip()
+                if value == '':
+                    continue
+            path, prop = self.parse_header(header)
+            value = self.convert(value, prop)
+
+            # create any nested objects and arrays needed to hold the value
+            obj = grant
+            for key, next_key in zip(path, path[1:]):
+                if isinstance(obj, list):
+                    while len(obj) <= key:
+                        obj.append({})
+                    obj = obj[key]
+                else:
+                    obj = obj.setdefault(key, [] if isinstance(next_key, int) else {})
+            obj[path[-1]] = value
+        return grant or None
+
+    def unflatten(self, rows):
+        """
+        Turn rows from a flat file into grants, one row at a time
+
+        :param rows: iterable of rows, where the first row contains the column headings
+        :return: iterator of grants as dicts
+        """
+        rows = iter(rows)
+        headers = None
+        for row in rows:
+            headers = [str(h).strip() if h is not None else None for h in row]
+            break
+        if headers is None:
+            return
+        for row in rows:
+            grant = self.unflatten_row(headers, row)
+            if grant is not None:
+                yield grant